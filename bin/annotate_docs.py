@@ -1,22 +1,217 @@
+import argparse
+import json
 import os
 import sys
 
 sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+from lib.annotation_cache import AnnotationCache
+from lib.annotation_server import RemoteAnnotator
 from lib.batch_annotator import BatchAnnotator
+from lib.memory_usage import memory_usage
+from lib.metrics import Metrics
+from lib.normalizer import TextNormalizer
+from lib.postings import PostingsWriter
+from lib.text_chunker import TextChunker
 
 
-def main(csv_filename):
-    batch_annotator = BatchAnnotator(linker="umls")
+def shard(value):
+    """
+    Parse a --shard argument such as 2/4.
+    """
+    try:
+        index, count = (int(part) for part in value.split("/"))
+    except ValueError:
+        raise argparse.ArgumentTypeError("expected a shard such as 2/4")
+    if not 1 <= index <= count:
+        raise argparse.ArgumentTypeError("shard %d/%d is not between 1/%d and %d/%d" % (index, count, count,
+                                                                                          count, count))
+    return index, count
 
-    output_filename = csv_filename.replace(".csv", ".json")
 
-    batch_annotator.load_csv(csv_filename)
-    batch_annotator.annotate(output_file=output_filename)
-    print("Done annotating %s, output in %s" % (csv_filename, output_filename))
+def row_range(value):
+    """
+    Parse a --rows argument such as 1000:2000, or 1000: for all rows from 1000.
+    """
+    try:
+        start, end = value.split(":")
+        start = int(start) if start else 0
+        end = int(end) if end else None
+    except ValueError:
+        raise argparse.ArgumentTypeError("expected rows such as 1000:2000")
+    if start < 0 or (end is not None and end < start):
+        raise argparse.ArgumentTypeError("rows %s are not a valid range" % value)
+    return start, end
+
+
+def main(args):
+    csv_filename = args.csv_filename
+    if args.server:
+        # Use the ScispaCy already loaded by annotation_server.py
+        batch_annotator = BatchAnnotator(annotator=RemoteAnnotator(args.server))
+    else:
+        linkers = args.linkers.split(",")
+        batch_annotator = BatchAnnotator(linker=linkers if len(linkers) > 1 else linkers[0],
+                                         mention_cache_size=args.mention_cache_size, snapshot=args.snapshot,
+                                         score_floor=args.score_floor)
+    batch_annotator.combined = args.combined
+
+    # Extra characters to replace in the documents
+    if args.normalize_map:
+        with open(args.normalize_map, "r", encoding="utf-8") as f:
+            batch_annotator.text_normalizer = TextNormalizer(json.load(f))
+
+    # Rows of the CSV to annotate on this machine, named so that the outputs
+    # of several machines don't collide
+    start = 0
+    end = args.max_docs
+    suffix = ""
+    if args.shard:
+        index, count = args.shard
+        n_rows = BatchAnnotator.count_rows(csv_filename, encoding=args.encoding, text_column=args.text_column)
+        if args.max_docs is not None:
+            n_rows = min(n_rows, args.max_docs)
+        start, end = (index - 1) * n_rows // count, index * n_rows // count
+        suffix = ".shard%dof%d" % (index, count)
+    elif args.rows:
+        start, end = args.rows
+        if args.max_docs is not None:
+            end = start + args.max_docs if end is None else min(end, start + args.max_docs)
+        suffix = ".rows%d-%s" % (start, "" if end is None else end)
+    if suffix:
+        print("Annotating rows %d to %s" % (start, "the end" if end is None else end - 1))
+
+    output_filename = csv_filename.replace(".csv", suffix + "." + args.format)
+
+    # Reuse annotations of identical documents
+    cache = None
+    if args.cache:
+        cache = AnnotationCache(args.cache, max_bytes=args.cache_size * 1024 * 1024)
+        batch_annotator.annotator.cache = cache
+
+    # Split very long documents into windows
+    if args.window_size:
+        batch_annotator.annotator.chunker = TextChunker(args.window_size, args.window_overlap)
+
+    # Time the pipeline stages
+    if args.metrics or args.prometheus:
+        batch_annotator.metrics = Metrics(jsonl_file=args.metrics, prometheus_file=args.prometheus,
+                                          interval=args.metrics_interval)
+
+    # Write the terms to disk when they take more memory than this
+    if args.memory_budget:
+        batch_annotator.memory_budget = int(args.memory_budget * 1024 * 1024)
+    batch_annotator.queue_size = args.queue_size
+
+    # Record the documents each concept is found in
+    postings_filename = None
+    if args.postings:
+        postings_filename = os.path.splitext(output_filename)[0] + ".postings.npz"
+        batch_annotator.postings = PostingsWriter(postings_filename, first_row=start)
+
+    # Read the CSV a chunk at a time while annotating
+    batch_annotator.stream_csv(csv_filename, encoding=args.encoding, text_column=args.text_column,
+                               max_docs=None if end is None else end - start, chunksize=args.chunk_size, start=start)
+    batch_annotator.annotate(output_file=output_filename, batch_size=args.batch_size, workers=args.workers,
+                             checkpoint=True, resume=args.resume, incremental=args.incremental)
+    output_filenames = batch_annotator.output_files(output_filename).values()
+    print("Done annotating %s, output in %s" % (csv_filename, ", ".join(output_filenames)))
+    if postings_filename:
+        print("Postings in", postings_filename)
+
+    for mention_cache in batch_annotator.annotator.mention_caches.values():
+        print(mention_cache.stats())
+    if cache:
+        print(cache.stats())
+        cache.close()
+    if batch_annotator.metrics:
+        print(batch_annotator.metrics.summary())
+    peak = memory_usage().get("peak_rss")
+    if peak is not None:
+        print("Peak memory: %.0f MB" % (peak / 1048576.0))
 
 
 if __name__ == "__main__":
-    if len(sys.argv) < 2 or not sys.argv[1].endswith(".csv"):
+    parser = argparse.ArgumentParser(description="Annotate a CSV of medical documents with ScispaCy.")
+    parser.add_argument("csv_filename", help="CSV file (.csv) to process")
+    parser.add_argument("--linkers", default="umls",
+                        help="Comma separated thesauri to link to: umls, mesh, rxnorm, go, hpo (default umls)")
+    parser.add_argument("--snapshot", metavar="DIR", default=os.environ.get("TERMSET_SNAPSHOT"),
+                        help="Load ScispaCy from a snapshot written by build_snapshot.py, which starts in seconds "
+                             "(default $TERMSET_SNAPSHOT if set)")
+    parser.add_argument("--score-floor", type=float, default=None, metavar="SCORE",
+                        help="Keep terms with scores down to SCORE, each with a histogram of its scores, so that the "
+                             "confidence can be chosen in termset_generator.py without annotating again "
+                             "(default keep scores of at least 0.7)")
+    parser.add_argument("--combined", action="store_true",
+                        help="With several linkers, write one output file with CUIs prefixed by the linker name")
+    parser.add_argument("--format", choices=["json", "sqlite"], default="json",
+                        help="Output format: json, or sqlite indexed by CUI for large corpora (default json)")
+    parser.add_argument("--batch-size", type=int, default=32,
+                        help="Number of documents to send through ScispaCy at once (default 32)")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Number of processes to annotate with in parallel (default 1)")
+    parser.add_argument("--encoding", default="utf-8",
+                        help="Encoding of the CSV file (default utf-8)")
+    parser.add_argument("--text-column", default="TEXT",
+                        help="Name of the column with the medical text (default TEXT)")
+    parser.add_argument("--window-size", type=int, default=None, metavar="CHARS",
+                        help="Split documents longer than CHARS characters into windows on paragraph or sentence "
+                             "boundaries (default no splitting)")
+    parser.add_argument("--window-overlap", type=int, default=200, metavar="CHARS",
+                        help="Characters of context around each window (default 200)")
+    parser.add_argument("--normalize-map", metavar="FILE",
+                        help="JSON file mapping extra text to replace in the documents to its replacement")
+    parser.add_argument("--max-docs", type=int, default=None,
+                        help="Only annotate the first MAX_DOCS documents")
+    parser.add_argument("--shard", type=shard, metavar="I/N",
+                        help="Only annotate the Ith of N equal ranges of rows, such as 2/4 on the second of four "
+                             "machines, writing my_csv_file.shard2of4.json. Combine them with merge_outputs.py.")
+    parser.add_argument("--rows", type=row_range, metavar="START:END",
+                        help="Only annotate rows START to END-1 (counted from 0, not including the header), "
+                             "writing my_csv_file.rowsSTART-END.json")
+    parser.add_argument("--chunk-size", type=int, default=1000,
+                        help="Number of CSV rows to read at a time (default 1000)")
+    parser.add_argument("--resume", action="store_true",
+                        help="Continue an interrupted run from its checkpoint")
+    parser.add_argument("--incremental", action="store_true",
+                        help="Only annotate documents not annotated by earlier --incremental runs and add their terms "
+                             "to the existing output")
+    parser.add_argument("--postings", action="store_true",
+                        help="Also write the documents each concept and term is found in to "
+                             "my_csv_file.postings.npz, for query_postings.py")
+    parser.add_argument("--memory-budget", type=float, default=None, metavar="MB",
+                        help="Approximate memory for the terms found, beyond which they are written to sorted files "
+                             "next to the output and merged when saving (default no limit)")
+    parser.add_argument("--queue-size", type=int, default=1000,
+                        help="Number of docs to read ahead of annotating them, and of annotated docs (shards with "
+                             "--workers) waiting to be merged and saved, each in a background thread (default "
+                             "1000, 0 to run the stages one after another)")
+    parser.add_argument("--cache", metavar="FILE",
+                        help="SQLite file to cache annotated documents in, reused across runs")
+    parser.add_argument("--cache-size", type=int, default=1024,
+                        help="Max size of the annotation cache in MB (default 1024)")
+    parser.add_argument("--mention-cache-size", type=int, default=100000,
+                        help="Number of distinct mentions to cache linked concepts for (default 100000, 0 to disable)")
+    parser.add_argument("--metrics", metavar="FILE",
+                        help="JSON-lines file to append stage timings, histograms and progress to")
+    parser.add_argument("--prometheus", metavar="FILE",
+                        help="Prometheus textfile to write the same metrics to, for node_exporter")
+    parser.add_argument("--metrics-interval", type=float, default=10.0,
+                        help="Seconds between metrics writes (default 10)")
+    parser.add_argument("--server", nargs="?", const="http://127.0.0.1:8765", metavar="URL",
+                        help="Annotate with a running annotation_server.py (default URL http://127.0.0.1:8765)")
+    args = parser.parse_args()
+
+    if args.shard and args.rows:
+        parser.error("Use either --shard or --rows")
+
+    if args.postings and args.incremental:
+        parser.error("--postings can't be used with --incremental")
+
+    if args.server and (args.workers > 1 or args.cache or args.window_size):
+        parser.error("--workers, --cache and --window-size are set on annotation_server.py when using --server")
+
+    if not args.csv_filename.endswith(".csv"):
         print("Specify a CSV file (.csv) to process")
     else:
-        main(sys.argv[1])
+        main(args)
@@ -0,0 +1,69 @@
+"""
+Run a local annotation server that keeps ScispaCy loaded.
+
+Loading ScispaCy and the UMLS linker can take minutes, so for many small
+batches start this server once and run annotate_docs.py with --server to
+send the documents to it.
+
+Usage:
+python bin/annotation_server.py --port 8765
+"""
+import argparse
+import os
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+from lib.annotation_cache import AnnotationCache
+from lib.annotation_server import AnnotationServer
+from lib.scispacy_annotator import SciSpacyAnnotator
+from lib.text_chunker import TextChunker
+
+
+def main(args):
+    linkers = args.linkers.split(",")
+    annotator = SciSpacyAnnotator(linker=linkers if len(linkers) > 1 else linkers[0],
+                                  mention_cache_size=args.mention_cache_size, snapshot=args.snapshot,
+                                  score_floor=args.score_floor)
+    if args.cache:
+        annotator.cache = AnnotationCache(args.cache, max_bytes=args.cache_size * 1024 * 1024)
+    if args.window_size:
+        annotator.chunker = TextChunker(args.window_size, args.window_overlap)
+
+    server = AnnotationServer(annotator, host=args.host, port=args.port)
+    server.verbose = not args.quiet
+    print("Annotation server listening on http://%s:%d" % (args.host, args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if annotator.cache:
+            annotator.cache.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Keep ScispaCy loaded and annotate documents sent to it.")
+    parser.add_argument("--host", default="127.0.0.1", help="Address to listen on (default 127.0.0.1)")
+    parser.add_argument("--port", type=int, default=8765, help="Port to listen on (default 8765)")
+    parser.add_argument("--linkers", default="umls",
+                        help="Comma separated thesauri to link to: umls, mesh, rxnorm, go, hpo (default umls)")
+    parser.add_argument("--snapshot", metavar="DIR", default=os.environ.get("TERMSET_SNAPSHOT"),
+                        help="Load ScispaCy from a snapshot written by build_snapshot.py, which starts in seconds "
+                             "(default $TERMSET_SNAPSHOT if set)")
+    parser.add_argument("--score-floor", type=float, default=None, metavar="SCORE",
+                        help="Keep terms with scores down to SCORE, each with a histogram of its scores, so that the "
+                             "confidence can be chosen in termset_generator.py without annotating again "
+                             "(default keep scores of at least 0.7)")
+    parser.add_argument("--mention-cache-size", type=int, default=100000,
+                        help="Number of distinct mentions to cache linked concepts for (default 100000, 0 to disable)")
+    parser.add_argument("--cache", metavar="FILE",
+                        help="SQLite file to cache annotated documents in, reused across runs")
+    parser.add_argument("--cache-size", type=int, default=1024,
+                        help="Max size of the annotation cache in MB (default 1024)")
+    parser.add_argument("--window-size", type=int, default=None, metavar="CHARS",
+                        help="Split documents longer than CHARS characters into windows (default no splitting)")
+    parser.add_argument("--window-overlap", type=int, default=200, metavar="CHARS",
+                        help="Characters of context around each window (default 200)")
+    parser.add_argument("--quiet", action="store_true", help="Don't log each request")
+    main(parser.parse_args())
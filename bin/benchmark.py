@@ -0,0 +1,201 @@
+"""
+Throughput benchmark of the annotation pipeline on a synthetic corpus.
+
+Writes a CSV of synthetic clinical notes with skewed concept frequencies,
+then annotates it the way annotate_docs.py does, with
+BatchAnnotator.stream_csv and annotate, and makes phrase dictionaries from
+the output as the termset generator does. Annotation uses a real
+SciSpacyAnnotator with the offline stand-ins for the ScispaCy model and
+linker in stub_linker.py, so the benchmark needs neither the models nor the
+UMLS knowledge base. The time of each stage is taken from the Metrics that
+annotate_docs.py --metrics reports.
+
+Results (docs/sec, peak RSS and seconds per stage) are written as JSON so
+that runs on different revisions can be compared:
+
+python bin/benchmark.py --docs 100000 --output before.json
+python bin/benchmark.py --docs 100000 --output after.json --compare before.json
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+import pandas as pd
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+import streamlit_functions as sf
+from lib.batch_annotator import BatchAnnotator
+from lib.memory_usage import memory_usage
+from lib.metrics import Metrics
+from lib.stub_linker import make_stub_annotator
+from lib.synthetic_corpus import make_vocabulary, write_notes_csv
+from lib.term_store import load_terms
+
+# Stages in the order they run: reading and cleaning up the CSV, the spaCy
+# pipeline, linking, looking up the linked concepts, normalizing and merging
+# the terms, saving the output and making phrase dictionaries. Idle is the
+# time stages waited on each other.
+stages = ["read", "ner", "link", "lookup", "normalize", "aggregate", "save", "idle", "phrase_dict"]
+
+
+def git_revision():
+    """
+    Get the git commit of this checkout, if any.
+    """
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"],
+                                       cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(args, work_dir):
+    """
+    Annotate a synthetic corpus and make phrase dictionaries from it.
+
+    Returns
+    -------
+    Dict of results
+    """
+    vocabulary = make_vocabulary(n_cuis=args.cuis, max_variants=args.variants, skew=args.skew, seed=args.seed)
+
+    csv_filename = os.path.join(work_dir, "notes.csv")
+    output_filename = os.path.join(work_dir, "notes." + args.format)
+    start = time.perf_counter()
+    write_notes_csv(csv_filename, n_docs=args.docs, words_per_doc=args.words, vocabulary=vocabulary, seed=args.seed)
+    generate_time = time.perf_counter() - start
+    csv_mb = os.path.getsize(csv_filename) / 1048576.0
+    print("Wrote %d synthetic notes (%.1f MB) in %.1f sec" % (args.docs, csv_mb, generate_time))
+
+    annotator = make_stub_annotator(vocabulary)
+    batch_annotator = BatchAnnotator(annotator=annotator)
+    batch_annotator.verbose = False
+    batch_annotator.queue_size = args.queue_size
+    batch_annotator.metrics = metrics = Metrics()
+
+    batch_annotator.stream_csv(csv_filename, chunksize=args.chunk_size)
+    terms = batch_annotator.annotate(output_file=output_filename, batch_size=args.batch_size, workers=args.workers,
+                                     checkpoint=args.checkpoint)
+    docs_per_sec = metrics.docs_per_sec()
+
+    # Concepts of interest, each with a few CUIs
+    rng = random.Random(args.seed)
+    cuis = [concept[0] for concept in vocabulary]
+    rows = [("Concept %d" % i, cui) for i in range(args.concepts) for cui in rng.sample(cuis, rng.randint(1, 5))]
+    concept_df = pd.DataFrame(rows, columns=["concept", "cui"])
+    concept_list = list(concept_df["concept"].unique())
+
+    start = time.perf_counter()
+    corpus = load_terms(output_filename, cuids=list(concept_df["cui"].unique()))
+    index = sf.build_concept_index(corpus, concept_df)
+    sf.make_phrase_dict_from_index(index, concept_list, 0.9)
+    metrics.add_time("phrase_dict", time.perf_counter() - start)
+
+    report = metrics.to_dict()
+    return {
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "params": {name: getattr(args, name) for name in
+                   ("docs", "words", "cuis", "variants", "skew", "concepts", "batch_size", "chunk_size", "format",
+                    "workers", "queue_size", "checkpoint", "seed")},
+        "csv_mb": round(csv_mb, 3),
+        "cuis_found": len(terms),
+        "docs_per_sec": round(docs_per_sec, 1),
+        "mb_per_sec": round(csv_mb * docs_per_sec / args.docs, 3),
+        "peak_rss": memory_usage().get("peak_rss"),
+        "stages": {stage: round(report["stages"][stage]["seconds"], 4) for stage in ordered(report["stages"])},
+        "histograms": {name: round(histogram["mean"], 3) for name, histogram in report["histograms"].items()},
+    }
+
+
+def ordered(names):
+    """
+    Get stage names in the order they run, followed by any others.
+    """
+    return [stage for stage in stages if stage in names] + sorted(set(names) - set(stages))
+
+
+def print_results(results, baseline=None):
+    """
+    Print results, and their ratio to a baseline run if any.
+    """
+    print("%-12s %10s %10s" % ("Stage", "Sec", "" if baseline is None else "vs base"))
+    for stage in ordered(results["stages"]):
+        seconds = results["stages"][stage]
+        line = "%-12s %10.3f" % (stage, seconds)
+        if baseline is not None and baseline["stages"].get(stage):
+            line += " %9.2fx" % (baseline["stages"][stage] / seconds if seconds else float("inf"))
+        print(line)
+
+    for name, mean in sorted(results["histograms"].items()):
+        print("%s: mean %.2f" % (name, mean))
+
+    for name, fmt in (("docs_per_sec", "%.0f"), ("peak_rss", "%.0f")):
+        if results[name] is None:
+            # Peak memory isn't available on Windows
+            continue
+        value = results[name] / 1048576.0 if name == "peak_rss" else results[name]
+        line = "%-12s %10s" % ("docs/sec" if name == "docs_per_sec" else "peak MB", fmt % value)
+        if baseline is not None and baseline.get(name) is not None:
+            base = baseline[name] / 1048576.0 if name == "peak_rss" else baseline[name]
+            line += " %10s" % (fmt % base) + " (base %s)" % baseline.get("revision")
+        print(line)
+
+    if baseline is not None and baseline.get("params") != results["params"]:
+        print("WARNING: baseline was run with different parameters")
+
+
+def main(args):
+    if args.workers > 1 and ("fork" not in multiprocessing.get_all_start_methods() or sys.platform == "darwin"):
+        # Workers would load the real ScispaCy models instead of sharing the
+        # stub annotator
+        sys.exit("--workers needs a platform where worker processes are forked, such as Linux")
+
+    with tempfile.TemporaryDirectory(dir=args.work_dir) as work_dir:
+        results = run(args, work_dir)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+
+    print_results(results, baseline)
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+        print("Wrote", args.output)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the annotation pipeline on a synthetic corpus.")
+    parser.add_argument("--docs", type=int, default=10000, help="Number of synthetic documents (default 10000)")
+    parser.add_argument("--words", type=int, default=300, help="Average number of words per document (default 300)")
+    parser.add_argument("--cuis", type=int, default=20000, help="Number of CUIs in the vocabulary (default 20000)")
+    parser.add_argument("--variants", type=int, default=500,
+                        help="Spelling variants of the most common CUI (default 500)")
+    parser.add_argument("--skew", type=float, default=1.1, help="Zipf exponent of CUI frequencies (default 1.1)")
+    parser.add_argument("--concepts", type=int, default=1000,
+                        help="Number of concepts of interest for phrase dictionaries (default 1000)")
+    parser.add_argument("--batch-size", type=int, default=32, help="Annotation batch size (default 32)")
+    parser.add_argument("--chunk-size", type=int, default=1000, help="CSV rows to read at a time (default 1000)")
+    parser.add_argument("--format", choices=["json", "sqlite"], default="json", help="Output format (default json)")
+    parser.add_argument("--workers", type=int, default=1, help="Number of processes to annotate with (default 1)")
+    parser.add_argument("--queue-size", type=int, default=1000,
+                        help="Documents to read ahead in a background thread (default 1000, 0 to read inline)")
+    parser.add_argument("--no-checkpoint", dest="checkpoint", action="store_false",
+                        help="Don't journal the terms, which annotate_docs.py always does so that it can --resume")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed (default 0)")
+    parser.add_argument("--work-dir", default=None, help="Directory for the temporary corpus (default system temp)")
+    parser.add_argument("--output", metavar="FILE", help="JSON file to write the results to")
+    parser.add_argument("--compare", metavar="FILE", help="JSON results of an earlier run to compare with")
+    main(parser.parse_args())
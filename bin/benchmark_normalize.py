@@ -0,0 +1,115 @@
+"""
+Benchmark of text and term normalization before annotation.
+
+Compares the chained str.replace calls applied one document at a time, as
+BatchAnnotator.fixup used to, with each replacement applied to the whole
+document column, and the per-term lowercasing, acronym and stopword
+checks with TermNormalizer. Reports MB/sec and checks that both give the
+same results.
+
+Usage:
+python bin/benchmark_normalize.py --docs 20000
+"""
+import argparse
+import copy
+import os
+import random
+import re
+import sys
+import time
+
+import pandas as pd
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+from lib.normalizer import TermNormalizer, TextNormalizer, stopwords
+from lib.synthetic_corpus import make_annotations, make_notes, make_vocabulary
+
+
+def fixup_chained(text):
+    """
+    Replace non-ASCII characters with chained str.replace calls, as
+    BatchAnnotator.fixup used to.
+    """
+    text = text.replace("\xc2\x91", "'")
+    text = text.replace("\xc2\x92", "'")
+    text = text.replace("\xc2\x93", '"')
+    text = text.replace("\xc2\x94", '"')
+    text = text.replace("\u2013", "-")
+    text = text.replace("\u201c", '"')
+    text = text.replace("\u201d", '"')
+    return text
+
+
+def normalize_terms_loop(all_terms):
+    """
+    Normalize terms one at a time, as BatchAnnotator.annotate used to,
+    discarding empty terms like TermNormalizer.
+    """
+    regex_upper = re.compile(r"^[A-Z]+$")
+    for terms in all_terms:
+        for obj in terms.values():
+            for term in obj["terms"]:
+                if not regex_upper.match(term["text"]):
+                    term["text"] = term["text"].lower()
+            obj["terms"] = [term for term in obj["terms"]
+                            if term["text"].strip() and term["text"].lower().split()[0] not in stopwords]
+
+
+def main(args):
+    vocabulary = make_vocabulary(n_cuis=args.cuis)
+
+    # Documents as read from the CSV
+    column = pd.Series(list(make_notes(n_docs=args.docs, vocabulary=vocabulary)))
+    mb = column.str.len().sum() / 1048576.0
+    print("%d documents, %.1f MB of text" % (len(column), mb))
+
+    start = time.perf_counter()
+    chained = column.astype(str).apply(lambda x: fixup_chained(x))
+    chained_time = time.perf_counter() - start
+
+    normalizer = TextNormalizer()
+    start = time.perf_counter()
+    translated = normalizer.normalize_series(column)
+    translated_time = time.perf_counter() - start
+
+    print("Text, chained replace:     %8.1f MB/sec" % (mb / chained_time))
+    print("Text, column replace:      %8.1f MB/sec (%.1fx)" % (mb / translated_time, chained_time / translated_time))
+
+    # Terms as returned by ScispaCy, with some capitalized and negated
+    rng = random.Random(0)
+    all_terms = list(make_annotations(n_docs=args.docs, vocabulary=vocabulary))
+    for terms in all_terms:
+        for obj in terms.values():
+            for term in obj["terms"]:
+                r = rng.random()
+                if r < 0.3:
+                    term["text"] = term["text"].capitalize()
+                elif r < 0.35:
+                    term["text"] = rng.choice(stopwords) + " " + term["text"]
+    looped = copy.deepcopy(all_terms)
+    term_mb = sum(len(term["text"]) for terms in all_terms for obj in terms.values()
+                  for term in obj["terms"]) / 1048576.0
+
+    start = time.perf_counter()
+    normalize_terms_loop(looped)
+    loop_time = time.perf_counter() - start
+
+    term_normalizer = TermNormalizer(stopwords)
+    start = time.perf_counter()
+    for terms in all_terms:
+        term_normalizer.normalize_terms(terms)
+    normalizer_time = time.perf_counter() - start
+
+    print("Terms, per-term checks:    %8.1f MB/sec" % (term_mb / loop_time))
+    print("Terms, TermNormalizer:     %8.1f MB/sec (%.1fx)" % (term_mb / normalizer_time, loop_time / normalizer_time))
+
+    if not chained.equals(translated) or looped != all_terms:
+        print("ERROR: results differ")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark text and term normalization on synthetic notes.")
+    parser.add_argument("--docs", type=int, default=20000, help="Number of synthetic documents (default 20000)")
+    parser.add_argument("--cuis", type=int, default=5000, help="Number of CUIs in the vocabulary (default 5000)")
+    main(parser.parse_args())
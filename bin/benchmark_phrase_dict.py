@@ -0,0 +1,93 @@
+"""
+Benchmark of phrase dictionary construction for the termset generator UI.
+
+Compares the original nested loops of make_phrase_dict with the vectorized
+concept index on a synthetic corpus, across many concepts and confidence
+values, and checks that both give the same phrase dictionaries.
+
+Usage:
+python bin/benchmark_phrase_dict.py --concepts 5000
+"""
+import argparse
+from collections import defaultdict
+import os
+import random
+import sys
+import time
+
+import pandas as pd
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+import streamlit_functions as sf
+from lib.synthetic_corpus import make_annotations, make_vocabulary
+from lib.term_accumulator import TermAccumulator
+
+
+def make_phrase_dict_loop(corpus, concept_df, concept_list, confidence=0.0):
+    """
+    Make a phrase dictionary with nested loops, as make_phrase_dict used to.
+    """
+    selected_concept_df = concept_df[concept_df["concept"].isin(concept_list)]
+
+    phrase_dict = dict()
+    for concept_name in selected_concept_df["concept"].unique():
+        counts = defaultdict(int)
+        for term in selected_concept_df[selected_concept_df["concept"] == concept_name]["cui"]:
+            if term in corpus:
+                for spelling in corpus[term]["terms"]:
+                    if spelling["score"] >= confidence:
+                        counts[spelling["text"]] = spelling["count"]
+            phrase_dict[concept_name] = counts
+
+    return phrase_dict
+
+
+def main(args):
+    rng = random.Random(0)
+
+    # Synthetic corpus as written by annotate_docs.py
+    vocabulary = make_vocabulary(n_cuis=args.cuis, max_variants=args.variants)
+    accumulator = TermAccumulator()
+    for terms in make_annotations(n_docs=args.docs, vocabulary=vocabulary):
+        accumulator.add_terms(terms)
+    corpus = accumulator.to_dict()
+
+    # Concepts of interest, each with a few CUIs
+    cuis = [concept[0] for concept in vocabulary]
+    rows = [("Concept %d" % i, cui) for i in range(args.concepts) for cui in rng.sample(cuis, rng.randint(1, 5))]
+    concept_df = pd.DataFrame(rows, columns=["concept", "cui"])
+    concept_list = list(concept_df["concept"].unique())
+    print("%d CUIs in corpus, %d concepts with %d CUIs" % (len(corpus), len(concept_list), len(concept_df)))
+
+    confidences = [0.7, 0.8, 0.9, 0.95]
+
+    start = time.perf_counter()
+    loop_results = [make_phrase_dict_loop(corpus, concept_df, concept_list, c) for c in confidences]
+    loop_time = (time.perf_counter() - start) / len(confidences)
+
+    start = time.perf_counter()
+    index = sf.build_concept_index(corpus, concept_df)
+    index_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    index_results = [sf.make_phrase_dict_from_index(index, concept_list, c) for c in confidences]
+    query_time = (time.perf_counter() - start) / len(confidences)
+
+    print("Nested loops:      %8.3f sec per phrase dict" % loop_time)
+    print("Vectorized index:  %8.3f sec to build, %.3f sec per phrase dict" % (index_time, query_time))
+    print("Speedup: %.1fx per phrase dict, %.1fx including the index" % (
+        loop_time / query_time, loop_time / (index_time + query_time)))
+
+    if loop_results != index_results:
+        print("ERROR: results differ")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark phrase dictionaries on a synthetic corpus.")
+    parser.add_argument("--concepts", type=int, default=5000, help="Number of concepts of interest (default 5000)")
+    parser.add_argument("--cuis", type=int, default=20000, help="Number of CUIs in the corpus (default 20000)")
+    parser.add_argument("--variants", type=int, default=500,
+                        help="Spelling variants of the most common CUI (default 500)")
+    parser.add_argument("--docs", type=int, default=20000, help="Number of synthetic documents (default 20000)")
+    main(parser.parse_args())
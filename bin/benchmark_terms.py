@@ -0,0 +1,98 @@
+"""
+Micro-benchmark of term aggregation in BatchAnnotator.
+
+Compares the original linear scan over each concept's terms with the
+hash-indexed TermAccumulator on a synthetic corpus with skewed CUI
+frequencies, and checks that both give the same terms.
+
+Usage:
+python bin/benchmark_terms.py --docs 20000 --variants 5000
+"""
+import argparse
+import copy
+import os
+import sys
+import time
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+from lib.synthetic_corpus import make_annotations, make_vocabulary
+from lib.term_accumulator import TermAccumulator
+
+
+def aggregate_linear(results):
+    """
+    Aggregate terms with a linear scan per CUID, as BatchAnnotator used to.
+    """
+    all_terms = dict()
+    for terms in results:
+        for cuid, obj in terms.items():
+            if cuid not in all_terms:
+                all_terms[cuid] = {"name": obj["name"], "terms": list()}
+
+            for term in obj["terms"]:
+                add = True
+                for existing in all_terms[cuid]["terms"]:
+                    if existing["text"] == term["text"]:
+                        existing["count"] += term["count"]
+                        add = False
+                        break
+                    elif existing["text"] == term["text"].lower():
+                        existing["count"] += term["count"]
+                        add = False
+                        break
+                    elif existing["text"].lower() == term["text"]:
+                        existing["count"] += term["count"]
+                        existing["text"] = existing["text"].lower()
+                        add = False
+                        break
+                if add:
+                    all_terms[cuid]["terms"].append(term)
+
+    return all_terms
+
+
+def aggregate_indexed(results):
+    """
+    Aggregate terms with TermAccumulator.
+    """
+    accumulator = TermAccumulator()
+    for terms in results:
+        for cuid, obj in terms.items():
+            accumulator.add_concept(cuid, obj["name"])
+            for term in obj["terms"]:
+                accumulator.add_term(cuid, term)
+
+    return accumulator.to_dict()
+
+
+def main(args):
+    vocabulary = make_vocabulary(n_cuis=args.cuis, max_variants=args.variants, skew=args.skew)
+    results = list(make_annotations(n_docs=args.docs, terms_per_doc=args.terms, vocabulary=vocabulary))
+    n_terms = sum(len(obj["terms"]) for terms in results for obj in terms.values())
+    print("%d docs, %d terms, %d CUIs, up to %d variants per CUI" % (args.docs, n_terms, args.cuis, args.variants))
+
+    timings = dict()
+    outputs = dict()
+    for name, aggregate in (("linear", aggregate_linear), ("indexed", aggregate_indexed)):
+        # Each run gets its own copy since aggregation updates the term dicts
+        docs = copy.deepcopy(results)
+        start = time.perf_counter()
+        outputs[name] = aggregate(docs)
+        timings[name] = time.perf_counter() - start
+        print("%-8s %8.3f sec %10.0f terms/sec" % (name, timings[name], n_terms / timings[name]))
+
+    print("Speedup: %.1fx" % (timings["linear"] / timings["indexed"]))
+    if outputs["linear"] != outputs["indexed"]:
+        print("ERROR: results differ")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark term aggregation on a synthetic corpus.")
+    parser.add_argument("--docs", type=int, default=10000, help="Number of documents (default 10000)")
+    parser.add_argument("--terms", type=int, default=20, help="Average terms per document (default 20)")
+    parser.add_argument("--cuis", type=int, default=1000, help="Number of concepts (default 1000)")
+    parser.add_argument("--variants", type=int, default=2000,
+                        help="Spelling variants of the most common concept (default 2000)")
+    parser.add_argument("--skew", type=float, default=1.1, help="Zipf exponent of CUI frequencies (default 1.1)")
+    main(parser.parse_args())
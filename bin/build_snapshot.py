@@ -0,0 +1,81 @@
+"""
+Save ScispaCy and its linkers as a snapshot that loads in seconds.
+
+Loading the UMLS linker builds its knowledge base from scratch, which takes
+minutes on every start of annotate_docs.py or annotation_server.py. This
+loads ScispaCy once and saves it to a directory that they can load with
+--snapshot (or the TERMSET_SNAPSHOT environment variable) instead. Build the
+snapshot again after upgrading spaCy, scispacy or scikit-learn.
+
+With --compare, the time to start an annotator in a new process is measured
+with and without the snapshot.
+
+Usage:
+python bin/build_snapshot.py snapshot
+python bin/build_snapshot.py snapshot --linkers umls,rxnorm --compare
+"""
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import time
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+from lib.snapshot import save_snapshot
+
+# Starts an annotator in a new process
+_start_annotator = """
+import sys
+sys.path.append(%r)
+from lib.scispacy_annotator import SciSpacyAnnotator
+SciSpacyAnnotator(linker=%r, model=%r, snapshot=%r)
+"""
+
+
+def cold_start(linkers, model, snapshot):
+    """
+    Time how long a new process takes to import and load an annotator.
+
+    Returns
+    -------
+    Seconds
+    """
+    code = _start_annotator % (os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."), linkers, model,
+                               snapshot)
+    start = time.time()
+    subprocess.run([sys.executable, "-c", code], check=True, stdout=subprocess.DEVNULL)
+    return time.time() - start
+
+
+def main(args):
+    linkers = args.linkers.split(",")
+    if os.path.exists(args.directory):
+        if not args.force:
+            sys.exit("%s already exists. Use --force to replace it." % args.directory)
+        shutil.rmtree(args.directory)
+
+    start = time.time()
+    save_snapshot(args.directory, model=args.model, linkers=linkers)
+    print("Saved snapshot to %s in %.1f sec" % (args.directory, time.time() - start))
+
+    if args.compare:
+        print("Measuring cold starts...")
+        without = cold_start(linkers, args.model, None)
+        with_snapshot = cold_start(linkers, args.model, args.directory)
+        print("Without snapshot: %.1f sec" % without)
+        print("From snapshot:    %.1f sec (%.1fx faster)" % (with_snapshot, without / max(with_snapshot, 1e-9)))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Save ScispaCy and its linkers as a snapshot that loads fast.")
+    parser.add_argument("directory", help="Directory to write the snapshot to")
+    parser.add_argument("--model", default="en_core_sci_sm",
+                        help="ScispaCy model to save (default en_core_sci_sm)")
+    parser.add_argument("--linkers", default="umls",
+                        help="Comma separated thesauri to save linkers for: umls, mesh, rxnorm, go, hpo "
+                             "(default umls)")
+    parser.add_argument("--force", action="store_true", help="Replace the directory if it exists")
+    parser.add_argument("--compare", action="store_true",
+                        help="Measure how long an annotator takes to start with and without the snapshot")
+    main(parser.parse_args())
@@ -0,0 +1,178 @@
+"""
+Find the terms of saved termsets in a CSV of medical documents.
+
+The termsets (JSON files saved by termset_generator.py) are compiled into
+one automaton that finds all of their terms in a single pass over each
+document, without running ScispaCy. The CSV is read a chunk of rows at a
+time, so memory use doesn't grow with its size.
+
+Two CSV files are written:
+- hits: for each document, the concepts and terms found in it and how many
+  times each was found
+- counts: for each concept and term, the number of documents it was found in
+  and the total number of times it was found
+
+Usage:
+python bin/match_termsets.py my_csv_file.csv "Reviewed Termsets/Headache termset_reviewed.json" ...
+"""
+import argparse
+from collections import deque
+import csv
+import multiprocessing
+import os
+import sys
+import time
+
+import pandas as pd
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+from lib.normalizer import TextNormalizer
+from lib.termset_matcher import TermsetMatcher, load_termsets
+
+# Matcher used by a worker process
+_matcher = None
+
+
+def _init_worker(matcher):
+    """
+    Set up the matcher of a worker process.
+    """
+    global _matcher
+    _matcher = matcher
+
+
+def _count_chunk(texts):
+    """
+    Count the terms in a chunk of documents in a worker process.
+    """
+    return [_matcher.count(text) for text in texts]
+
+
+def read_chunks(args):
+    """
+    Generator of the row numbers, ids and normalized texts of the documents
+    in the CSV, a chunk at a time.
+    """
+    text_normalizer = TextNormalizer()
+    columns = [args.text_column] + ([args.id_column] if args.id_column else [])
+    try:
+        reader = pd.read_csv(args.csv_filename, encoding=args.encoding, usecols=columns,
+                             chunksize=args.chunk_size, nrows=args.max_docs)
+        with reader:
+            for df in reader:
+                ids = df[args.id_column].tolist() if args.id_column else None
+                yield df.index.tolist(), ids, list(text_normalizer.normalize_series(df[args.text_column]))
+    except UnicodeDecodeError:
+        raise RuntimeError("File encoding does not appear to be %s - specify a different encoding." % args.encoding)
+
+
+def count_chunks(matcher, chunks, workers):
+    """
+    Generator of the chunks of documents with the term counts of each
+    document, in CSV order.
+    """
+    if workers <= 1:
+        for rows, ids, texts in chunks:
+            yield rows, ids, [matcher.count(text) for text in texts]
+        return
+
+    pending = deque()
+    with multiprocessing.Pool(workers, initializer=_init_worker, initargs=(matcher,)) as pool:
+        for rows, ids, texts in chunks:
+            pending.append((rows, ids, pool.apply_async(_count_chunk, (texts,))))
+
+            # Only read a few chunks ahead of the workers
+            if len(pending) > 2 * workers:
+                rows, ids, result = pending.popleft()
+                yield rows, ids, result.get()
+
+        while pending:
+            rows, ids, result = pending.popleft()
+            yield rows, ids, result.get()
+
+
+def main(args):
+    termsets = load_termsets(args.termsets, encoding=args.termset_encoding)
+    matcher = TermsetMatcher(termsets, case_sensitive=args.case_sensitive)
+    print("Compiled %d terms of %d concepts" % (len(matcher), len(termsets)))
+
+    name = os.path.splitext(args.csv_filename)[0]
+    hits_filename = args.hits or name + ".hits.csv"
+    counts_filename = args.counts or name + ".counts.csv"
+
+    # Number of documents each term is found in and times it is found
+    term_docs = dict.fromkeys(matcher.terms, 0)
+    term_counts = dict.fromkeys(matcher.terms, 0)
+    concept_docs = dict.fromkeys(termsets, 0)
+
+    start = time.time()
+    next_progress = start + 10
+    n_docs = 0
+    n_matched = 0
+    with open(hits_filename, "w", newline="", encoding="utf-8") as f:
+        writer = csv.writer(f)
+        writer.writerow(["row"] + (["id"] if args.id_column else []) + ["concept", "term", "count"])
+
+        for rows, ids, counts in count_chunks(matcher, read_chunks(args), args.workers):
+            for i, doc_counts in enumerate(counts):
+                n_docs += 1
+                if not doc_counts:
+                    continue
+                n_matched += 1
+
+                prefix = [rows[i]] + ([ids[i]] if ids else [])
+                concepts = set()
+                for term, n in doc_counts.items():
+                    term_docs[term] += 1
+                    term_counts[term] += n
+                    for concept in matcher.concepts[term]:
+                        concepts.add(concept)
+                        writer.writerow(prefix + [concept, term, n])
+
+                for concept in concepts:
+                    concept_docs[concept] += 1
+
+            if time.time() >= next_progress:
+                next_progress = time.time() + 10
+                print("Searched %d docs (%.0f docs/sec)" % (n_docs, n_docs / max(time.time() - start, 1e-9)))
+
+    with open(counts_filename, "w", newline="", encoding="utf-8") as f:
+        writer = csv.writer(f)
+        writer.writerow(["concept", "term", "docs", "count"])
+        for concept in termsets:
+            terms = [term for term in matcher.terms if concept in matcher.concepts[term]]
+            for term in sorted(terms, key=lambda term: (-term_counts[term], term)):
+                writer.writerow([concept, term, term_docs[term], term_counts[term]])
+
+    print("Found terms in %d of %d docs" % (n_matched, n_docs))
+    for concept, n in concept_docs.items():
+        print("  %s: %d docs" % (concept, n))
+    print("Wrote", hits_filename, "and", counts_filename)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Find the terms of saved termsets in a CSV of medical documents.")
+    parser.add_argument("csv_filename", help="CSV file (.csv) to search")
+    parser.add_argument("termsets", nargs="+", help="Saved termset JSON files")
+    parser.add_argument("--hits", metavar="FILE",
+                        help="CSV file of the terms found in each document (default <csv_filename>.hits.csv)")
+    parser.add_argument("--counts", metavar="FILE",
+                        help="CSV file of the documents and times each term is found "
+                             "(default <csv_filename>.counts.csv)")
+    parser.add_argument("--case-sensitive", action="store_true",
+                        help="Match only terms with the same case")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Number of processes to search with (default 1)")
+    parser.add_argument("--encoding", default="utf-8",
+                        help="Encoding of the CSV file (default utf-8)")
+    parser.add_argument("--termset-encoding", default="utf-8",
+                        help="Encoding of the termset files (default utf-8)")
+    parser.add_argument("--text-column", default="TEXT",
+                        help="Name of the column that contains the medical text (default TEXT)")
+    parser.add_argument("--id-column", default=None,
+                        help="Optional column that identifies each document, such as ROW_ID, to add to the hits")
+    parser.add_argument("--max-docs", type=int, default=None,
+                        help="Optional max number of documents to search")
+    parser.add_argument("--chunk-size", type=int, default=1000,
+                        help="Number of CSV rows to read at a time (default 1000)")
+    main(parser.parse_args())
@@ -0,0 +1,64 @@
+"""
+Merge the outputs of annotate_docs.py runs into one output.
+
+Use this to combine the shards of a CSV annotated on several machines with
+--shard or --rows. Spellings of each concept are merged the same way as
+when annotating, case insensitive and favoring lowercase, and their counts
+are added up. Merging the shards of a CSV in order gives the same output as
+annotating the whole CSV on one machine.
+
+The inputs are read one concept at a time, so memory use grows with the
+merged output rather than with the number of inputs. With --memory-budget,
+the merged terms are written to sorted files on disk beyond that budget and
+merged again when writing the output.
+
+Usage:
+python bin/merge_outputs.py --output my_csv_file.json my_csv_file.shard1of4.json my_csv_file.shard2of4.json ...
+"""
+import argparse
+import os
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+from lib.memory_usage import memory_usage
+from lib.term_accumulator import TermAccumulator
+from lib.term_store import iter_terms, save_terms, sqlite_extensions
+
+
+def main(args):
+    memory_budget = int(args.memory_budget * 1024 * 1024) if args.memory_budget else None
+    accumulator = TermAccumulator(memory_budget=memory_budget,
+                                  spill_dir=os.path.dirname(os.path.abspath(args.output)))
+    for filename in args.inputs:
+        n = 0
+        for cuid, obj in iter_terms(filename, encoding=args.encoding):
+            accumulator.add_concept(cuid, obj["name"])
+            for term in obj["terms"]:
+                accumulator.add_term(cuid, term)
+            n += 1
+        print("Merged %d concepts from %s" % (n, filename))
+
+    save_terms(accumulator.items(), args.output, encoding=args.encoding)
+    print("Wrote %d concepts to %s" % (len(accumulator), args.output))
+    peak = memory_usage().get("peak_rss")
+    if peak is not None:
+        print("Peak memory: %.0f MB" % (peak / 1048576.0))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Merge annotate_docs.py output files.")
+    parser.add_argument("inputs", nargs="+", help="Output files (.json or .sqlite) to merge, in order")
+    parser.add_argument("--output", required=True, help="Merged output file (.json or .sqlite)")
+    parser.add_argument("--encoding", default="utf-8", help="Encoding of JSON files (default utf-8)")
+    parser.add_argument("--memory-budget", type=float, default=None, metavar="MB",
+                        help="Approximate memory for the merged terms, beyond which they are written to disk "
+                             "(default no limit)")
+    args = parser.parse_args()
+
+    if os.path.abspath(args.output) in [os.path.abspath(filename) for filename in args.inputs]:
+        parser.error("The output file can't be one of the inputs")
+    for filename in [args.output] + args.inputs:
+        if not filename.lower().endswith((".json",) + sqlite_extensions):
+            parser.error("%s is not a .json or .sqlite file" % filename)
+
+    main(args)
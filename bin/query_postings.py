@@ -0,0 +1,70 @@
+"""
+Query the postings written by annotate_docs.py --postings: the number of
+documents concepts and their terms were found in, the concepts found most
+often in the same documents, and sample documents to read.
+
+Usage:
+python bin/query_postings.py my_csv_file.postings.npz
+python bin/query_postings.py my_csv_file.postings.npz "yourCUIofInterest1" "yourCUIofInterest2"
+"""
+import argparse
+import os
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+from lib.postings import Postings
+
+
+def show_concept(postings, cuid, args):
+    """
+    Print the document frequency, terms, co-occurring concepts and sample
+    documents of a concept.
+    """
+    if cuid not in postings:
+        print("%s was not found" % cuid)
+        print("")
+        return
+
+    print("%s %s: %d docs" % (cuid, postings.name(cuid), postings.doc_frequency(cuid)))
+
+    if args.term:
+        print("  \"%s\": %d docs" % (args.term, postings.doc_frequency(cuid, args.term)))
+    else:
+        print("  Terms:")
+        for text, n in list(postings.term_frequencies(cuid).items())[:args.top]:
+            print("    %s: %d docs" % (text, n))
+
+    print("  Found with:")
+    for other, n in postings.cooccurring(cuid, args.top):
+        print("    %s %s: %d docs" % (other, postings.name(other), n))
+
+    rows = postings.sample_docs(cuid, args.samples, text=args.term, seed=args.seed)
+    print("  Sample rows: %s" % ", ".join(str(row) for row in rows))
+    print("")
+
+
+def main(args):
+    postings = Postings(args.postings)
+    print("%d docs, %d concepts" % (len(postings), len(postings.cuis)))
+    print("")
+
+    if args.cuids:
+        for cuid in args.cuids:
+            show_concept(postings, cuid, args)
+    else:
+        # Show the concepts found in the most documents
+        for cuid, n in list(postings.doc_frequencies().items())[:args.top]:
+            print("%s %s: %d docs" % (cuid, postings.name(cuid), n))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Query the documents concepts were found in.")
+    parser.add_argument("postings", help="Postings file (.postings.npz) written by annotate_docs.py --postings")
+    parser.add_argument("cuids", nargs="*", help="CUIs to show (default the most frequent)")
+    parser.add_argument("--term", help="Show only the documents with this term of the CUIs")
+    parser.add_argument("--top", type=int, default=10,
+                        help="Number of concepts and terms to show (default 10)")
+    parser.add_argument("--samples", type=int, default=10,
+                        help="Number of sample documents to show (default 10)")
+    parser.add_argument("--seed", type=int, default=None, help="Random seed for the sample documents")
+    main(parser.parse_args())
@@ -1,21 +1,25 @@
 """
-Show the concepts found by annotate_docs.py and stored in a JSON file.
+Show the concepts found by annotate_docs.py and stored in a JSON or SQLite file.
 """
-import json
+import os
 import sys
 
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+from lib.term_store import load_terms, sqlite_extensions
+
 
 def main():
-    json_filename = sys.argv[1]
-    with open(json_filename, "r") as f:
-        js = json.load(f)
+    filename = sys.argv[1]
 
     # If no CUIDs provided show all
     if len(sys.argv) == 2:
+        js = load_terms(filename)
         for cuid, terms in sorted(js.items(), key=lambda x: len(x[1]["terms"]), reverse=False):
             print("%s %s [%s]" % (cuid, js[cuid]["name"], ", ".join(t["text"] for t in js[cuid]["terms"])))
             print("")
     else:
+        # Only read the requested CUIDs
+        js = load_terms(filename, cuids=sys.argv[2:])
         for cuid in sys.argv[2:]:
             if cuid in js:
                 print("%s %s [%s]" % (cuid, js[cuid]["name"], ", ".join(t["text"] for t in js[cuid]["terms"])))
@@ -23,7 +27,7 @@ def main():
 
 
 if __name__ == "__main__":
-    if len(sys.argv) < 2 or not sys.argv[1].endswith(".json"):
-        print("Specify an annotate_docs.py JSON output file (.json) to process")
+    if len(sys.argv) < 2 or not sys.argv[1].lower().endswith((".json",) + sqlite_extensions):
+        print("Specify an annotate_docs.py output file (.json or .sqlite) to process")
     else:
         main()
@@ -4,6 +4,13 @@ Functions to support termset_generator.py
 import pandas as pd
 from collections import defaultdict
 import json
+import os
+import sys
+import tempfile
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+from lib.score_histogram import count_at_least
+from lib.term_store import read_sqlite, sqlite_extensions
 
 
 def load_concept_csv(concepts_file):
@@ -39,6 +46,135 @@ def load_saved_json(concepts_file):
     return df
 
 
+def load_corpus(corpus_file, cuids=None):
+    """
+    Read an annotated corpus file uploaded in the UI, as JSON or SQLite.
+
+    Parameters
+    ----------
+    corpus_file: UploadedFile
+        JSON or SQLite file generated from the annotate_docs.py script
+    cuids: list
+        Optional CUIs to read. Only these are read from SQLite files.
+
+    Returns
+    -------
+    Terms indexed by CUI, in the annotate_docs.py output format
+    """
+    if corpus_file.name.lower().endswith(sqlite_extensions):
+        # SQLite can only read from a file
+        with tempfile.NamedTemporaryFile(suffix=".sqlite", delete=False) as f:
+            f.write(corpus_file.getvalue())
+        try:
+            return read_sqlite(f.name, cuids)
+        finally:
+            os.remove(f.name)
+
+    return json.loads(corpus_file.getvalue())
+
+
+def flatten_corpus(corpus):
+    """
+    Flatten an annotated corpus into a table with one row per spelling.
+
+    Parameters
+    ----------
+    corpus: dict
+        Terms indexed by CUI, in the annotate_docs.py output format
+
+    Returns
+    -------
+    df: dataframe
+        pandas dataframe with columns ["cui", "text", "score", "count",
+        "scores", "position"], where scores is the spelling's score histogram
+        if annotated with a score floor and position is its order in the
+        corpus
+    """
+    rows = [(cui, spelling["text"], spelling["score"], spelling["count"], spelling.get("scores"))
+            for cui, obj in corpus.items() for spelling in obj["terms"]]
+    df = pd.DataFrame(rows, columns=["cui", "text", "score", "count", "scores"])
+    df["score"] = df["score"].astype(float)
+    df["position"] = range(len(df))
+
+    return df
+
+
+def build_concept_index(corpus, concept_df):
+    """
+    Index the spelling variations of every concept in the concept file, so
+    that phrase dictionaries can be made for any selection of concepts and
+    confidence without going back to the corpus.
+
+    Parameters
+    ----------
+    corpus: dict
+        Terms indexed by CUI, in the annotate_docs.py output format
+    concept_df: dataframe
+        pandas dataframe with 2 columns: ["concept", "cui"]
+
+    Returns
+    -------
+    index: dataframe
+        pandas dataframe with columns ["concept", "text", "score", "count",
+        "scores"] and a row for each spelling of each concept's CUIs, in
+        concept file and then corpus order. Concepts with no spellings have
+        one row with no text or score.
+    """
+    concepts = concept_df[["concept", "cui"]].reset_index(drop=True)
+    concepts["row"] = range(len(concepts))
+
+    # Concepts in the order they first appear in the concept file
+    concept_order = {concept_name: i for i, concept_name in enumerate(concepts["concept"].unique())}
+    concepts["concept_order"] = concepts["concept"].map(concept_order)
+
+    index = concepts.merge(flatten_corpus(corpus), on="cui", how="left")
+    index = index.sort_values(["concept_order", "row", "position"], kind="mergesort")
+
+    return index[["concept", "text", "score", "count", "scores"]].reset_index(drop=True)
+
+
+def make_phrase_dict_from_index(index, concept_list, confidence=0.0):
+    """
+    Create a dictionary of qualified spelling variations for each concept of
+    interest from an index made by build_concept_index.
+
+    Parameters
+    ----------
+    index: dataframe
+        concept index from build_concept_index
+    concept_list: list
+        concepts of interest, defined in sidebar widget
+    confidence: float
+        minimum confidence score to include spelling variation
+
+    Returns
+    -------
+    phrase_dict: dict
+        the same dictionary as make_phrase_dict
+    """
+    selected = index[index["concept"].isin(concept_list)]
+    phrase_dict = {concept_name: defaultdict(int) for concept_name in selected["concept"].unique()}
+
+    # Spellings that meet min confidence. When a spelling is found for more
+    # than one of a concept's CUIs, keep the count of the last one.
+    meets = selected["score"] >= confidence
+    has_scores = selected["scores"].notna()
+    if has_scores.any():
+        # Spellings annotated with a score floor count the times found with
+        # at least min confidence, from their score histograms
+        counts = selected["count"].where(meets, 0)
+        counts[has_scores] = [count_at_least(scores, confidence) for scores in selected.loc[has_scores, "scores"]]
+        selected = selected.assign(count=counts)
+        meets = counts > 0
+    qualified = selected[meets]
+    counts = qualified.groupby(["concept", "text"], sort=False)["count"].last()
+
+    for (concept_name, text), count in zip(counts.index, counts.tolist()):
+        phrase_dict[concept_name][text] = int(count)
+
+    return phrase_dict
+
+
 def make_phrase_dict(jsonfile, concept_df, concept_list, confidence=0.0):
     """
     Create a dictionary of qualified spelling variations for each concept of interest.
@@ -46,8 +182,8 @@ def make_phrase_dict(jsonfile, concept_df, concept_list, confidence=0.0):
     Parameters
     ----------
     jsonfile: JSON
-        JSON file of annotated clinical notes generated from the 
-        annotate_docs.py script 
+        JSON or SQLite file of annotated clinical notes generated from the
+        annotate_docs.py script
     concept_df: dataframe
         pandas dataframe with 2 columns: ["concept", "cui"]
     concept_list: list
@@ -65,22 +201,12 @@ def make_phrase_dict(jsonfile, concept_df, concept_list, confidence=0.0):
         {"concept_name1": defaultdict(int, {"spelling1": count1,
                                             "spelling2": count2})}
     """
-    jsonfile = json.loads(jsonfile.getvalue())
-
     # Get concepts of interest after user added/removed from side bar
     selected_concept_df = concept_df[concept_df["concept"].isin(concept_list)]
 
-    phrase_dict = dict()
+    # Only read the concepts of interest
+    jsonfile = load_corpus(jsonfile, cuids=list(selected_concept_df["cui"].unique()))
 
-    # Iterate through concept, term, then spelling variation
-    for concept_name in selected_concept_df["concept"].unique():
-        counts = defaultdict(int)
-        for term in selected_concept_df[selected_concept_df["concept"] == concept_name]["cui"]:
-            if term in jsonfile:
-                for spelling in jsonfile[term]["terms"]:
-                    # Collect spelling and count for spellings that meets min confidence
-                    if spelling["score"] >= confidence:
-                        counts[spelling["text"]] = spelling["count"]
-            phrase_dict[concept_name] = counts
+    index = build_concept_index(jsonfile, selected_concept_df)
 
-    return phrase_dict
+    return make_phrase_dict_from_index(index, concept_list, confidence)
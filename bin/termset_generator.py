@@ -8,6 +8,7 @@ for a given "concept of interest", or medical term.
 Usage:
 streamlit run termset_generator.py
 """
+import hashlib
 import json
 import os
 
@@ -16,21 +17,50 @@ import streamlit as st
 import streamlit_functions as sf
 
 
-def load_concept_file(concept_file):
+def file_hash(uploaded_file, uploader):
     """
-    Read in the concept file as either a CSV or JSON.
+    Get a hash of an uploaded file's content, computed once per upload. Only
+    the hash of the current upload of each uploader is kept.
     """
-    if concept_file.name.lower().endswith(".csv"):
-        return sf.load_concept_csv(concept_file)
-    elif concept_file.name.lower().endswith(".json"):
-        return sf.load_concept_json(concept_file)
+    key = "file_hash:" + uploader
+    upload = (uploaded_file.name, getattr(uploaded_file, "file_id", ""), uploaded_file.size)
+    saved = st.session_state.get(key)
+    if saved is None or saved[0] != upload:
+        saved = st.session_state[key] = (upload, hashlib.sha256(uploaded_file.getvalue()).hexdigest())
+
+    return saved[1]
+
+
+@st.cache_data(max_entries=8, show_spinner=False)
+def load_concept_file(content_hash, _concept_file):
+    """
+    Read in the concept file as either a CSV or JSON. Cached by the hash of
+    its content, so the file is only parsed again when it changes.
+    """
+    if _concept_file.name.lower().endswith(".csv"):
+        return sf.load_concept_csv(_concept_file)
+    elif _concept_file.name.lower().endswith(".json"):
+        return sf.load_concept_json(_concept_file)
     else:
         # Should never get here
         st.info(
-            'Unsupported filename "%s".' % concept_file.name)
+            'Unsupported filename "%s".' % _concept_file.name)
         return None
 
 
+@st.cache_resource(max_entries=4, show_spinner=False)
+def load_concept_index(corpus_hash, concept_hash, _corpus_file, _concept_df):
+    """
+    Read the annotated corpus and index the spellings of every concept in the
+    concept file. Cached by the hashes of both files, so changing the
+    confidence or the selected concepts only filters the index in memory.
+    The index is shared between reruns and must not be modified.
+    """
+    corpus = sf.load_corpus(_corpus_file, cuids=list(_concept_df["cui"].unique()))
+
+    return sf.build_concept_index(corpus, _concept_df)
+
+
 def save_termset(concept, terms, filename):
     """
     Save the termset as a JSON if filepath exists. 
@@ -141,7 +171,7 @@ def generate_mode():
     Run Generate mode functionality. 
     """
     # Controls to get the corpus, confidence, and concepts for search
-    corpus_file = st.sidebar.file_uploader("Annotated file", type="json")
+    corpus_file = st.sidebar.file_uploader("Annotated file", type=["json", "sqlite", "db"])
     confidence = st.sidebar.slider("Confidence", min_value=0.0, value=0.9)
     file_types = ["csv", "json"]
     concept_file = st.sidebar.file_uploader("Concept file", type=file_types)
@@ -152,7 +182,7 @@ def generate_mode():
     # If a concept file is uploaded, load it into a DataFrame
     concept_df = None
     if concept_file:
-        concept_df = load_concept_file(concept_file)
+        concept_df = load_concept_file(file_hash(concept_file, "concept"), concept_file)
 
     # If we have both the corpus and concepts, get the phrases that are found
     phrase_dict = dict()
@@ -161,7 +191,9 @@ def generate_mode():
             try:
                 concepts = list(concept_df["concept"].unique())
                 concept_list = st.sidebar.multiselect("Concepts", concepts, default=concepts)
-                phrase_dict = sf.make_phrase_dict(corpus_file, concept_df, concept_list, confidence)
+                index = load_concept_index(file_hash(corpus_file, "corpus"), file_hash(concept_file, "concept"),
+                                           corpus_file, concept_df)
+                phrase_dict = sf.make_phrase_dict_from_index(index, concept_list, confidence)
             except ValueError:
                 st.subheader("Annotated file does not contain any of the concepts of interest.")
     
@@ -0,0 +1,170 @@
+"""
+Class to cache ScispaCy annotations on disk.
+
+The AnnotationCache class stores the terms found in each document in an
+SQLite database, keyed by a hash of the document text and the annotator
+settings. Duplicate and templated notes, and documents annotated by an
+earlier run with the same settings, are then served from the cache without
+running ScispaCy. The least recently used entries are evicted when the cache
+grows past its size limit.
+"""
+import hashlib
+import json
+import sqlite3
+
+
+class AnnotationCache:
+    """
+    SQLite cache of annotated documents.
+    """
+    def __init__(self, filename, max_bytes=1 << 30, commit_every=100):
+        """
+        Constructor.
+
+        Parameters
+        ----------
+        filename (str)
+            SQLite database file, created if needed
+        max_bytes (int)
+            Approximate max size of the cached annotations
+        commit_every (int)
+            Number of changes to make before committing them
+        """
+        self.filename = filename
+        self.max_bytes = max_bytes
+        self.commit_every = commit_every
+        self.hits = 0
+        self.misses = 0
+
+        # Allow several annotation processes to share the cache
+        self._conn = sqlite3.connect(filename, timeout=60)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS annotations "
+            "(key TEXT PRIMARY KEY, terms TEXT, size INTEGER, used INTEGER)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS annotations_used ON annotations (used)")
+        self._conn.commit()
+
+        # Entries are stamped with a counter to find the least recently used
+        row = self._conn.execute("SELECT MAX(used), SUM(size) FROM annotations").fetchone()
+        self._clock = row[0] or 0
+        self._bytes = row[1] or 0
+        self._changes = 0
+
+    @staticmethod
+    def make_key(text, *settings):
+        """
+        Make a cache key from a document's text and the settings that affect
+        how it is annotated (model, linker, threshold, etc.)
+
+        Returns
+        -------
+        Hex digest of the text and settings
+        """
+        h = hashlib.sha256()
+        h.update(json.dumps(settings).encode("utf-8"))
+        h.update(b"\0")
+        h.update(text.encode("utf-8", errors="surrogatepass"))
+
+        return h.hexdigest()
+
+    def get(self, key):
+        """
+        Get the cached terms of a document.
+
+        Parameters
+        ----------
+        key (str)
+            Key from make_key
+
+        Returns
+        -------
+        Terms indexed by CUID, or None if the document isn't cached
+        """
+        row = self._conn.execute("SELECT terms FROM annotations WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self._clock += 1
+        self._conn.execute("UPDATE annotations SET used = ? WHERE key = ?", (self._clock, key))
+        self._changed()
+
+        return json.loads(row[0])
+
+    def put(self, key, terms):
+        """
+        Cache the terms of a document.
+
+        Parameters
+        ----------
+        key (str)
+            Key from make_key
+        terms (dict)
+            Terms indexed by CUID
+        """
+        value = json.dumps(terms, ensure_ascii=False)
+        self._clock += 1
+
+        # Replacing an entry frees the size of the one it replaces
+        row = self._conn.execute("SELECT size FROM annotations WHERE key = ?", (key,)).fetchone()
+        if row is not None:
+            self._bytes -= row[0]
+
+        self._conn.execute("INSERT OR REPLACE INTO annotations VALUES (?, ?, ?, ?)",
+                           (key, value, len(value), self._clock))
+        self._bytes += len(value)
+        self._changed()
+
+        if self._bytes > self.max_bytes:
+            self._evict()
+
+    def commit(self):
+        """
+        Commit any pending changes.
+        """
+        self._conn.commit()
+        self._changes = 0
+
+    def close(self):
+        """
+        Commit any pending changes and close the cache.
+        """
+        self.commit()
+        self._conn.close()
+
+    def stats(self):
+        """
+        Describe the cache hits and misses.
+        """
+        total = self.hits + self.misses
+        rate = 100.0 * self.hits / total if total else 0.0
+
+        return "Annotation cache: %d hits, %d misses (%.1f%% hit rate)" % (self.hits, self.misses, rate)
+
+    def _changed(self):
+        """
+        Internal method to commit after every commit_every changes.
+        """
+        self._changes += 1
+        if self._changes >= self.commit_every:
+            self.commit()
+
+    def _evict(self):
+        """
+        Internal method to delete the least recently used entries until the
+        cache is back under 90% of its max size.
+        """
+        # Other processes may have added entries, so get the actual size
+        self._bytes = self._conn.execute("SELECT SUM(size) FROM annotations").fetchone()[0] or 0
+
+        target = 0.9 * self.max_bytes
+        while self._bytes > target:
+            rows = self._conn.execute("SELECT key, size FROM annotations ORDER BY used LIMIT 100").fetchall()
+            if not rows:
+                break
+            self._conn.executemany("DELETE FROM annotations WHERE key = ?", [(row[0],) for row in rows])
+            self._bytes -= sum(row[1] for row in rows)
+
+        self.commit()
@@ -0,0 +1,203 @@
+"""
+Classes to keep ScispaCy loaded in a local server and annotate through it.
+
+Loading ScispaCy and the UMLS linker takes longer than annotating a small
+batch of documents. The AnnotationServer class keeps a SciSpacyAnnotator
+loaded and annotates documents sent to it over HTTP on localhost. The
+RemoteAnnotator class sends documents to that server and can be used by
+BatchAnnotator in place of a SciSpacyAnnotator, giving the same results.
+"""
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import json
+import urllib.error
+import urllib.request
+
+
+class AnnotationServer(HTTPServer):
+    """
+    HTTP server that annotates documents with an already loaded annotator.
+
+    POST /annotate with {"texts": [...], "batch_size": 32} returns
+    {"results": [...]}, one result per text as returned by
+    SciSpacyAnnotator.annotate, or {"error": "..."} with status 500 if
+    annotating fails. GET /info returns the annotator settings.
+    """
+    def __init__(self, annotator, host="127.0.0.1", port=8765):
+        """
+        Constructor.
+
+        Parameters
+        ----------
+        annotator (SciSpacyAnnotator)
+            Loaded annotator to annotate with
+        host (str)
+            Address to listen on. Only localhost by default, since the
+            documents are medical notes.
+        port (int)
+            Port to listen on
+        """
+        super().__init__((host, port), _AnnotationHandler)
+        self.annotator = annotator
+        self.verbose = True
+
+    def info(self):
+        """
+        Get the settings of the annotator.
+        """
+        return {
+            "model": self.annotator.model,
+            "linkers": list(self.annotator.linkers),
+            "threshold": self.annotator.threshold,
+        }
+
+
+class _AnnotationHandler(BaseHTTPRequestHandler):
+    """
+    Handle requests to an AnnotationServer.
+    """
+    def do_GET(self):
+        if self.path == "/info":
+            self._send_json(self.server.info())
+        else:
+            self.send_error(404)
+
+    def do_POST(self):
+        if self.path != "/annotate":
+            self.send_error(404)
+            return
+
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            request = json.loads(self.rfile.read(length).decode("utf-8"))
+            texts = request["texts"]
+            batch_size = request.get("batch_size", 32)
+        except (ValueError, KeyError):
+            self.send_error(400, "Expected JSON with a list of texts")
+            return
+
+        try:
+            results = list(self.server.annotator.annotate_many(texts, batch_size=batch_size))
+        except Exception as e:
+            # Tell the client what went wrong rather than dropping the
+            # connection
+            message = "%s: %s" % (type(e).__name__, e)
+            self.log_error("Annotation failed: %s", message)
+            self._send_json({"error": message}, status=500)
+            return
+
+        self._send_json({"results": results})
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    def _send_json(self, obj, status=200):
+        body = json.dumps(obj, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class RemoteAnnotator:
+    """
+    Annotate documents with an AnnotationServer, with the same methods as
+    SciSpacyAnnotator.
+    """
+    def __init__(self, url="http://127.0.0.1:8765", timeout=3600):
+        """
+        Constructor.
+
+        Parameters
+        ----------
+        url (str)
+            URL of the annotation server
+        timeout (float)
+            Seconds to wait for each request
+        """
+        self.url = url.rstrip("/")
+        self.timeout = timeout
+
+        # Caches are kept by the server
+        self.cache = None
+        self.mention_caches = dict()
+
+        # The pipeline runs on the server, so its stages aren't timed and
+        # long documents aren't split here
+        self.metrics = None
+        self.chunker = None
+
+        info = self._request("/info")
+        self.model = info["model"]
+        self.threshold = info["threshold"]
+        self.linkers = {name: None for name in info["linkers"]}
+
+    def annotate(self, text):
+        """
+        Annotate text and return the terms found.
+
+        Parameters
+        ----------
+        text (str)
+            Text to annotate
+
+        Returns
+        -------
+        CUIDs with their names and term spellings
+        """
+        return self._request("/annotate", {"texts": [text]})["results"][0]
+
+    def annotate_many(self, texts, batch_size=32):
+        """
+        Annotate several texts, sending them to the server in batches.
+
+        Parameters
+        ----------
+        texts (iterable of str)
+            Texts to annotate
+        batch_size (int)
+            Number of texts to send at once
+
+        Returns
+        -------
+        Generator of CUIDs with their names and term spellings, one per text
+        in the same order as the texts
+        """
+        batch = list()
+        for text in texts:
+            batch.append(text)
+            if len(batch) >= batch_size:
+                yield from self._request("/annotate", {"texts": batch, "batch_size": batch_size})["results"]
+                batch = list()
+
+        if batch:
+            yield from self._request("/annotate", {"texts": batch, "batch_size": batch_size})["results"]
+
+    def _request(self, path, obj=None):
+        """
+        Internal method to send a request to the server.
+
+        Returns
+        -------
+        Decoded JSON response
+        """
+        data = None
+        headers = dict()
+        if obj is not None:
+            data = json.dumps(obj, ensure_ascii=False).encode("utf-8")
+            headers["Content-Type"] = "application/json"
+
+        request = urllib.request.Request(self.url + path, data=data, headers=headers)
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                return json.loads(response.read().decode("utf-8"))
+        except urllib.error.HTTPError as e:
+            # The server answered with an error, such as one raised annotating
+            try:
+                message = json.loads(e.read().decode("utf-8"))["error"]
+            except (ValueError, KeyError, TypeError):
+                message = "%d %s" % (e.code, e.reason)
+            raise RuntimeError("The annotation server at %s failed: %s" % (self.url, message))
+        except OSError as e:
+            raise RuntimeError("Could not reach the annotation server at %s: %s" % (self.url, e))
@@ -6,43 +6,105 @@ from a CSV file that contains multiple documents to annotate at once. The class
 then saves the "batch" results from those documents for viewing with
 termset_generator.py.
 """
-from collections import defaultdict
-import json
-import re
+from collections import deque
+from contextlib import ExitStack
+import gc
+from itertools import islice
+import multiprocessing
+import os
+import sys
+import time
 
 import pandas as pd
 
+from lib.annotation_cache import AnnotationCache
+from lib.checkpoint import Checkpoint
+from lib.memory_usage import format_memory_usage, memory_usage
+from lib.metrics import Metrics, timed
+from lib.normalizer import TermNormalizer, TextNormalizer, stopwords
+from lib.pipeline import BackgroundStage, StageQueue, read_ahead
+from lib.postings import PostingsBuffer
 from lib.scispacy_annotator import SciSpacyAnnotator
-
-# Modifiers of terms to exclude
-stopwords = ["denied", "denies", "her", "his", "negative", "no"]
+from lib.seen_documents import SeenDocuments
+from lib.term_accumulator import TermAccumulator
+from lib.term_store import iter_terms, TermWriter
 
 
 class BatchAnnotator:
     """
     Annotate multiple documents with ScispaCy and save results.
     """
-    def __init__(self, linker="umls"):
+    def __init__(self, linker="umls", mention_cache_size=100000, annotator=None, snapshot=None,
+                 score_floor=None):
         """
         Constructor.
 
         Parameters
         ----------
-        linker (str)
-            Which ScispaCy thesaurus to load
+        linker (str or list of str)
+            Which ScispaCy thesaurus to load, or a list of them to link each
+            entity to all of them in one pass
+        mention_cache_size (int)
+            Number of distinct mentions to cache each linker's candidates for
+            (0 to not cache)
+        annotator (SciSpacyAnnotator)
+            Optional annotator that is already loaded, to use instead of
+            loading one. Worker processes can only share it where they are
+            forked.
+        snapshot (str)
+            Optional snapshot directory written by build_snapshot.py to load
+            ScispaCy from
+        score_floor (float)
+            Optional min score to keep terms down to, with a histogram of each
+            term's scores so the threshold can be chosen later
         """
-        self.annotator = SciSpacyAnnotator(linker=linker)
+        # Worker processes create their annotators with the same arguments
+        # if they can't share this one. An annotator passed in can't be
+        # made again from arguments.
+        self._annotator_args = None
+        self.annotator = annotator
+        if self.annotator is None:
+            self._annotator_args = dict(linker=linker, mention_cache_size=mention_cache_size, snapshot=snapshot,
+                                        score_floor=score_floor)
+            self.annotator = SciSpacyAnnotator(**self._annotator_args)
         self.docs = list()
-        self._terms = defaultdict(dict)
+        self.text_normalizer = TextNormalizer()
+        self.term_normalizer = TermNormalizer(stopwords)
+        self._terms = TermAccumulator()
         self.term_names = dict()
         self.verbose = True
         self.encoding = "utf-8"
+        self._checkpoint = None
+
+        # With more than one linker, save one namespaced output file
+        # instead of one per linker
+        self.combined = False
+
+        # Memory used by each worker process of the last parallel run
+        self.worker_memory = dict()
+
+        # Optional Metrics to time the pipeline stages in
+        self.metrics = None
+
+        # Optional PostingsWriter to record the docs each concept is found in
+        self.postings = None
+
+        # Optional approximate number of bytes of terms to keep in memory,
+        # beyond which they are written to disk until saved
+        self.memory_budget = None
 
-        self.regex_upper = re.compile(r"^[A-Z]+$")
+        # Number of docs to read ahead of annotating them, and of annotated
+        # docs (or shards with multiple workers) waiting to be merged and
+        # saved, each in a background thread. 0 runs every stage in turn in
+        # this thread.
+        self.queue_size = 1000
+
+        # StageQueues between the stages of the current run
+        self._queues = list()
 
     @property
     def terms(self):
-        return self._terms
+        return self._terms.to_dict()
 
     def load_csv(self, csv_filename, encoding="utf-8", text_column="TEXT"):
         """
@@ -70,8 +132,7 @@ class BatchAnnotator:
         except UnicodeDecodeError:
             raise RuntimeError("File encoding does not appear to be %s - specify a different encoding." % encoding)
 
-        df[text_column] = df[text_column].astype(str)
-        df[text_column] = df[text_column].apply(lambda x: self.fixup(x))
+        df[text_column] = self.text_normalizer.normalize_series(df[text_column])
 
         # Keep the documents
         self.docs = list(df[text_column])
@@ -81,42 +142,140 @@ class BatchAnnotator:
 
         return len(self.docs)
 
+    def stream_csv(self, csv_filename, encoding="utf-8", text_column="TEXT", max_docs=None, chunksize=1000, start=0):
+        """
+        Read a CSV with medical text for annotating a chunk of rows at a time.
+
+        Unlike load_csv, the documents aren't kept in memory. self.docs is set
+        to a generator that reads and cleans up the next chunk of rows only
+        when annotate needs them, so annotating starts right away and memory
+        use doesn't grow with the size of the file. The documents can be
+        annotated only once.
+
+        Parameters
+        ----------
+        csv_filename: str
+            Path to the CSV file to read
+        encoding: str
+            A valid Python file encoding (ascii, latin1, utf-8, etc.)
+        text_column: str
+            Name of the column that contains the medical text
+        max_docs: int
+            Optional max number of rows (documents) to read
+        chunksize: int
+            Number of rows to read at a time
+        start: int
+            Number of rows to skip, such as to annotate one shard of a CSV
+            on each of several machines. max_docs rows are read after these.
+
+        Returns
+        -------
+        void
+        """
+        if self.verbose:
+            print("Streaming", csv_filename)
+
+        self.docs = self._read_chunks(csv_filename, encoding, text_column, max_docs, chunksize, start)
+
+    def _read_chunks(self, csv_filename, encoding, text_column, max_docs, chunksize, start=0):
+        """
+        Internal generator of the cleaned up documents in a CSV, read a chunk
+        at a time.
+        """
+        try:
+            # Skip the rows before start (but not the header) as the file is
+            # read, rather than making them into data frames
+            reader = pd.read_csv(csv_filename, encoding=encoding, usecols=[text_column], chunksize=chunksize,
+                                 nrows=max_docs, skiprows=range(1, start + 1) if start else None)
+            with reader:
+                for df in reader:
+                    yield from self.text_normalizer.normalize_series(df[text_column])
+        except UnicodeDecodeError:
+            raise RuntimeError("File encoding does not appear to be %s - specify a different encoding." % encoding)
+
+    @staticmethod
+    def count_rows(csv_filename, encoding="utf-8", text_column="TEXT", chunksize=100000):
+        """
+        Count the documents in a CSV, such as to split it into shards.
+
+        Parameters
+        ----------
+        csv_filename: str
+            Path to the CSV file to read
+        encoding: str
+            A valid Python file encoding (ascii, latin1, utf-8, etc.)
+        text_column: str
+            Name of the column that contains the medical text
+        chunksize: int
+            Number of rows to read at a time
+
+        Returns
+        -------
+        Number of rows (documents)
+        """
+        try:
+            with pd.read_csv(csv_filename, encoding=encoding, usecols=[text_column], chunksize=chunksize) as reader:
+                return sum(len(df) for df in reader)
+        except UnicodeDecodeError:
+            raise RuntimeError("File encoding does not appear to be %s - specify a different encoding." % encoding)
+
     @staticmethod
     def fixup(text):
         """
         Cleanup text by converting common non-ASCII characters to their
         ASCII equivalents.
         """
-        
         try:
-            # These appear like \u00e2\u0092 in JSON
-            text = text.replace("\xc2\x91", "'")  # Stylized quote
-            text = text.replace("\xc2\x92", "'")  # Stylized quote
-            text = text.replace("\xc2\x93", '"')  # Stylized double quote
-            text = text.replace("\xc2\x94", '"')  # Stylized double quote
-            text = text.replace("\u2013", "-")  # Double dash
-            text = text.replace("\u201c", '"')  # Stylized double quote
-            text = text.replace("\u201d", '"')  # Stylized double quote
+            text = _default_text_normalizer.normalize(text)
         except AttributeError:
             print(type(text))
             pass
 
         return text
 
-    def annotate(self, max_docs=None, output_file=None):
+    def annotate(self, max_docs=None, output_file=None, batch_size=32, workers=1, shard_size=1000,
+                 checkpoint=False, resume=False, incremental=False):
         """
-        Annotate the loaded docs with scispaCy.
+        Annotate the loaded docs with scispaCy. If postings is set to a
+        PostingsWriter, the docs each concept and term is found in are also
+        recorded and saved with the output file.
+
+        Unless queue_size is 0, the docs are read and cleaned up by a
+        background thread while others are annotated, and another thread
+        merges, journals and saves the terms found, so annotating doesn't
+        wait on disk.
 
         Parameters
         ----------
         max_docs: int
             Optional max number of docs to process
         output_file: str
-            Optional output file to save to (JSON)
+            Optional output file to save to (JSON, or SQLite if it ends with
+            .sqlite or .db)
+        batch_size: int
+            Number of docs to send through the scispaCy pipeline at once
+        workers: int
+            Number of worker processes to annotate with. More than one splits
+            the docs into shards that are annotated in parallel and merged
+            in order, giving the same results as a single process.
+        shard_size: int
+            Number of docs in each shard when using multiple workers
+        checkpoint: bool
+            Journal the terms of each doc next to output_file instead of
+            periodically rewriting output_file, so the run can be resumed
+        resume: bool
+            Continue from the checkpoint of an interrupted run, skipping the
+            docs it already annotated (requires checkpoint)
+        incremental: bool
+            Add to the terms already in output_file, annotating only the
+            docs that weren't annotated by earlier incremental runs. The
+            fingerprints of the annotated docs are kept in output_file with
+            ".seen" appended.
 
         Returns
         -------
-        Terms found (concepts and text found)
+        Terms found (concepts and text found), or None if they took more
+        than memory_budget and were written to disk (they are in output_file)
 
         Term structure is a dict with this pattern, indexed by CUID:
 
@@ -141,81 +300,409 @@ class BatchAnnotator:
             ]
           }
         """
+        if workers > 1 and self._annotator_args is None and not _can_fork():
+            raise ValueError("Workers can only share an annotator passed to BatchAnnotator where they are forked, "
+                             "such as on Linux")
 
-        # Start fresh
+        # Start fresh, keeping terms over the memory budget in files next to
+        # the output
         self._terms.clear()
+        self._terms.memory_budget = self.memory_budget
+        self._terms.spill_dir = os.path.dirname(os.path.abspath(output_file)) if output_file else None
+
+        self._checkpoint = None
+        done = 0
+        resumed = False
+        if checkpoint:
+            if not output_file:
+                raise ValueError("An output file is required to checkpoint")
+            self._checkpoint = Checkpoint(output_file, encoding=self.encoding)
+            if resume and self._checkpoint.exists():
+                resumed = True
+                done = self._checkpoint.load(self._terms)
+                if self.verbose:
+                    print("Resuming after document %d" % done)
+            elif resume and self.verbose:
+                print("No checkpoint of %s to resume, starting from the first document" % output_file)
+
+        seen = None
+        docs = self.docs
+        if incremental:
+            if not output_file:
+                raise ValueError("An output file is required to update incrementally")
+            seen = SeenDocuments(output_file + ".seen")
+
+            # Start from the terms of earlier runs, unless resuming from a
+            # checkpoint that already has them
+            if not resumed:
+                self._load_output(output_file, seen)
+
+            docs = seen.filter(docs)
+
+        # Start a new checkpoint only once any terms of earlier runs are
+        # loaded, so that it is never resumed without them
+        if self._checkpoint and not resumed:
+            self._checkpoint.start(self._terms)
+
+        # Postings are numbered by row, so they continue after the docs
+        # already done
+        if self.postings is not None:
+            if incremental:
+                raise ValueError("Postings can't be recorded when updating incrementally")
+            if resume:
+                self.postings.resume(done)
+            else:
+                self.postings.start()
+
+        # Skip docs that are already done and don't feed the pipeline more
+        # docs than requested
+        docs = islice(docs, done, max_docs)
+
+        self.annotator.metrics = self.metrics
+        if self.metrics:
+            total = max_docs
+            if isinstance(self.docs, list):
+                total = len(self.docs) if max_docs is None else min(max_docs, len(self.docs))
+            self.metrics.start(total, done)
+            self.metrics.verbose = self.verbose
+            docs = timed(docs, self.metrics, "read")
+
+        # Read the docs in the background
+        self._queues = list()
+        reader = None
+        if self.queue_size:
+            reader = docs = read_ahead(docs, self._add_queue("read", self.queue_size), self.metrics)
 
-        for i, text in enumerate(self.docs):
-            if self.verbose:
-                print("Document %d of %d" % (i + 1, len(self.docs)))
-
-            # Run ScispaCy
-            terms = self.annotator.annotate(text)
-
-            # Add any new terms that were found
-            for cuid, obj in terms.items():
-
-                # Start a new concept ID if needed
-                if cuid not in self._terms:
-                    self._terms[cuid] = dict()
-                    self._terms[cuid]["name"] = obj["name"]
-                    self._terms[cuid]["terms"] = list()
-
-                # Now add the terms to the concept
-                for term in obj["terms"]:
-                    # Get the term text and standardize on lowercase, unless an acronym
-                    if not self.regex_upper.match(term["text"]):
-                        term["text"] = term["text"].lower()
-
-                    # Discard negations and other noise
-                    words = term["text"].lower().split()
-                    if len(words) == 0:
-                        continue
-                    elif words[0] in stopwords:
-                        continue
-
-                    # Add unique ones, case insensitive (favor lowercase)
-                    add = True
-                    for existing in self._terms[cuid]["terms"]:
-                        if existing["text"] == term["text"]:
-                            # Already have it
-                            existing["count"] += 1
-                            add = False
-                            break
-                        elif existing["text"] == term["text"].lower():
-                            # Already have lowercase version
-                            existing["count"] += 1
-                            add = False
-                            break
-                        elif existing["text"].lower() == term["text"]:
-                            # Already have uppercase version - keep lowercase
-                            existing["count"] += 1
-                            existing["text"] = existing["text"].lower()
-                            add = False
-                            break
-                        else:
-                            # Look at next term
-                            pass
-                    if add:
-                        self._terms[cuid]["terms"].append(term)
-
-            # Periodically update the output file
-            if output_file and (i + 1) % 50 == 0:
-                self._save(output_file)
-
-            # Stop if there is a requested limit and it is reached
-            if max_docs and (i + 1) >= max_docs:
-                break
-
-        # Write the final output file
+        try:
+            if workers > 1:
+                self._annotate_parallel(docs, done, output_file, batch_size, workers, shard_size)
+            else:
+                self._annotate_serial(docs, done, output_file, batch_size)
+        finally:
+            if reader is not None:
+                reader.close()
+
+        # Show which stages waited on which (included in the metrics summary)
+        if self.verbose and not self.metrics:
+            for stage_queue in self._queues:
+                print(stage_queue.summary())
+
+        # Write the final output file, and the postings with it
         if output_file:
             self._save(output_file)
+            if self.postings is not None:
+                self.postings.finish()
+
+        # Then remember the docs it includes
+        if seen:
+            seen.save()
+            if self.verbose:
+                print("Skipped %d documents already annotated, annotated %d new ones" % (seen.skipped, seen.new))
+
+        if self.metrics:
+            self.metrics.write()
+
+        # The checkpoint isn't needed once the output is complete
+        if self._checkpoint:
+            self._checkpoint.close()
+            self._checkpoint.remove()
+            self._checkpoint = None
+        if output_file and self.postings is not None:
+            self.postings.remove()
+
+        # Don't gather terms that didn't fit in memory into one dict
+        if self._terms.runs:
+            if self.verbose:
+                print("Terms were written to disk in %d runs over the memory budget" % self._terms.runs)
+            return None
+
+        return self._terms.to_dict()
+
+    def _annotate_serial(self, docs, done, output_file, batch_size):
+        """
+        Internal method to annotate docs one batch at a time in this process.
+        """
+        # Run ScispaCy in batches
+        results = self.annotator.annotate_many(docs, batch_size=batch_size)
+
+        # Merge and save the terms found in the background
+        write_queue = self._add_queue("write", self.queue_size) if self.queue_size else None
+        with BackgroundStage(self._aggregate_doc, write_queue, self.metrics) as writer:
+            metrics = self.metrics
+            for i, terms in enumerate(results, done + 1):
+                if metrics:
+                    start = time.perf_counter()
+                terms = self._normalize_terms(terms)
+                if metrics:
+                    metrics.add_time("normalize", time.perf_counter() - start)
+
+                writer.put(i, terms, output_file)
+
+    def _aggregate_doc(self, i, terms, output_file):
+        """
+        Internal method to add the normalized terms of the i'th doc to the
+        accumulated terms.
+        """
+        if self.verbose:
+            self._print_progress(i)
+
+        # Add any new terms that were found
+        metrics = self.metrics
+        if metrics:
+            start = time.perf_counter()
+        if self.postings is not None:
+            self.postings.add_doc(terms)
+        self._add_terms(terms, i)
+        if metrics:
+            metrics.add_time("aggregate", time.perf_counter() - start)
+            metrics.progress(i)
+
+        # Periodically update the output file
+        if output_file and not self._checkpoint and i % 50 == 0:
+            self._save(output_file)
+
+    def _annotate_parallel(self, docs, done, output_file, batch_size, workers, shard_size):
+        """
+        Internal method to annotate shards of docs in a pool of worker
+        processes. Each worker returns the terms for its shard, and the
+        shards are merged in their original order so the results match a
+        serial run. Unless queue_size is 0, they are merged and saved in a
+        background thread, so more shards are sent to the workers meanwhile.
+        """
+        global _shared_annotator
+
+        # Where possible, fork the workers after ScispaCy is loaded so that
+        # they share its knowledge base and indexes with this process, rather
+        # than each loading its own copy
+        fork = _can_fork()
+        context = multiprocessing.get_context("fork" if fork else None)
+
+        # Workers open their own connection to the annotation cache file
+        caches = _caches(self.annotator)
+        cache = self.annotator.cache
+        cache_args = (cache.filename, cache.max_bytes) if cache else (None, None)
+        self.annotator.cache = None
+
+        self.worker_memory.clear()
+        try:
+            if fork:
+                _shared_annotator = self.annotator
+                # Keep the garbage collector from touching (and so copying)
+                # every shared object in the workers
+                gc.freeze()
+
+            def merge_shard(result):
+                nonlocal done
+                done = self._merge_shard(result, done, output_file, caches)
+
+            # The background threads start once the workers are forked
+            initargs = (self._annotator_args,) + cache_args + (self.annotator.chunker, self.postings is not None)
+            write_queue = self._add_queue("write", workers) if self.queue_size else None
+            with context.Pool(workers, initializer=_init_worker, initargs=initargs) as pool, \
+                    BackgroundStage(merge_shard, write_queue, self.metrics) as writer:
+                gc.unfreeze()
+
+                pending = deque()
+                for shard in _make_shards(docs, shard_size):
+                    pending.append(pool.apply_async(_annotate_shard, (shard, batch_size)))
+
+                    # Only read a few shards ahead of the workers
+                    if len(pending) > 2 * workers:
+                        writer.put(pending.popleft().get())
+
+                while pending:
+                    writer.put(pending.popleft().get())
+        finally:
+            gc.unfreeze()
+            _shared_annotator = None
+            self.annotator.cache = cache
+
+        if self.verbose:
+            print("Memory used by this process and the workers:")
+            print(format_memory_usage([memory_usage()] + list(self.worker_memory.values())))
+
+    def _merge_shard(self, result, done, output_file, caches):
+        """
+        Internal method to merge the terms of an annotated shard, and add the
+        worker's cache hits and misses to the caches' stats.
+
+        Returns
+        -------
+        Number of docs annotated so far
+        """
+        n, terms, cache_counts, memory, stats, postings = result
+        done += n
+        self.worker_memory[memory["pid"]] = memory
+
+        # Include the workers' stage times
+        if self.metrics and stats:
+            self.metrics.merge(stats)
+
+        # Include the workers' use of the caches in their stats
+        for cache, (hits, misses) in zip(caches, cache_counts):
+            if cache:
+                cache.hits += hits
+                cache.misses += misses
+
+        if self.verbose:
+            self._print_progress(done)
+
+        if self.metrics:
+            start = time.perf_counter()
+        if self.postings is not None:
+            self.postings.merge(postings)
+        self._add_terms(terms, done)
+        if self.metrics:
+            self.metrics.add_time("aggregate", time.perf_counter() - start)
+            self.metrics.progress(done)
+
+        # Periodically update the output file
+        if output_file and not self._checkpoint:
+            self._save(output_file)
 
-        return self._terms
+        return done
+
+    def _print_progress(self, done):
+        """
+        Internal method to show how many docs have been annotated. When
+        timed, the metrics show the progress instead, every few seconds.
+        """
+        if self.metrics:
+            return
+
+        if isinstance(self.docs, list):
+            progress = "Document %d of %d" % (done, len(self.docs))
+        else:
+            progress = "Document %d" % done
+
+        if self._queues:
+            progress += " [%s]" % ", ".join("%s queue %d%%" % (stage_queue.name,
+                                                              100 * len(stage_queue) // stage_queue.maxsize)
+                                            for stage_queue in self._queues)
+
+        print(progress)
+
+    def _add_queue(self, name, maxsize):
+        """
+        Internal method to make a queue between the stages of this run and
+        report its occupancy.
+        """
+        stage_queue = StageQueue(name, maxsize)
+        self._queues.append(stage_queue)
+        if self.metrics:
+            self.metrics.add_queue(stage_queue)
+        return stage_queue
+
+    def _normalize_terms(self, terms):
+        """
+        Internal method to standardize the terms found in a document and drop
+        those that are noise.
+
+        Parameters
+        ----------
+        terms (dict)
+            Terms found in one document, indexed by CUID
+
+        Returns
+        -------
+        The terms to keep, indexed by CUID
+        """
+        return self.term_normalizer.normalize_terms(terms)
+
+    def _add_terms(self, terms, done):
+        """
+        Internal method to merge terms into the accumulated terms.
+
+        Parameters
+        ----------
+        terms (dict)
+            Normalized terms found in one document, or the accumulated terms
+            of a shard of documents, indexed by CUID
+        done (int)
+            Total number of docs annotated, including these
+
+        Returns
+        -------
+        void
+        """
+        # Journal the terms before merging them updates their counts
+        if self._checkpoint:
+            self._checkpoint.append(done, terms)
+
+        # Add unique ones, case insensitive (favor lowercase)
+        self._terms.add_terms(terms)
+
+        if self._checkpoint and self._checkpoint.needs_compact:
+            self._checkpoint.compact(done, self._terms)
+
+    def _load_output(self, output_file, seen):
+        """
+        Internal method to add the terms saved by an earlier incremental run
+        to the accumulated terms.
+
+        Parameters
+        ----------
+        output_file (str)
+            Output filename
+        seen (SeenDocuments)
+            Docs annotated by earlier runs
+
+        Returns
+        -------
+        void
+        """
+        if not os.path.exists(seen.filename):
+            # The first incremental run annotates everything
+            if self.verbose:
+                print("No %s yet, annotating all documents" % seen.filename)
+            return
+
+        found = False
+        for name, filename in self.output_files(output_file).items():
+            if not os.path.exists(filename):
+                continue
+            found = True
+
+            for cuid, obj in iter_terms(filename, encoding=self.encoding):
+                if name is not None:
+                    # Put back the namespace of this linker's concepts
+                    cuid = name + ":" + cuid
+                self._terms.add_terms({cuid: obj})
+
+        if not found:
+            raise RuntimeError("%s is missing but %s lists documents already annotated. Delete %s to annotate all "
+                               "documents again." % (output_file, seen.filename, seen.filename))
+
+        if self.verbose:
+            print("Adding to the terms of %d documents in %s" % (len(seen), output_file))
+
+    def output_files(self, output_file):
+        """
+        Get the files that annotate writes for an output file. With more than
+        one linker, and unless combined is set, the terms of each linker are
+        written to their own file with the linker name added, such as
+        "notes.umls.json" and "notes.rxnorm.json".
+
+        Parameters
+        ----------
+        output_file (str)
+            Output filename passed to annotate
+
+        Returns
+        -------
+        Dict of output filenames indexed by linker name (None for a single
+        combined file)
+        """
+        linkers = self.annotator.linkers
+        if len(linkers) == 1 or self.combined:
+            return {None: output_file}
+
+        base, ext = os.path.splitext(output_file)
+        return {name: "%s.%s%s" % (base, name, ext) for name in linkers}
 
     def _save(self, output_file):
         """
-        Internal method to save the annotations to a JSON file.
+        Internal method to save the annotations to a JSON or SQLite file.
 
         Parameters
         ----------
@@ -226,8 +713,124 @@ class BatchAnnotator:
         -------
         void
         """
-        with open(output_file, "w", encoding=self.encoding) as f:
-            json.dump(self._terms, f, indent=2, ensure_ascii=False)
+        if self.metrics:
+            start = time.perf_counter()
+
+        # Write the terms one concept at a time rather than all in one dict,
+        # going through them once for all the output files
+        with ExitStack() as stack:
+            writers = {name: stack.enter_context(TermWriter(filename, encoding=self.encoding))
+                       for name, filename in self.output_files(output_file).items()}
+            combined = writers.get(None)
+            for cuid, obj in self._terms.items():
+                if combined is not None:
+                    combined.write(cuid, obj)
+                else:
+                    # Just this linker's concepts, without the namespace
+                    name, _, linker_cuid = cuid.partition(":")
+                    if name in writers:
+                        writers[name].write(linker_cuid, obj)
 
         if self.verbose:
-            print("Wrote", output_file)
+            for writer in writers.values():
+                print("Wrote", writer.filename)
+
+        if self.metrics:
+            self.metrics.add_time("save", time.perf_counter() - start)
+
+
+# Normalizer used by BatchAnnotator.fixup
+_default_text_normalizer = TextNormalizer()
+
+# Annotator used by a worker process of BatchAnnotator._annotate_parallel
+_worker = None
+
+# Annotator loaded by the parent process, inherited by forked workers
+_shared_annotator = None
+
+
+def _can_fork():
+    """
+    True if worker processes can be forked, and so share this process's
+    annotator.
+    """
+    return "fork" in multiprocessing.get_all_start_methods() and sys.platform != "darwin"
+
+
+def _init_worker(annotator_args, cache_file, cache_bytes, chunker, postings):
+    """
+    Set up the annotator of a worker process, loading scispaCy unless the
+    worker was forked from a process that already loaded it.
+    """
+    global _worker
+    annotator = _shared_annotator
+    metrics = None
+    if annotator is not None:
+        # Count only this worker's cache hits
+        for cache in _caches(annotator):
+            if cache:
+                cache.hits = cache.misses = 0
+
+        # Time this worker's stages, to send them to the parent with each
+        # shard
+        if annotator.metrics:
+            metrics = Metrics()
+
+    _worker = BatchAnnotator(annotator=annotator, **(annotator_args or dict()))
+    _worker.verbose = False
+    # Shards are already in memory and their terms are merged by the parent
+    _worker.queue_size = 0
+    _worker.metrics = metrics
+    _worker.annotator.chunker = chunker
+    _worker.postings = PostingsBuffer() if postings else None
+    if cache_file:
+        _worker.annotator.cache = AnnotationCache(cache_file, max_bytes=cache_bytes)
+
+
+def _annotate_shard(docs, batch_size):
+    """
+    Annotate one shard of docs in a worker process.
+
+    Returns
+    -------
+    Number of docs in the shard, the terms found in them, the number of hits
+    and misses of the annotation and mention caches, the memory used by the
+    worker, its stage times if timed and the postings of the docs if
+    recorded
+    """
+    _worker.docs = docs
+    terms = _worker.annotate(batch_size=batch_size)
+
+    cache_counts = list()
+    for cache in _caches(_worker.annotator):
+        if cache:
+            cache_counts.append((cache.hits, cache.misses))
+            cache.hits = cache.misses = 0
+        else:
+            cache_counts.append((0, 0))
+
+    stats = _worker.metrics.pop_stats() if _worker.metrics else None
+
+    postings = _worker.postings.pop() if _worker.postings is not None else None
+
+    return len(docs), terms, cache_counts, memory_usage(), stats, postings
+
+
+def _caches(annotator):
+    """
+    Get the annotation cache and mention caches of an annotator, in the same
+    order in every process.
+    """
+    return [annotator.cache] + [annotator.mention_caches[name] for name in sorted(annotator.mention_caches)]
+
+
+def _make_shards(docs, shard_size):
+    """
+    Split docs into lists of at most shard_size docs.
+    """
+    docs = iter(docs)
+    while True:
+        shard = list(islice(docs, shard_size))
+        if not shard:
+            return
+        yield shard
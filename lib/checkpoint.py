@@ -0,0 +1,193 @@
+"""
+Class to checkpoint a long annotation run so it can be resumed.
+
+The Checkpoint class appends the terms found in each document (or shard of
+documents) to a journal file, one JSON line per entry, so the cost of a
+checkpoint stays the same however many documents have been annotated. When
+the journal grows larger than the last snapshot, the accumulated terms are
+written to a new snapshot file and the journal starts over. Snapshots are
+written to a temporary file and renamed, so a crash leaves either the old or
+the new snapshot, never a partial one. Snapshots hold one concept per line,
+so writing or loading one doesn't need a second copy of all the terms in
+memory.
+"""
+import json
+import os
+
+
+class Checkpoint:
+    """
+    Append-only journal of annotated terms with periodic snapshots.
+    """
+    def __init__(self, filename, encoding="utf-8", min_compact_bytes=1 << 20):
+        """
+        Constructor.
+
+        Parameters
+        ----------
+        filename (str)
+            Base filename; the journal and snapshot are written next to it
+            with ".journal" and ".snapshot" appended
+        encoding (str)
+            Encoding of the journal and snapshot files
+        min_compact_bytes (int)
+            Don't write a snapshot until the journal is at least this large
+        """
+        self.journal_file = filename + ".journal"
+        self.snapshot_file = filename + ".snapshot"
+        self.encoding = encoding
+        self.min_compact_bytes = min_compact_bytes
+
+        self._journal = None
+        self._journal_bytes = 0
+        self._snapshot_bytes = 0
+
+    def load(self, accumulator):
+        """
+        Rebuild the accumulated terms from the snapshot and journal.
+
+        Parameters
+        ----------
+        accumulator (TermAccumulator)
+            Accumulator to add the saved terms to
+
+        Returns
+        -------
+        Number of docs that were annotated before the checkpoint
+        """
+        done = 0
+        if os.path.exists(self.snapshot_file):
+            # The number of docs, then one concept per line
+            with open(self.snapshot_file, "r", encoding=self.encoding) as f:
+                done = json.loads(f.readline())["docs"]
+                for line in f:
+                    cuid, obj = json.loads(line)
+                    accumulator.add_terms({cuid: obj})
+            self._snapshot_bytes = os.path.getsize(self.snapshot_file)
+
+        if os.path.exists(self.journal_file):
+            with open(self.journal_file, "r", encoding=self.encoding) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # The last entry may be incomplete after a crash
+                        break
+
+                    # Skip entries already in the snapshot
+                    if entry["docs"] <= done:
+                        continue
+                    accumulator.add_terms(entry["terms"])
+                    done = entry["docs"]
+
+        # Continue the journal after the last complete entry
+        self._open_journal(done, accumulator)
+
+        return done
+
+    def exists(self):
+        """
+        True if there is a checkpoint to load.
+        """
+        return os.path.exists(self.snapshot_file) or os.path.exists(self.journal_file)
+
+    def start(self, accumulator=None):
+        """
+        Start a new checkpoint, discarding any previous one.
+
+        Parameters
+        ----------
+        accumulator (TermAccumulator)
+            Optional terms to start from, such as those of earlier incremental
+            runs. They are written to the snapshot before the journal is
+            created, so the checkpoint never exists without them.
+        """
+        self.close()
+        self.remove()
+        self._snapshot_bytes = 0
+        if accumulator is not None and len(accumulator):
+            self._write_snapshot(0, accumulator)
+        self._journal = open(self.journal_file, "w", encoding=self.encoding)
+        self._journal_bytes = 0
+
+    def append(self, docs, terms):
+        """
+        Add the terms of newly annotated docs to the journal. Call this before
+        merging the terms, since merging updates their counts.
+
+        Parameters
+        ----------
+        docs (int)
+            Total number of docs annotated, including these
+        terms (dict)
+            Terms found in the newly annotated docs, indexed by CUID
+        """
+        line = json.dumps({"docs": docs, "terms": terms}, ensure_ascii=False) + "\n"
+        self._journal.write(line)
+        self._journal.flush()
+        self._journal_bytes += len(line)
+
+    @property
+    def needs_compact(self):
+        """
+        True if the journal has grown larger than the snapshot, so that the
+        total size written for snapshots stays proportional to the journal.
+        """
+        return self._journal_bytes > max(self._snapshot_bytes, self.min_compact_bytes)
+
+    def compact(self, docs, accumulator):
+        """
+        Write all the accumulated terms to a new snapshot and empty the journal.
+
+        Parameters
+        ----------
+        docs (int)
+            Total number of docs annotated
+        accumulator (TermAccumulator)
+            All the terms accumulated so far
+        """
+        self._write_snapshot(docs, accumulator)
+
+        # Journal entries up to here are now in the snapshot
+        self._journal.close()
+        self._journal = open(self.journal_file, "w", encoding=self.encoding)
+        self._journal_bytes = 0
+
+    def close(self):
+        """
+        Close the journal.
+        """
+        if self._journal:
+            self._journal.close()
+            self._journal = None
+
+    def remove(self):
+        """
+        Delete the journal and snapshot files.
+        """
+        for filename in (self.journal_file, self.snapshot_file):
+            if os.path.exists(filename):
+                os.remove(filename)
+
+    def _write_snapshot(self, docs, accumulator):
+        """
+        Internal method to write all the accumulated terms to a new snapshot.
+        """
+        tmp_file = self.snapshot_file + ".tmp"
+        with open(tmp_file, "w", encoding=self.encoding) as f:
+            f.write(json.dumps({"docs": docs}) + "\n")
+            for item in accumulator.items():
+                f.write(json.dumps(item, ensure_ascii=False) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_file, self.snapshot_file)
+        self._snapshot_bytes = os.path.getsize(self.snapshot_file)
+
+    def _open_journal(self, docs, accumulator):
+        """
+        Internal method to continue checkpointing after load. The loaded
+        state is compacted into a new snapshot, which also drops any partial
+        entry left at the end of the journal.
+        """
+        self._journal = open(self.journal_file, "a", encoding=self.encoding)
+        self.compact(docs, accumulator)
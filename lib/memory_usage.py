@@ -0,0 +1,74 @@
+"""
+Functions to measure the memory used by a process.
+
+Worker processes forked after ScispaCy is loaded share the knowledge base
+pages with their parent, so their resident set size (RSS) counts memory that
+isn't really theirs. On Linux, the proportional set size (PSS) splits shared
+pages between the processes that use them, and the unique set size (USS) is
+the memory only that process uses, which is what adding a worker costs.
+"""
+import os
+import sys
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows
+    resource = None
+
+
+def memory_usage():
+    """
+    Get the memory used by this process.
+
+    Returns
+    -------
+    Dict with "pid" and "rss", "pss", "uss" and "peak_rss" in bytes. Only
+    "pid" and "peak_rss" are available on systems without /proc, and only
+    "pid" on Windows.
+    """
+    usage = {"pid": os.getpid()}
+    if resource is None:
+        return usage
+
+    # ru_maxrss is in KB on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    usage["peak_rss"] = peak if sys.platform == "darwin" else peak * 1024
+
+    try:
+        with open("/proc/self/smaps_rollup", "r") as f:
+            fields = dict()
+            for line in f:
+                parts = line.split()
+                if len(parts) == 3 and parts[2] == "kB":
+                    fields[parts[0].rstrip(":")] = int(parts[1]) * 1024
+    except OSError:
+        return usage
+
+    usage["rss"] = fields.get("Rss", 0)
+    usage["pss"] = fields.get("Pss", 0)
+    usage["uss"] = fields.get("Private_Clean", 0) + fields.get("Private_Dirty", 0)
+
+    return usage
+
+
+def format_memory_usage(usages):
+    """
+    Format the memory used by processes as a table.
+
+    Parameters
+    ----------
+    usages (list of dict)
+        Memory used by each process, from memory_usage
+
+    Returns
+    -------
+    Table as a string, with sizes in MB
+    """
+    lines = ["%8s %10s %10s %10s %10s" % ("PID", "RSS MB", "PSS MB", "USS MB", "Peak MB")]
+    for usage in usages:
+        sizes = [usage.get(name) for name in ("rss", "pss", "uss", "peak_rss")]
+        lines.append("%8d " % usage["pid"] + " ".join(
+            "%10s" % ("-" if size is None else "%.0f" % (size / 1048576.0)) for size in sizes))
+
+    return "\n".join(lines)
@@ -0,0 +1,110 @@
+"""
+Class to cache the candidate concepts of entity mentions.
+
+The same mentions ("SOB", "HTN", "flu shot") appear over and over in a
+corpus, and the ScispaCy linker looks up candidates for every one of them
+with a TF-IDF transform and approximate nearest neighbor search. The
+MentionCache class wraps the linker's candidate generator with an LRU cache
+so each distinct mention is only looked up once.
+"""
+from collections import OrderedDict
+
+
+class MentionCache:
+    """
+    LRU cache in front of a ScispaCy CandidateGenerator.
+    """
+    def __init__(self, candidate_generator, max_size=100000, name=""):
+        """
+        Constructor.
+
+        Parameters
+        ----------
+        candidate_generator (scispacy.candidate_generation.CandidateGenerator)
+            Candidate generator of the linker
+        max_size (int)
+            Max number of distinct mentions to keep
+        name (str)
+            Optional name of the linker, for stats
+        """
+        self.candidate_generator = candidate_generator
+        self.max_size = max_size
+        self.name = name
+        self.hits = 0
+        self.misses = 0
+
+        self._cache = OrderedDict()
+
+    def __call__(self, mention_texts, k):
+        """
+        Get the candidate concepts of mentions, the same way as the candidate
+        generator.
+
+        Parameters
+        ----------
+        mention_texts (list of str)
+            Mention texts, with abbreviations already resolved by the linker
+        k (int)
+            Number of nearest neighbors to look up
+
+        Returns
+        -------
+        List of candidates for each mention
+        """
+        results = [None] * len(mention_texts)
+
+        # Collect the distinct mentions that aren't cached
+        todo = OrderedDict()
+        for i, text in enumerate(mention_texts):
+            key = (self.normalize(text), k)
+            candidates = self._cache.get(key)
+            if candidates is not None:
+                self._cache.move_to_end(key)
+                results[i] = candidates
+                self.hits += 1
+            elif key in todo:
+                # Repeated in this batch, so only looked up once
+                todo[key].append(i)
+                self.hits += 1
+            else:
+                todo[key] = [i]
+                self.misses += 1
+
+        # Look them up in one batch
+        if todo:
+            batch = self.candidate_generator([mention_texts[indexes[0]] for indexes in todo.values()], k)
+            for (key, indexes), candidates in zip(todo.items(), batch):
+                self._cache[key] = candidates
+                for i in indexes:
+                    results[i] = candidates
+
+            while len(self._cache) > self.max_size:
+                self._cache.popitem(last=False)
+
+        return results
+
+    @staticmethod
+    def normalize(text):
+        """
+        Normalize a mention for the cache key. The linker's TF-IDF vectorizer
+        lowercases and splits on whitespace, so mentions that differ only in
+        case or spacing get the same candidates.
+        """
+        return " ".join(text.lower().split())
+
+    def clear(self):
+        """
+        Remove all cached mentions.
+        """
+        self._cache.clear()
+
+    def stats(self):
+        """
+        Describe the cache hits and misses.
+        """
+        total = self.hits + self.misses
+        rate = 100.0 * self.hits / total if total else 0.0
+
+        name = " (%s)" % self.name if self.name else ""
+
+        return "Mention cache%s: %d hits, %d misses (%.1f%% hit rate)" % (name, self.hits, self.misses, rate)
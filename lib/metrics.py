@@ -0,0 +1,404 @@
+"""
+Class to measure where annotation time goes.
+
+A Metrics object collects the time spent in each stage of the pipeline
+(reading, tokenization and NER, linking, concept lookup, aggregation,
+writing), histograms such as the number of entities per document, and the
+documents done, from which it works out docs/sec and the time left. It
+periodically appends the metrics to a JSON-lines file and rewrites a
+Prometheus textfile, for node_exporter's textfile collector, and if verbose
+shows the progress.
+
+Instrumented classes keep a metrics attribute that is None by default and
+only measure anything when it is set, so there is no cost when disabled.
+Stages running in other threads can add to the same Metrics object, along
+with the occupancy of the queues between them.
+"""
+from bisect import bisect_left
+import json
+import os
+import threading
+import time
+
+# Upper bounds of the histogram buckets
+default_buckets = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+
+class Metrics:
+    """
+    Stage timers, histograms and progress of an annotation run.
+    """
+    def __init__(self, jsonl_file=None, prometheus_file=None, interval=10.0, prefix="termset"):
+        """
+        Constructor.
+
+        Parameters
+        ----------
+        jsonl_file (str)
+            Optional file to append a JSON line of metrics to periodically
+        prometheus_file (str)
+            Optional Prometheus textfile to rewrite periodically
+        interval (float)
+            Seconds between writes
+        prefix (str)
+            Prefix of the Prometheus metric names
+        """
+        self.jsonl_file = jsonl_file
+        self.prometheus_file = prometheus_file
+        self.interval = interval
+        self.prefix = prefix
+
+        # Print the progress each time the metrics are written
+        self.verbose = False
+
+        self.total = None
+        self.docs = 0
+        self._done_at_start = 0
+        self.stages = dict()
+        self.histograms = dict()
+
+        # StageQueues between pipeline stages, by name
+        self.queues = dict()
+
+        # Stages in other threads add to the same totals
+        self._lock = threading.RLock()
+
+        # Total time added in each thread, to tell how much of a timed step
+        # was spent in stages nested in it
+        self._local = threading.local()
+
+        self._start = time.time()
+        self._next_write = time.perf_counter() + interval
+
+    def start(self, total=None, done=0):
+        """
+        Start timing a run.
+
+        Parameters
+        ----------
+        total (int)
+            Number of docs to annotate, if known, for the ETA
+        done (int)
+            Number of docs already done, such as when resuming
+        """
+        self.total = total
+        self.docs = done
+        self._done_at_start = done
+        self._start = time.time()
+        self.queues = dict()
+
+    @property
+    def _measured(self):
+        return getattr(self._local, "measured", 0.0)
+
+    def add_queue(self, stage_queue):
+        """
+        Report the occupancy of a queue between pipeline stages.
+
+        Parameters
+        ----------
+        stage_queue (StageQueue)
+            Queue to report
+        """
+        self.queues[stage_queue.name] = stage_queue
+
+    def add_time(self, stage, seconds, calls=1):
+        """
+        Add time spent in a stage.
+
+        Parameters
+        ----------
+        stage (str)
+            Name of the stage
+        seconds (float)
+            Time spent
+        calls (int)
+            Number of times the stage ran
+        """
+        with self._lock:
+            totals = self.stages.get(stage)
+            if totals is None:
+                totals = self.stages[stage] = [0, 0.0]
+            totals[0] += calls
+            totals[1] += seconds
+        self._local.measured = self._measured + seconds
+
+    def observe(self, name, value):
+        """
+        Add a value to a histogram.
+
+        Parameters
+        ----------
+        name (str)
+            Name of the histogram, such as "entities_per_doc"
+        value (float)
+            Value observed
+        """
+        with self._lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = [[0] * (len(default_buckets) + 1), 0, 0.0]
+            histogram[0][bisect_left(default_buckets, value)] += 1
+            histogram[1] += 1
+            histogram[2] += value
+
+    def progress_line(self):
+        """
+        Format the docs done, docs/sec, time left and how full the queues
+        are.
+        """
+        with self._lock:
+            line = "Document %d" % self.docs
+            if self.total is not None:
+                line += " of %d" % self.total
+
+            if self.queues:
+                line += " [%s]" % ", ".join("%s queue %d%%" % (name, 100 * len(stage_queue) // stage_queue.maxsize)
+                                            for name, stage_queue in self.queues.items())
+
+            eta = self.eta()
+            line += " (%.1f docs/sec" % self.docs_per_sec()
+            if eta is not None:
+                line += ", %s left" % _format_seconds(eta)
+            return line + ")"
+
+    def progress(self, done):
+        """
+        Record the number of docs done, writing the metrics files if it is
+        time to.
+
+        Parameters
+        ----------
+        done (int)
+            Total number of docs done
+        """
+        self.docs = done
+        if time.perf_counter() >= self._next_write:
+            self.write()
+
+    def docs_per_sec(self):
+        """
+        Get the docs done per second in this run.
+        """
+        elapsed = time.time() - self._start
+        return (self.docs - self._done_at_start) / elapsed if elapsed > 0 else 0.0
+
+    def eta(self):
+        """
+        Get the estimated seconds left, or None if unknown.
+        """
+        rate = self.docs_per_sec()
+        if self.total is None or rate <= 0:
+            return None
+        return max(self.total - self.docs, 0) / rate
+
+    def pop_stats(self):
+        """
+        Get the stage times and histograms and reset them, such as to send
+        those of a worker process to its parent.
+
+        Returns
+        -------
+        Tuple of stage times and histograms, for merge
+        """
+        with self._lock:
+            stats = (self.stages, self.histograms)
+            self.stages = dict()
+            self.histograms = dict()
+        return stats
+
+    def merge(self, stats):
+        """
+        Add the stage times and histograms of another Metrics object.
+
+        Parameters
+        ----------
+        stats (tuple)
+            Stage times and histograms from pop_stats
+        """
+        stages, histograms = stats
+        with self._lock:
+            for stage, (calls, seconds) in stages.items():
+                self.add_time(stage, seconds, calls)
+
+            for name, (buckets, count, total) in histograms.items():
+                histogram = self.histograms.get(name)
+                if histogram is None:
+                    histogram = self.histograms[name] = [[0] * (len(default_buckets) + 1), 0, 0.0]
+                histogram[0] = [a + b for a, b in zip(histogram[0], buckets)]
+                histogram[1] += count
+                histogram[2] += total
+
+    def to_dict(self):
+        """
+        Get the current metrics.
+
+        Returns
+        -------
+        Dict of the metrics, as written to the JSON-lines file
+        """
+        with self._lock:
+            eta = self.eta()
+            return {
+                "time": round(time.time(), 3),
+                "elapsed_sec": round(time.time() - self._start, 3),
+                "docs": self.docs,
+                "total_docs": self.total,
+                "docs_per_sec": round(self.docs_per_sec(), 3),
+                "eta_sec": None if eta is None else round(eta, 1),
+                "stages": {stage: {"calls": calls, "seconds": round(seconds, 6)}
+                           for stage, (calls, seconds) in self.stages.items()},
+                "histograms": {name: {"count": count, "sum": total, "mean": total / count if count else 0.0,
+                                      "buckets": self._cumulative(buckets)}
+                               for name, (buckets, count, total) in self.histograms.items()},
+                "queues": {name: stage_queue.stats() for name, stage_queue in self.queues.items()},
+            }
+
+    def write(self):
+        """
+        Append the metrics to the JSON-lines file and rewrite the Prometheus
+        textfile.
+        """
+        self._next_write = time.perf_counter() + self.interval
+
+        if self.verbose:
+            print(self.progress_line())
+
+        if self.jsonl_file:
+            with open(self.jsonl_file, "a", encoding="utf-8") as f:
+                f.write(json.dumps(self.to_dict()) + "\n")
+
+        if self.prometheus_file:
+            # Write under another name and rename, so the collector never
+            # reads a partial file
+            tmp_file = self.prometheus_file + ".tmp"
+            with open(tmp_file, "w", encoding="utf-8") as f:
+                f.write(self.to_prometheus())
+            os.replace(tmp_file, self.prometheus_file)
+
+    def to_prometheus(self):
+        """
+        Format the metrics in the Prometheus text format.
+        """
+        with self._lock:
+            p = self.prefix
+            lines = [
+                "# HELP %s_docs_total Documents annotated." % p,
+                "# TYPE %s_docs_total counter" % p,
+                "%s_docs_total %d" % (p, self.docs),
+                "# HELP %s_docs_per_second Documents annotated per second in this run." % p,
+                "# TYPE %s_docs_per_second gauge" % p,
+                "%s_docs_per_second %f" % (p, self.docs_per_sec()),
+            ]
+
+            eta = self.eta()
+            if eta is not None:
+                lines += ["# HELP %s_eta_seconds Estimated seconds left." % p,
+                          "# TYPE %s_eta_seconds gauge" % p,
+                          "%s_eta_seconds %f" % (p, eta)]
+
+            lines += ["# HELP %s_stage_seconds_total Time spent in each pipeline stage." % p,
+                      "# TYPE %s_stage_seconds_total counter" % p]
+            lines += ['%s_stage_seconds_total{stage="%s"} %f' % (p, stage, seconds)
+                      for stage, (_, seconds) in sorted(self.stages.items())]
+            lines += ["# HELP %s_stage_calls_total Number of times each pipeline stage ran." % p,
+                      "# TYPE %s_stage_calls_total counter" % p]
+            lines += ['%s_stage_calls_total{stage="%s"} %d' % (p, stage, calls)
+                      for stage, (calls, _) in sorted(self.stages.items())]
+
+            for name, (buckets, count, total) in sorted(self.histograms.items()):
+                lines += ["# TYPE %s_%s histogram" % (p, name)]
+                for le, n in self._cumulative(buckets).items():
+                    lines.append('%s_%s_bucket{le="%s"} %d' % (p, name, le, n))
+                lines += ["%s_%s_sum %f" % (p, name, total), "%s_%s_count %d" % (p, name, count)]
+
+            if self.queues:
+                lines += ["# HELP %s_queue_occupancy Mean fraction of each queue between stages that was full." % p,
+                          "# TYPE %s_queue_occupancy gauge" % p]
+                lines += ['%s_queue_occupancy{queue="%s"} %f' % (p, name, stage_queue.occupancy())
+                          for name, stage_queue in sorted(self.queues.items())]
+                lines += ["# HELP %s_queue_wait_seconds_total Time the stages before (producer) and after "
+                          "(consumer) each queue waited for it." % p,
+                          "# TYPE %s_queue_wait_seconds_total counter" % p]
+                for name, stage_queue in sorted(self.queues.items()):
+                    lines.append('%s_queue_wait_seconds_total{queue="%s",side="producer"} %f'
+                                 % (p, name, stage_queue.producer_wait))
+                    lines.append('%s_queue_wait_seconds_total{queue="%s",side="consumer"} %f'
+                                 % (p, name, stage_queue.consumer_wait))
+
+            return "\n".join(lines) + "\n"
+
+    def summary(self):
+        """
+        Format the stage times, histograms and queues as a table.
+        """
+        with self._lock:
+            lines = ["%-12s %10s %10s %8s" % ("Stage", "Calls", "Sec", "%")]
+            total = sum(seconds for _, seconds in self.stages.values()) or 1.0
+            for stage, (calls, seconds) in sorted(self.stages.items(), key=lambda item: -item[1][1]):
+                lines.append("%-12s %10d %10.3f %7.1f%%" % (stage, calls, seconds, 100.0 * seconds / total))
+
+            for name, (_, count, total) in sorted(self.histograms.items()):
+                lines.append("%s: mean %.2f over %d" % (name, total / count if count else 0.0, count))
+
+            for stage_queue in self.queues.values():
+                lines.append(stage_queue.summary())
+
+            lines.append("%.1f docs/sec" % self.docs_per_sec())
+            return "\n".join(lines)
+
+    @staticmethod
+    def _cumulative(buckets):
+        """
+        Internal method to get cumulative bucket counts indexed by their
+        upper bound, as Prometheus expects.
+        """
+        cumulative = dict()
+        n = 0
+        for le, count in zip(list(default_buckets) + ["+Inf"], buckets):
+            n += count
+            cumulative[str(le)] = n
+        return cumulative
+
+
+def _format_seconds(seconds):
+    """
+    Internal function to format a number of seconds as hours, minutes and
+    seconds.
+    """
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return "%d:%02d:%02d" % (hours, minutes, seconds)
+
+
+def timed(iterable, metrics, stage):
+    """
+    Time how long it takes to get each item of an iterable, such as docs
+    read from a CSV or processed by a spaCy pipeline. Time spent in other
+    stages while getting an item, such as reading the docs that the pipeline
+    pulls in, is not counted again.
+
+    Parameters
+    ----------
+    iterable (iterable)
+        Items to time
+    metrics (Metrics)
+        Metrics to add the time to
+    stage (str)
+        Name of the stage
+
+    Returns
+    -------
+    Generator of the items
+    """
+    iterator = iter(iterable)
+    while True:
+        measured = metrics._measured
+        start = time.perf_counter()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            return
+        elapsed = time.perf_counter() - start
+        metrics.add_time(stage, elapsed - (metrics._measured - measured))
+        yield item
@@ -0,0 +1,170 @@
+"""
+Classes to normalize document text and the terms found in it.
+
+The TextNormalizer class converts common non-ASCII characters to their
+ASCII equivalents, over a whole column of documents at once, and can be
+extended with user-supplied mappings.
+
+The TermNormalizer class standardizes the terms found by ScispaCy
+(lowercase unless an acronym) and discards negations and other noise.
+"""
+import re
+
+# Common non-ASCII characters and their ASCII equivalents
+default_mappings = {
+    # These appear like â\u0092 in JSON
+    "\xc2\x91": "'",  # Stylized quote
+    "\xc2\x92": "'",  # Stylized quote
+    "\xc2\x93": '"',  # Stylized double quote
+    "\xc2\x94": '"',  # Stylized double quote
+    "\u2013": "-",  # Double dash
+    "\u201c": '"',  # Stylized double quote
+    "\u201d": '"',  # Stylized double quote
+}
+
+# Modifiers of terms to exclude
+stopwords = ["denied", "denies", "her", "his", "negative", "no"]
+
+# Line breaks within an entity's text
+_mention_table = str.maketrans({"\r": " ", "\n": " "})
+
+
+def clean_mention(text):
+    """
+    Replace line breaks in an entity's text with spaces and strip it.
+    """
+    return text.translate(_mention_table).strip()
+
+
+class TextNormalizer:
+    """
+    Replace characters and character sequences in document text.
+    """
+    def __init__(self, mappings=None):
+        """
+        Constructor.
+
+        Parameters
+        ----------
+        mappings (dict)
+            Optional extra mappings of text to replace and its replacement,
+            added to (or overriding) default_mappings. Longer sequences are
+            replaced first, so a mapping of one character doesn't break up
+            a longer sequence that contains it.
+        """
+        self.mappings = dict(default_mappings)
+        if mappings:
+            self.mappings.update(mappings)
+
+        self._replacements = sorted(self.mappings.items(), key=lambda item: len(item[0]), reverse=True)
+
+        # ASCII documents need no work unless ASCII text is mapped
+        self._skip_ascii = not any(old.isascii() for old in self.mappings)
+
+    def normalize(self, text):
+        """
+        Normalize the text of one document.
+
+        Parameters
+        ----------
+        text (str)
+            Document text
+
+        Returns
+        -------
+        Normalized text
+        """
+        if self._skip_ascii and text.isascii():
+            return text
+
+        for old, new in self._replacements:
+            text = text.replace(old, new)
+
+        return text
+
+    def normalize_series(self, series):
+        """
+        Normalize a column of documents, one mapping at a time over the whole
+        column rather than one document at a time.
+
+        Parameters
+        ----------
+        series (pandas.Series)
+            Document texts, converted to str if needed
+
+        Returns
+        -------
+        Series of normalized texts
+        """
+        series = series.astype(str)
+        for old, new in self._replacements:
+            series = series.str.replace(old, new, regex=False)
+
+        return series
+
+
+class TermNormalizer:
+    """
+    Standardize term spellings and discard noise.
+    """
+    def __init__(self, stopwords=stopwords):
+        """
+        Constructor.
+
+        Parameters
+        ----------
+        stopwords (list of str)
+            Terms that start with one of these words are discarded
+        """
+        self.stopwords = set(stopwords)
+        self.regex_upper = re.compile(r"^[A-Z]+$")
+
+    def normalize(self, text):
+        """
+        Normalize a term's text.
+
+        Parameters
+        ----------
+        text (str)
+            Term text
+
+        Returns
+        -------
+        Text in lowercase unless it is an acronym, or None if the term should
+        be discarded
+        """
+        # Standardize on lowercase, unless an acronym
+        normalized = text
+        if not self.regex_upper.match(text):
+            normalized = text.lower()
+
+        # Discard negations and other noise
+        words = normalized.lower().split()
+        if len(words) == 0 or words[0] in self.stopwords:
+            normalized = None
+
+        return normalized
+
+    def normalize_terms(self, terms):
+        """
+        Normalize the terms found in a document and drop those to discard.
+
+        Parameters
+        ----------
+        terms (dict)
+            Terms found in one document, indexed by CUID
+
+        Returns
+        -------
+        The terms to keep, indexed by CUID
+        """
+        for obj in terms.values():
+            kept = list()
+            for term in obj["terms"]:
+                text = self.normalize(term["text"])
+                if text is not None:
+                    term["text"] = text
+                    kept.append(term)
+            obj["terms"] = kept
+
+        return terms
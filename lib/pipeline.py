@@ -0,0 +1,261 @@
+"""
+Classes to run the stages of annotation in their own threads.
+
+Reading and cleaning up the documents, and merging, journaling and saving
+the terms found in them, mostly wait on disk, while annotating with ScispaCy
+keeps a CPU busy. Running them in background threads connected by bounded
+queues lets the annotation stage go on while the others read ahead and
+write behind it, and the queues keep any stage from getting too far ahead.
+
+Each StageQueue measures how full it is and how long the stages on either
+side of it waited: a queue that is usually full means the stage after it is
+the bottleneck, and one that is usually empty means the stage before it is.
+"""
+import queue
+import threading
+import time
+
+# Put in a queue after the last item
+_end = object()
+
+
+class StageQueue:
+    """
+    Bounded queue between two pipeline stages.
+    """
+    def __init__(self, name, maxsize):
+        """
+        Constructor.
+
+        Parameters
+        ----------
+        name (str)
+            Name of the queue, such as "read", to report it by
+        maxsize (int)
+            Max number of items waiting in the queue
+        """
+        self.name = name
+        self.maxsize = maxsize
+        self._queue = queue.Queue(maxsize)
+
+        # Number of items put, the total number waiting after each put, and
+        # the seconds the stages before and after the queue spent waiting
+        # for room and for items
+        self.puts = 0
+        self._waiting = 0
+        self.producer_wait = 0.0
+        self.consumer_wait = 0.0
+
+    def __len__(self):
+        return self._queue.qsize()
+
+    def put(self, item):
+        """
+        Add an item, waiting for room if the queue is full.
+        """
+        try:
+            self._queue.put_nowait(item)
+        except queue.Full:
+            start = time.perf_counter()
+            self._queue.put(item)
+            self.producer_wait += time.perf_counter() - start
+
+        self.puts += 1
+        self._waiting += self._queue.qsize()
+
+    def get(self):
+        """
+        Remove the next item, waiting for one if the queue is empty.
+        """
+        try:
+            return self._queue.get_nowait()
+        except queue.Empty:
+            start = time.perf_counter()
+            item = self._queue.get()
+            self.consumer_wait += time.perf_counter() - start
+            return item
+
+    def occupancy(self):
+        """
+        Get the mean fraction of the queue that was full.
+        """
+        return self._waiting / float(self.puts * self.maxsize) if self.puts else 0.0
+
+    def stats(self):
+        """
+        Get the queue's occupancy and wait times.
+
+        Returns
+        -------
+        Dict of the max size, mean occupancy (0 to 1) and seconds the stages
+        before and after the queue waited
+        """
+        return {"maxsize": self.maxsize, "occupancy": round(self.occupancy(), 3),
+                "producer_wait_sec": round(self.producer_wait, 3),
+                "consumer_wait_sec": round(self.consumer_wait, 3)}
+
+    def summary(self):
+        """
+        Format the queue's occupancy and wait times.
+        """
+        return "%s queue: %.0f%% full, waited %.1f sec for room and %.1f sec for items" % (
+            self.name, 100.0 * self.occupancy(), self.producer_wait, self.consumer_wait)
+
+    def _drain(self):
+        """
+        Internal method to discard the items waiting.
+        """
+        try:
+            while True:
+                self._queue.get_nowait()
+        except queue.Empty:
+            pass
+
+
+class _Error:
+    """
+    Exception raised by a background stage, to raise in the next stage.
+    """
+    def __init__(self, exception):
+        self.exception = exception
+
+
+def read_ahead(iterable, stage_queue, metrics=None):
+    """
+    Get the items of an iterable in a background thread, up to the size of
+    the queue ahead of when they are needed, such as to read and clean up
+    documents while others are annotated. An exception raised getting the
+    items is raised where they are used. Closing the generator stops the
+    thread.
+
+    Parameters
+    ----------
+    iterable (iterable)
+        Items to get
+    stage_queue (StageQueue)
+        Queue to keep the items in until needed
+    metrics (Metrics)
+        Optional Metrics to add the time spent waiting for items to, as the
+        "idle" stage
+
+    Returns
+    -------
+    Generator of the items, in order
+    """
+    stop = threading.Event()
+    thread = threading.Thread(target=_read, args=(iterable, stage_queue, stop),
+                              name="%s stage" % stage_queue.name, daemon=True)
+    thread.start()
+    try:
+        while True:
+            waited = stage_queue.consumer_wait
+            item = stage_queue.get()
+            if metrics and stage_queue.consumer_wait > waited:
+                metrics.add_time("idle", stage_queue.consumer_wait - waited)
+
+            if item is _end:
+                return
+            if isinstance(item, _Error):
+                raise item.exception
+            yield item
+    finally:
+        # Make room for the item the thread may be waiting to put, so that it
+        # sees it should stop
+        stop.set()
+        while thread.is_alive():
+            stage_queue._drain()
+            thread.join(0.01)
+
+
+def _read(iterable, stage_queue, stop):
+    """
+    Internal function to put the items of an iterable in a queue until
+    stopped, in the read_ahead thread.
+    """
+    try:
+        for item in iterable:
+            if stop.is_set():
+                return
+            stage_queue.put(item)
+    except BaseException as e:
+        stage_queue.put(_Error(e))
+        return
+    stage_queue.put(_end)
+
+
+class BackgroundStage:
+    """
+    Run a function on items in a background thread, in the order they are
+    put, such as to merge and save the terms found in documents while more
+    are annotated.
+
+    Use it as a context manager: leaving the with block waits for the items
+    already put to be done, even when leaving on an exception, and raises
+    any exception the function raised.
+    """
+    def __init__(self, function, stage_queue, metrics=None):
+        """
+        Constructor. Starts the thread.
+
+        Parameters
+        ----------
+        function (callable)
+            Function to call with the arguments of each put
+        stage_queue (StageQueue)
+            Queue to keep the items in until the function is called on them,
+            or None to call it right away in this thread instead
+        metrics (Metrics)
+            Optional Metrics to add the time spent waiting for room in the
+            queue to, as the "idle" stage
+        """
+        self.function = function
+        self.queue = stage_queue
+        self.metrics = metrics
+        self._error = None
+        self._thread = None
+        if stage_queue is not None:
+            self._thread = threading.Thread(target=self._run, name="%s stage" % stage_queue.name, daemon=True)
+            self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self._thread is None:
+            return
+        self.queue.put(_end)
+        self._thread.join()
+        if exc_type is None and self._error is not None:
+            raise self._error
+
+    def put(self, *args):
+        """
+        Call the function with these arguments in the background, waiting for
+        room in the queue if it is full. Raises the exception the function
+        raised on an earlier item, if any.
+        """
+        if self._thread is None:
+            self.function(*args)
+            return
+        if self._error is not None:
+            raise self._error
+
+        waited = self.queue.producer_wait
+        self.queue.put(args)
+        if self.metrics and self.queue.producer_wait > waited:
+            self.metrics.add_time("idle", self.queue.producer_wait - waited)
+
+    def _run(self):
+        """
+        Internal method to call the function on each item, in the thread.
+        After an exception, the rest are discarded so put never waits.
+        """
+        while True:
+            args = self.queue.get()
+            if args is _end:
+                return
+            if self._error is None:
+                try:
+                    self.function(*args)
+                except BaseException as e:
+                    self._error = e
@@ -0,0 +1,641 @@
+"""
+Classes to record and query which documents each concept was found in.
+
+The annotate_docs.py output only keeps how often each term was found across
+the whole corpus. Postings also keep which documents each concept (CUI) and
+each term was found in, as sparse document x CUI and document x term
+matrices in compressed sparse row (CSR) form, saved as a NumPy .npz file.
+Queries such as document frequency, the concepts that most often appear in
+the same documents as a concept, and sample documents, run on the arrays in
+NumPy, in seconds even over millions of documents.
+
+The PostingsWriter class records the postings while annotating. The IDs
+found in each document are appended to files next to the .npz file as they
+are found, rather than kept in memory, and can be picked up again when an
+interrupted run is resumed. The .npz file is written when annotation is done.
+
+The PostingsBuffer class keeps the postings of a shard of documents in
+memory, such as in a worker process, for the PostingsWriter to merge.
+
+The Postings class loads an .npz file and answers queries.
+
+Arrays in the .npz file:
+- cuis, names: CUI and concept name of each CUI column
+- term_cuis, term_texts: CUI column and lowercase text of each term column
+- cui_indptr, cui_indices: CSR document x CUI matrix
+- term_indptr, term_indices: CSR document x term matrix
+- first_row: CSV row number of the first document (row 0 of the matrices)
+"""
+from array import array
+import json
+import os
+import random
+import sys
+
+import numpy as np
+
+
+class PostingsBuffer:
+    """
+    Postings of documents kept in memory.
+    """
+    def __init__(self):
+        """
+        Constructor.
+        """
+        # Column IDs of CUIs, and of terms indexed by CUI column and
+        # lowercase text
+        self.cuis = dict()
+        self.terms = dict()
+
+        # Concept names in CUI column order
+        self._names = list()
+
+        # Sorted CUI and term columns of each document
+        self._docs = list()
+
+    def __len__(self):
+        """
+        Number of documents.
+        """
+        return len(self._docs)
+
+    def start(self):
+        """
+        Start over, discarding the postings added so far.
+        """
+        self.pop()
+
+    def add_doc(self, terms):
+        """
+        Add the terms found in a document.
+
+        Parameters
+        ----------
+        terms (dict)
+            Normalized terms found in the document, indexed by CUID
+        """
+        self._docs.append(self._columns(terms))
+
+    def pop(self):
+        """
+        Get the postings added so far and start over, such as to send those
+        of a shard in a worker process to its parent.
+
+        Returns
+        -------
+        Tuple of the CUIs and names, the terms, and the columns of each
+        document, for PostingsWriter.merge
+        """
+        cuis = list(zip(self.cuis, self._names))
+        shard = (cuis, list(self.terms), self._docs)
+        self.cuis = dict()
+        self.terms = dict()
+        self._names = list()
+        self._docs = list()
+        return shard
+
+    def _columns(self, terms):
+        """
+        Internal method to get the sorted CUI and term columns of a
+        document's terms, adding new CUIs and terms.
+        """
+        cui_ids = set()
+        term_ids = set()
+        for cuid, obj in terms.items():
+            # Concepts whose terms were all discarded weren't found
+            if not obj["terms"]:
+                continue
+
+            cui_id = self.cuis.get(cuid)
+            if cui_id is None:
+                cui_id = self._add_cui(cuid, obj["name"])
+            cui_ids.add(cui_id)
+
+            for term in obj["terms"]:
+                key = (cui_id, term["text"].lower())
+                term_id = self.terms.get(key)
+                if term_id is None:
+                    term_id = self._add_term(key)
+                term_ids.add(term_id)
+
+        return sorted(cui_ids), sorted(term_ids)
+
+    def _add_cui(self, cuid, name):
+        """
+        Internal method to add a CUI column.
+        """
+        cui_id = self.cuis[cuid] = len(self.cuis)
+        self._names.append(name)
+        return cui_id
+
+    def _add_term(self, key):
+        """
+        Internal method to add a term column.
+        """
+        term_id = self.terms[key] = len(self.terms)
+        return term_id
+
+
+class PostingsWriter(PostingsBuffer):
+    """
+    Record postings to files while annotating, and save them as an .npz file.
+    """
+    def __init__(self, filename, first_row=0):
+        """
+        Constructor.
+
+        Parameters
+        ----------
+        filename (str)
+            .npz file to write; the postings are recorded in files next to
+            it with ".keys", ".ids" and ".docs" appended
+        first_row (int)
+            CSV row number of the first document annotated
+        """
+        super().__init__()
+        self.filename = filename
+        self.first_row = first_row
+
+        # New CUIs and terms, each document's columns, and the number of CUI
+        # and term columns of each document
+        self.keys_file = filename + ".keys"
+        self.ids_file = filename + ".ids"
+        self.docs_file = filename + ".docs"
+
+        self._keys = None
+        self._ids = None
+        self._doc_lengths = None
+        self._n_docs = 0
+
+    def __len__(self):
+        """
+        Number of documents.
+        """
+        return self._n_docs
+
+    def start(self):
+        """
+        Start recording, discarding the files of any previous run.
+        """
+        self.close()
+        self.remove()
+        self._open("w")
+
+    def resume(self, docs):
+        """
+        Continue recording the postings of an interrupted run, after the
+        documents it finished.
+
+        Parameters
+        ----------
+        docs (int)
+            Number of documents that were annotated before the checkpoint
+        """
+        self.close()
+        if not all(os.path.exists(filename) for filename in (self.keys_file, self.ids_file, self.docs_file)):
+            if docs:
+                raise RuntimeError("%s is missing the postings of the documents already annotated" % self.docs_file)
+            self.start()
+            return
+
+        # Keys are written before the IDs that use them, so any keys after
+        # the checkpoint are unused but harmless. An incomplete last line is
+        # dropped.
+        size = 0
+        with open(self.keys_file, "r", encoding="utf-8") as f:
+            for line in f:
+                if not line.endswith("\n"):
+                    break
+                key = json.loads(line)
+                if key[0] == "cui":
+                    self._add_cui(key[1], key[2])
+                else:
+                    self._add_term((key[1], key[2]))
+                size += len(line.encode("utf-8"))
+
+        lengths = array("I")
+        with open(self.docs_file, "rb") as f:
+            lengths.frombytes(f.read(8 * docs))
+        if sys.byteorder == "big":
+            lengths.byteswap()
+        if len(lengths) < 2 * docs:
+            raise RuntimeError("%s has the postings of fewer than %d documents" % (self.docs_file, docs))
+
+        # Drop the documents after the checkpoint
+        for filename, length in ((self.keys_file, size), (self.ids_file, 4 * sum(lengths)),
+                                 (self.docs_file, 8 * docs)):
+            with open(filename, "r+b") as f:
+                f.truncate(length)
+
+        self._n_docs = docs
+        self._open("a")
+
+    def add_doc(self, terms):
+        """
+        Record the terms found in a document.
+
+        Parameters
+        ----------
+        terms (dict)
+            Normalized terms found in the document, indexed by CUID
+        """
+        cui_ids, term_ids = self._columns(terms)
+        self._write([(cui_ids, term_ids)])
+
+    def merge(self, shard):
+        """
+        Record the documents of a PostingsBuffer.
+
+        Parameters
+        ----------
+        shard (tuple)
+            Postings from PostingsBuffer.pop
+        """
+        cuis, terms, docs = shard
+
+        cui_map = list()
+        for cuid, name in cuis:
+            cui_id = self.cuis.get(cuid)
+            cui_map.append(self._add_cui(cuid, name) if cui_id is None else cui_id)
+
+        term_map = list()
+        for cui, text in terms:
+            key = (cui_map[cui], text)
+            term_id = self.terms.get(key)
+            term_map.append(self._add_term(key) if term_id is None else term_id)
+
+        self._write([(sorted(cui_map[i] for i in cui_ids), sorted(term_map[i] for i in term_ids))
+                     for cui_ids, term_ids in docs])
+
+    def finish(self):
+        """
+        Save the postings as an .npz file, written under a temporary name
+        and then renamed. The recording files are kept until remove is
+        called, once the checkpoint they match is no longer needed.
+        """
+        self.close()
+
+        lengths = np.fromfile(self.docs_file, dtype="<u4").reshape(-1, 2)
+        ids = np.fromfile(self.ids_file, dtype="<u4")
+
+        # Each document's CUI columns are followed by its term columns
+        is_term = np.repeat(np.tile(np.array([False, True]), len(lengths)), lengths.ravel())
+        cui_matrix = _Matrix(_indptr(lengths[:, 0]), ids[~is_term].astype(np.int32), len(self.cuis))
+        term_matrix = _Matrix(_indptr(lengths[:, 1]), ids[is_term].astype(np.int32), len(self.terms))
+        del ids, is_term
+
+        term_keys = list(self.terms)
+        arrays = {
+            "cuis": np.array(list(self.cuis), dtype=str),
+            "names": np.array(self._names, dtype=str),
+            "term_cuis": np.array([cui for cui, _ in term_keys], dtype=np.int32),
+            "term_texts": np.array([text for _, text in term_keys], dtype=str),
+            "first_row": np.array(self.first_row, dtype=np.int64),
+        }
+        arrays.update(cui_matrix.to_arrays("cui"))
+        arrays.update(term_matrix.to_arrays("term"))
+
+        tmp_file = self.filename + ".tmp"
+        with open(tmp_file, "wb") as f:
+            np.savez(f, **arrays)
+        os.replace(tmp_file, self.filename)
+
+    def close(self):
+        """
+        Close the recording files.
+        """
+        for f in (self._keys, self._ids, self._doc_lengths):
+            if f:
+                f.close()
+        self._keys = self._ids = self._doc_lengths = None
+
+    def remove(self):
+        """
+        Delete the recording files.
+        """
+        for filename in (self.keys_file, self.ids_file, self.docs_file):
+            if os.path.exists(filename):
+                os.remove(filename)
+
+    def _open(self, mode):
+        """
+        Internal method to open the recording files.
+        """
+        self._keys = open(self.keys_file, mode, encoding="utf-8")
+        self._ids = open(self.ids_file, mode + "b")
+        self._doc_lengths = open(self.docs_file, mode + "b")
+
+    def _add_cui(self, cuid, name):
+        """
+        Internal method to add a CUI column and record it.
+        """
+        if self._keys:
+            self._keys.write(json.dumps(["cui", cuid, name], ensure_ascii=False) + "\n")
+        return super()._add_cui(cuid, name)
+
+    def _add_term(self, key):
+        """
+        Internal method to add a term column and record it.
+        """
+        if self._keys:
+            self._keys.write(json.dumps(["term", key[0], key[1]], ensure_ascii=False) + "\n")
+        return super()._add_term(key)
+
+    def _write(self, docs):
+        """
+        Internal method to append the columns of documents. The files are
+        flushed so they are at least as far along as the checkpoint journal,
+        which is written next.
+        """
+        ids = array("I")
+        lengths = array("I")
+        for cui_ids, term_ids in docs:
+            ids.extend(cui_ids)
+            ids.extend(term_ids)
+            lengths.append(len(cui_ids))
+            lengths.append(len(term_ids))
+
+        self._keys.flush()
+        self._ids.write(_little_endian(ids).tobytes())
+        self._ids.flush()
+        self._doc_lengths.write(_little_endian(lengths).tobytes())
+        self._doc_lengths.flush()
+        self._n_docs += len(docs)
+
+
+class Postings:
+    """
+    Query the documents that concepts and terms were found in.
+    """
+    def __init__(self, filename):
+        """
+        Constructor.
+
+        Parameters
+        ----------
+        filename (str)
+            .npz file written by PostingsWriter
+        """
+        with np.load(filename, allow_pickle=False) as data:
+            self.cuis = data["cuis"].tolist()
+            self.names = data["names"].tolist()
+            self.first_row = int(data["first_row"])
+            self._term_cuis = data["term_cuis"]
+            self._term_texts = data["term_texts"].tolist()
+            self._cui_matrix = _Matrix.from_arrays(data, "cui", len(self.cuis))
+            self._term_matrix = _Matrix.from_arrays(data, "term", len(self._term_texts))
+
+        self._cui_ids = {cuid: i for i, cuid in enumerate(self.cuis)}
+        self._term_ids = None
+
+    def __len__(self):
+        """
+        Number of documents.
+        """
+        return len(self._cui_matrix.indptr) - 1
+
+    def __contains__(self, cuid):
+        return cuid in self._cui_ids
+
+    def name(self, cuid):
+        """
+        Get the name of a concept.
+        """
+        return self.names[self._cui_ids[cuid]]
+
+    def doc_frequency(self, cuid, text=None):
+        """
+        Get the number of documents a concept, or one of its terms, was
+        found in.
+
+        Parameters
+        ----------
+        cuid (str)
+            Concept ID
+        text (str)
+            Optional text of a term of the concept, case insensitive
+
+        Returns
+        -------
+        Number of documents
+        """
+        matrix, column = self._column(cuid, text)
+        return 0 if column is None else matrix.column_count(column)
+
+    def doc_frequencies(self):
+        """
+        Get the number of documents each concept was found in.
+
+        Returns
+        -------
+        Dict of the number of documents indexed by CUID, most frequent first
+        """
+        counts = np.diff(self._cui_matrix.column_indptr)
+        order = np.argsort(-counts, kind="stable")
+        return {self.cuis[i]: int(counts[i]) for i in order}
+
+    def term_frequencies(self, cuid):
+        """
+        Get the number of documents each term of a concept was found in.
+
+        Parameters
+        ----------
+        cuid (str)
+            Concept ID
+
+        Returns
+        -------
+        Dict of the number of documents indexed by lowercase term text, most
+        frequent first
+        """
+        cui_id = self._cui_ids.get(cuid)
+        columns = np.flatnonzero(self._term_cuis == cui_id) if cui_id is not None else []
+        counts = {self._term_texts[i]: self._term_matrix.column_count(i) for i in columns}
+        return dict(sorted(counts.items(), key=lambda item: -item[1]))
+
+    def docs(self, cuid, text=None):
+        """
+        Get the documents a concept, or one of its terms, was found in.
+
+        Parameters
+        ----------
+        cuid (str)
+            Concept ID
+        text (str)
+            Optional text of a term of the concept, case insensitive
+
+        Returns
+        -------
+        Array of the CSV row numbers of the documents, in order
+        """
+        matrix, column = self._column(cuid, text)
+        if column is None:
+            return np.zeros(0, dtype=np.int64)
+        return matrix.column(column).astype(np.int64) + self.first_row
+
+    def sample_docs(self, cuid, n=10, text=None, seed=None):
+        """
+        Get a random sample of the documents a concept, or one of its terms,
+        was found in.
+
+        Parameters
+        ----------
+        cuid (str)
+            Concept ID
+        n (int)
+            Max number of documents
+        text (str)
+            Optional text of a term of the concept, case insensitive
+        seed (int)
+            Optional random seed, for the same sample every time
+
+        Returns
+        -------
+        List of the CSV row numbers of the documents, in order
+        """
+        docs = self.docs(cuid, text)
+        if len(docs) <= n:
+            return docs.tolist()
+        return sorted(int(docs[i]) for i in random.Random(seed).sample(range(len(docs)), n))
+
+    def cooccurring(self, cuid, top=10):
+        """
+        Get the concepts found in the most documents with a concept.
+
+        Parameters
+        ----------
+        cuid (str)
+            Concept ID
+        top (int)
+            Max number of concepts
+
+        Returns
+        -------
+        List of (CUID, number of documents) tuples, most documents first
+        """
+        cui_id = self._cui_ids.get(cuid)
+        if cui_id is None:
+            return list()
+
+        counts = self._cui_matrix.row_column_counts(self._cui_matrix.column(cui_id))
+        counts[cui_id] = 0
+
+        # Ties in the order the concepts were first found
+        top = min(top, np.count_nonzero(counts))
+        columns = np.argsort(-counts, kind="stable")[:top]
+        return [(self.cuis[i], int(counts[i])) for i in columns]
+
+    def _column(self, cuid, text):
+        """
+        Internal method to get the matrix and column of a concept or term, or
+        a None column if it wasn't found.
+        """
+        cui_id = self._cui_ids.get(cuid)
+        if text is None or cui_id is None:
+            return self._cui_matrix, cui_id
+
+        if self._term_ids is None:
+            self._term_ids = {(cui, text): i for i, (cui, text) in
+                              enumerate(zip(self._term_cuis.tolist(), self._term_texts))}
+        return self._term_matrix, self._term_ids.get((cui_id, text.lower()))
+
+
+class _Matrix:
+    """
+    Sparse CSR matrix of the columns found in each document, with the
+    transposed (CSC) index of the rows in each column.
+    """
+    def __init__(self, indptr, indices, n_columns, column_indptr=None, column_rows=None):
+        self.indptr = indptr
+        self.indices = indices
+        self.n_columns = n_columns
+
+        if column_rows is None:
+            # Sort the entries by column and then row, as one int64 key
+            # (several times faster than a stable argsort)
+            n_rows = len(indptr) - 1
+            keys = indices.astype(np.int64) * n_rows
+            keys += np.repeat(np.arange(n_rows, dtype=np.int64), np.diff(indptr))
+            keys.sort()
+            column_rows = (keys % max(n_rows, 1)).astype(np.int32)
+            column_indptr = _indptr(self.column_counts())
+        self.column_indptr = column_indptr
+        self.column_rows = column_rows
+
+    @classmethod
+    def from_arrays(cls, data, prefix, n_columns):
+        """
+        Load a matrix saved with to_arrays.
+        """
+        return cls(data[prefix + "_indptr"], data[prefix + "_indices"], n_columns,
+                   data[prefix + "_column_indptr"], data[prefix + "_column_rows"])
+
+    def to_arrays(self, prefix):
+        """
+        Get the arrays to save, named with a prefix.
+        """
+        return {prefix + "_indptr": self.indptr, prefix + "_indices": self.indices,
+                prefix + "_column_indptr": self.column_indptr, prefix + "_column_rows": self.column_rows}
+
+    def column_counts(self):
+        """
+        Number of rows in each column.
+        """
+        return np.bincount(self.indices, minlength=self.n_columns)
+
+    def column_count(self, column):
+        """
+        Number of rows in a column.
+        """
+        return int(self.column_indptr[column + 1] - self.column_indptr[column])
+
+    def column(self, column):
+        """
+        Rows in a column, in order.
+        """
+        return self.column_rows[self.column_indptr[column]:self.column_indptr[column + 1]]
+
+    def row_column_counts(self, rows, block_size=1 << 20):
+        """
+        Number of the given rows in each column.
+        """
+        indptr = self.indptr
+        starts = indptr[rows]
+        lengths = indptr[rows + 1] - starts
+
+        if lengths.sum() <= 4 * block_size:
+            # Gather the rows' entries, without a Python loop over the rows
+            offsets = np.repeat(starts - np.cumsum(lengths) + lengths, lengths)
+            positions = offsets + np.arange(len(offsets))
+            return np.bincount(self.indices[positions], minlength=self.n_columns)
+
+        # Too many entries to gather at once, so go through all rows a block
+        # at a time and count those selected
+        selected = np.zeros(len(indptr) - 1, dtype=bool)
+        selected[rows] = True
+        counts = np.zeros(self.n_columns, dtype=np.int64)
+        for start in range(0, len(selected), block_size):
+            end = min(start + block_size, len(selected))
+            entries = np.repeat(selected[start:end], np.diff(indptr[start:end + 1]))
+            counts += np.bincount(self.indices[indptr[start]:indptr[end]][entries], minlength=self.n_columns)
+        return counts
+
+
+def _indptr(lengths):
+    """
+    Get the CSR index pointers of rows of the given lengths.
+    """
+    indptr = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=indptr[1:])
+    return indptr
+
+
+def _little_endian(values):
+    """
+    Get a copy of an array in little-endian byte order, for saving.
+    """
+    if sys.byteorder == "big":
+        values = array(values.typecode, values)
+        values.byteswap()
+    return values
@@ -2,59 +2,143 @@
 Class for invoking ScispaCy.
 
 The SciSpacyAnnotator class lets you load ScispaCy once and then repeatedly
-invoke it to annotate documents.
+invoke it to annotate documents. It loads from a snapshot written by
+build_snapshot.py in seconds rather than minutes.
 """
-from collections import defaultdict
+from collections import defaultdict, deque
+import copy
+from itertools import islice
+import time
 
 import spacy
 from scispacy.linking import EntityLinker
 
+from lib.mention_cache import MentionCache
+from lib.metrics import timed
+from lib.normalizer import clean_mention
+from lib.score_histogram import new_histogram
+from lib.snapshot import load_snapshot
+
+# Settings of each scispacy linker, scispacy's defaults spelled out so that
+# linkers made directly and through add_pipe link the same way
+_linker_settings = dict(resolve_abbreviations=True, k=30, threshold=0.7, no_definition_threshold=0.95,
+                        filter_for_definitions=True, max_entities_per_mention=5)
+
 
 class SciSpacyAnnotator:
     """
     Wrapper around ScispaCy for exporting terms.
     """
 
-    def __init__(self, linker="umls", model="en_core_sci_sm", threshold=0.7):
+    def __init__(self, linker="umls", model="en_core_sci_sm", threshold=0.7, mention_cache_size=100000,
+                 snapshot=None, score_floor=None, nlp=None, candidate_generators=None):
         """
         Constructor.
 
         Parameters
         ----------
-        linker (str)
-            Which ScispaCy thesaurus to load
+        linker (str or list of str)
+            Which ScispaCy thesaurus to load, or a list of them to link each
+            entity to all of them. With more than one, the CUIDs returned are
+            prefixed by the thesaurus name, such as "umls:C0020538".
         model (str)
             Which ScispaCy model to load (small/medium/large)
         threshold (float)
             Min score to keep a term
+        mention_cache_size (int)
+            Number of distinct mentions to cache each linker's candidates for
+            (0 to not cache)
+        snapshot (str)
+            Optional snapshot directory written by build_snapshot.py to load
+            the model and linkers from. The model is the snapshot's.
+        score_floor (float)
+            Optional min score to keep a term instead of threshold, lower than
+            any confidence the terms will be used with. Each term then has a
+            histogram of its "scores", so that the threshold can be applied
+            later (see score_histogram.py).
+        nlp (spacy.language.Language)
+            Optional spaCy pipeline that is already loaded, to use instead of
+            loading model, such as the offline stub in stub_linker.py
+        candidate_generators (dict)
+            Optional candidate generators indexed by linker name, to link with
+            nlp instead of loading the linkers' knowledge bases
         """
         self.threshold = threshold
+        self.score_floor = score_floor
+        self.model = model
+        self.linker_name = linker
         self.verbose = True
 
-        if self.verbose:
-            print("Loading", model)
+        # Optional AnnotationCache of annotated documents
+        self.cache = None
 
-        self.nlp = spacy.load(model)
+        # Optional Metrics to time the pipeline stages in
+        self.metrics = None
 
-        # Which terminology set to link to. Current choices:
+        # Optional TextChunker to split very long documents with
+        self.chunker = None
+
+        # Which terminology sets to link to. Current choices:
         # umls   - UMLS
         # mesh   - NIH MeSH
         # rxnorm - RxNorm
         # go     - Gene Ontology
         # hpo    - Human Phenotype Ontology
-        linker = linker
+        if isinstance(linker, str):
+            linker_names = [linker]
+        else:
+            linker_names = list(linker)
+
+        generators = None
+        if snapshot:
+            if self.verbose:
+                print("Loading snapshot", snapshot)
+            self.model, self.nlp, generators = load_snapshot(snapshot, linker_names)
+        elif nlp is not None:
+            self.nlp = nlp
+            generators = candidate_generators
+        else:
+            if self.verbose:
+                print("Loading", model)
+            self.nlp = spacy.load(model)
 
-        if self.verbose:
-            print("Loading %s linker..." % linker)
+        settings = dict(_linker_settings)
+        if score_floor is not None:
+            # The linker drops candidates below its own threshold
+            settings["threshold"] = score_floor
 
-        # Configure the scispacy pipeline
-        config = dict()
-        config["linker_name"] = linker
-        config["resolve_abbreviations"] = True
-        self.nlp.add_pipe("scispacy_linker", config=config)
+        # The linkers are disabled in the pipeline so that the documents are
+        # tokenized and tagged once, then each linker is run on them in turn
+        self.linkers = dict()
+        self.mention_caches = dict()
+        for name in linker_names:
+            if self.verbose:
+                print("Loading %s linker..." % name)
 
-        # Get the linker so we can resolve concept IDs
-        self.linker = self.nlp.get_pipe("scispacy_linker")
+            pipe_name = "scispacy_linker" if not self.linkers else "scispacy_linker_" + name
+            if generators:
+                # The linker is only ever called directly, so it doesn't need
+                # to be in the pipeline
+                self.linkers[name] = EntityLinker(nlp=self.nlp, name=pipe_name, candidate_generator=generators[name],
+                                                  **settings)
+            else:
+                # Configure the scispacy pipeline
+                config = dict(settings, linker_name=name)
+                self.nlp.add_pipe("scispacy_linker", name=pipe_name, config=config)
+                self.nlp.disable_pipe(pipe_name)
+
+                # Get the linker so we can resolve concept IDs
+                self.linkers[name] = self.nlp.get_pipe(pipe_name)
+
+            # Look up the candidates of repeated mentions only once
+            if mention_cache_size:
+                mention_cache = MentionCache(self.linkers[name].candidate_generator, max_size=mention_cache_size,
+                                             name=name)
+                self.linkers[name].candidate_generator = mention_cache
+                self.mention_caches[name] = mention_cache
+
+        # The first linker, for compatibility
+        self.linker = self.linkers[linker_names[0]]
 
     def annotate(self, text):
         """
@@ -69,36 +153,216 @@ class SciSpacyAnnotator:
         -------
         CUIDs with their names and term spellings
         """
-        terms = defaultdict(dict)
+        if self.cache is not None:
+            key = self._cache_key(text)
+            terms = self.cache.get(key)
+            if terms is None:
+                terms = next(self._annotate_texts([text], 1))
+                self.cache.put(key, terms)
+            return terms
 
         # Run ScispaCy
-        doc = self.nlp(text)
+        return next(self._annotate_texts([text], 1))
+
+    def annotate_many(self, texts, batch_size=32):
+        """
+        Annotate several texts with ScispaCy, streaming them through the
+        pipeline in batches.
+
+        Parameters
+        ----------
+        texts (iterable of str)
+            Texts to annotate
+        batch_size (int)
+            Number of texts to send through the pipeline at once
+
+        Returns
+        -------
+        Generator of CUIDs with their names and term spellings, one per text
+        in the same order as the texts
+        """
+        if self.cache is not None:
+            yield from self._annotate_cached(texts, batch_size)
+            return
+
+        yield from self._annotate_texts(texts, batch_size)
+
+    def _annotate_cached(self, texts, batch_size):
+        """
+        Internal generator like annotate_many that gets documents from the
+        cache when possible, and only sends the rest through ScispaCy.
+        """
+        texts = iter(texts)
+        while True:
+            batch = list(islice(texts, batch_size))
+            if not batch:
+                return
+
+            keys = [self._cache_key(text) for text in batch]
+            results = [None] * len(batch)
+
+            # Look up each distinct text once, then annotate the ones not
+            # cached
+            todo = dict()
+            for i, key in enumerate(keys):
+                if key in todo:
+                    todo[key].append(i)
+                    continue
+                results[i] = self.cache.get(key)
+                if results[i] is None:
+                    todo[key] = [i]
+
+            firsts = [indexes[0] for indexes in todo.values()]
+            for i, terms in zip(firsts, self._annotate_texts((batch[i] for i in firsts), batch_size)):
+                results[i] = terms
+                self.cache.put(keys[i], results[i])
+
+            # Duplicates within the batch get their own copy
+            for indexes in todo.values():
+                for i in indexes[1:]:
+                    results[i] = copy.deepcopy(results[indexes[0]])
+                    self.cache.hits += 1
+
+            self.cache.commit()
+            yield from results
+
+    def _annotate_texts(self, texts, batch_size):
+        """
+        Internal generator of the terms found in texts by the pipeline. With
+        a chunker, long texts are split into windows, the windows of all the
+        texts are sent through the pipeline in batches, and the terms of each
+        text's windows are put back together.
+        """
+        if self.chunker is None:
+            for doc in self._pipe(texts, batch_size):
+                yield self._extract(doc)
+            return
 
-        # Collect the concept IDs, terms, and scores
-        for ent in doc.ents:
-            for umls_ent in ent._.kb_ents:
-                score = umls_ent[1]
+        # Windows read by the pipeline but not yet processed
+        pending = deque()
 
-                # Skip those with low scores
-                if score < self.threshold:
+        def window_texts():
+            for text in texts:
+                windows = self.chunker.split(text)
+                if windows is None:
+                    pending.append((None, True))
+                    yield text
                     continue
 
-                # Get the term
-                obj = self.linker.kb.cui_to_entity[umls_ent[0]]
-
-                # Start a new concept ID if needed
-                if obj.concept_id not in terms:
-                    terms[obj.concept_id] = dict()
-                    terms[obj.concept_id]["name"] = obj.canonical_name
-                    terms[obj.concept_id]["terms"] = list()
-
-                # Add the term
-                d = dict()
-                d["text"] = ent.text
-                d["text"] = d["text"].replace("\r", " ").strip()
-                d["text"] = d["text"].replace("\n", " ").strip()
-                d["score"] = score
-                d["count"] = 1
-                terms[obj.concept_id]["terms"].append(d)
+                for i, window in enumerate(windows):
+                    pending.append((window, i == len(windows) - 1))
+                    yield window.text
+
+        terms = None
+        for doc in self._pipe(window_texts(), batch_size):
+            window, last = pending.popleft()
+            terms = self._extract(doc, window, terms)
+            if last:
+                yield terms
+                terms = None
+
+    def _pipe(self, texts, batch_size):
+        """
+        Internal method to tokenize and tag texts with the pipeline, timing
+        it if metrics are set.
+        """
+        docs = self.nlp.pipe(texts, batch_size=batch_size)
+        if self.metrics:
+            docs = timed(docs, self.metrics, "ner")
+        return docs
+
+    def _cache_key(self, text):
+        """
+        Internal method to get the cache key of a text. BatchAnnotator passes
+        texts already cleaned up by fixup, so the key is of the normalized text.
+        """
+        settings = [self.model, self.linker_name, self.threshold]
+        if self.score_floor is not None:
+            settings.append(self.score_floor)
+        if self.chunker and len(text) > self.chunker.window_size:
+            # Split documents can have different terms
+            settings += [self.chunker.window_size, self.chunker.overlap]
+
+        return self.cache.make_key(text, *settings)
+
+    def _extract(self, doc, window=None, terms=None):
+        """
+        Internal method to collect the terms from an annotated document.
+
+        Parameters
+        ----------
+        doc (spacy.tokens.Doc)
+            Document processed by the ScispaCy pipeline
+        window (Window)
+            If doc is a window of a longer document, the window, so that
+            only the entities that belong to it are collected
+        terms (dict)
+            Terms of the earlier windows of the document to add to
+
+        Returns
+        -------
+        CUIDs with their names and term spellings
+        """
+        if terms is None:
+            terms = defaultdict(dict)
+
+        ents = doc.ents
+        if window is not None:
+            ents = [ent for ent in ents if window.owns(ent)]
+
+        metrics = self.metrics
+        if metrics:
+            metrics.observe("entities_per_doc", len(ents))
+
+        threshold = self.threshold if self.score_floor is None else self.score_floor
+
+        for name, linker in self.linkers.items():
+            # Link the entities with this thesaurus
+            if metrics:
+                start = time.perf_counter()
+            linker(doc)
+            if metrics:
+                linked = time.perf_counter()
+                metrics.add_time("link", linked - start)
+
+            # Namespace the concept IDs if there is more than one thesaurus
+            prefix = name + ":" if len(self.linkers) > 1 else ""
+
+            # Collect the concept IDs, terms, and scores
+            for ent in ents:
+                text = None
+                if metrics:
+                    metrics.observe("candidates_per_entity", len(ent._.kb_ents))
+                for umls_ent in ent._.kb_ents:
+                    score = umls_ent[1]
+
+                    # Skip those with low scores
+                    if score < threshold:
+                        continue
+
+                    # Get the term
+                    obj = linker.kb.cui_to_entity[umls_ent[0]]
+                    cuid = prefix + obj.concept_id
+
+                    # Start a new concept ID if needed
+                    if cuid not in terms:
+                        terms[cuid] = dict()
+                        terms[cuid]["name"] = obj.canonical_name
+                        terms[cuid]["terms"] = list()
+
+                    # Add the term, cleaning its text once per entity
+                    if text is None:
+                        text = clean_mention(ent.text)
+                    d = dict()
+                    d["text"] = text
+                    d["score"] = score
+                    d["count"] = 1
+                    if self.score_floor is not None:
+                        d["scores"] = new_histogram(score)
+                    terms[cuid]["terms"].append(d)
+
+            # Time to look up the concepts and collect the terms
+            if metrics:
+                metrics.add_time("lookup", time.perf_counter() - linked)
 
         return terms
@@ -0,0 +1,101 @@
+"""
+Functions for histograms of the scores a term was found with.
+
+When annotating with a score floor, each term keeps a histogram of the
+scores of the times it was found, so that the counts at any confidence above
+the floor can be worked out later without annotating again:
+
+  "scores": {
+    "min": 0.6214,
+    "max": 0.8015,
+    "sum": 2.2244,
+    "buckets": {"0.62": 1, "0.80": 2}
+  }
+
+Scores are counted in buckets 0.01 wide, named by their lowest score, so
+counts are exact for confidences that are multiples of 0.01, such as those
+of the termset generator's slider. The mean score is sum / count. The sum is
+kept rather than the mean, rounded to 6 decimals, so that it is the same
+whatever order the histograms of a corpus are merged in.
+"""
+import math
+
+# Buckets per unit of score
+_resolution = 100
+
+# Tolerance for scores that are a multiple of the bucket width but not
+# exactly representable, such as 0.29 * 100 = 28.999999999999996
+_epsilon = 1e-9
+
+# Decimals the sums of scores are rounded to
+_sum_digits = 6
+
+
+def _bucket(score):
+    """
+    Internal function to get the name of the bucket of a score.
+    """
+    return "%.2f" % (int(score * _resolution + _epsilon) / float(_resolution))
+
+
+def new_histogram(score, count=1):
+    """
+    Make the histogram of a term found count times with the same score.
+
+    Parameters
+    ----------
+    score (float)
+        Score the term was found with
+    count (int)
+        Number of times it was found
+
+    Returns
+    -------
+    Histogram dict with the "min", "max" and "sum" of the scores and the
+    count in each of the "buckets"
+    """
+    return {"min": score, "max": score, "sum": round(round(score, _sum_digits) * count, _sum_digits),
+            "buckets": {_bucket(score): count}}
+
+
+def merge_histograms(a, b):
+    """
+    Combine the histograms of two sets of times a term was found.
+
+    Parameters
+    ----------
+    a (dict)
+        Histogram
+    b (dict)
+        Another histogram
+
+    Returns
+    -------
+    New histogram with the buckets in order of score
+    """
+    buckets = dict(a["buckets"])
+    for name, count in b["buckets"].items():
+        buckets[name] = buckets.get(name, 0) + count
+
+    return {"min": min(a["min"], b["min"]), "max": max(a["max"], b["max"]),
+            "sum": round(a["sum"] + b["sum"], _sum_digits), "buckets": dict(sorted(buckets.items()))}
+
+
+def count_at_least(histogram, confidence):
+    """
+    Count the times a term was found with at least a min score.
+
+    Parameters
+    ----------
+    histogram (dict)
+        Histogram of the term's scores
+    confidence (float)
+        Min score. If it isn't a multiple of 0.01, the times found with a
+        score in the same bucket are not counted.
+
+    Returns
+    -------
+    Number of times found with at least that score
+    """
+    lowest = "%.2f" % (max(math.ceil(confidence * _resolution - _epsilon), 0) / float(_resolution))
+    return sum(count for name, count in histogram["buckets"].items() if name >= lowest)
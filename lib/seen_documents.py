@@ -0,0 +1,166 @@
+"""
+Class to remember which documents have already been annotated.
+
+For incremental updates of a growing corpus, the SeenDocuments class keeps
+a fingerprint of each document annotated so far in a file next to the
+output, so that only new documents are annotated when the whole CSV is read
+again. The fingerprints are a multiset: a document that appears three times
+in the corpus is counted three times, and a fourth copy is new.
+
+Fingerprints are 64-bit hashes of the cleaned up text, kept in sorted arrays
+(12 bytes per distinct document), so millions of documents fit in memory.
+The chance of two different documents sharing a fingerprint is negligible
+(about 1 in 300,000 for 10 million documents).
+"""
+from array import array
+from bisect import bisect_left
+import hashlib
+from heapq import merge
+import os
+import sys
+
+# Identifies the file format
+_magic = b"TSSEEN1\n"
+
+
+class SeenDocuments:
+    """
+    Multiset of fingerprints of annotated documents.
+    """
+    def __init__(self, filename):
+        """
+        Constructor. Loads the fingerprints saved in filename, if any.
+
+        Parameters
+        ----------
+        filename (str)
+            File to load and save the fingerprints
+        """
+        self.filename = filename
+
+        # Sorted distinct fingerprints and how many times each was seen
+        self._hashes = array("Q")
+        self._counts = array("I")
+
+        # Times each fingerprint was seen again while filtering
+        self._used = None
+
+        # Fingerprints of the new documents
+        self._new = list()
+
+        # Docs skipped and new docs found by filter
+        self.skipped = 0
+        self.new = 0
+
+        if os.path.exists(filename):
+            self._load()
+
+    def __len__(self):
+        """
+        Number of documents seen, including new ones.
+        """
+        return sum(self._counts) + len(self._new)
+
+    @staticmethod
+    def fingerprint(text):
+        """
+        Get the fingerprint of a document.
+
+        Parameters
+        ----------
+        text (str)
+            Document text
+
+        Returns
+        -------
+        64-bit int hash of the text
+        """
+        return int.from_bytes(hashlib.blake2b(text.encode("utf-8"), digest_size=8).digest(), "little")
+
+    def filter(self, docs):
+        """
+        Skip the documents that have already been seen, and remember the rest.
+
+        Parameters
+        ----------
+        docs (iterable of str)
+            Documents of the whole corpus, in any order
+
+        Returns
+        -------
+        Generator of the new documents
+        """
+        hashes = self._hashes
+        counts = self._counts
+        self._used = array("I", bytes(4 * len(hashes)))
+        used = self._used
+        n = len(hashes)
+
+        for doc in docs:
+            h = self.fingerprint(doc)
+            i = bisect_left(hashes, h)
+            if i < n and hashes[i] == h and used[i] < counts[i]:
+                used[i] += 1
+                self.skipped += 1
+                continue
+
+            self._new.append(h)
+            self.new += 1
+            yield doc
+
+    def save(self):
+        """
+        Add the new documents to the seen ones and save them. The file is
+        written under a temporary name and then renamed.
+        """
+        hashes = array("Q")
+        counts = array("I")
+        new = sorted(self._new)
+        for fingerprint, count in merge(zip(self._hashes, self._counts), ((h, 1) for h in new)):
+            if hashes and hashes[-1] == fingerprint:
+                counts[-1] += count
+            else:
+                hashes.append(fingerprint)
+                counts.append(count)
+
+        tmp_file = self.filename + ".tmp"
+        with open(tmp_file, "wb") as f:
+            f.write(_magic)
+            f.write(len(hashes).to_bytes(8, "little"))
+            f.write(_little_endian(hashes).tobytes())
+            f.write(_little_endian(counts).tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_file, self.filename)
+
+        self._hashes = hashes
+        self._counts = counts
+        self._new = list()
+
+    def _load(self):
+        """
+        Internal method to load the fingerprints file.
+        """
+        with open(self.filename, "rb") as f:
+            if f.read(len(_magic)) != _magic:
+                raise RuntimeError("%s is not a seen documents file" % self.filename)
+            n = int.from_bytes(f.read(8), "little")
+            self._hashes.frombytes(f.read(8 * n))
+            self._counts.frombytes(f.read(4 * n))
+
+        if len(self._hashes) != n or len(self._counts) != n:
+            raise RuntimeError("%s is incomplete" % self.filename)
+
+        if sys.byteorder == "big":
+            self._hashes.byteswap()
+            self._counts.byteswap()
+
+
+def _little_endian(values):
+    """
+    Get a copy of an array in little-endian byte order, for saving.
+    """
+    if sys.byteorder == "big":
+        values = array(values.typecode, values)
+        values.byteswap()
+    return values
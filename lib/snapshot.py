@@ -0,0 +1,189 @@
+"""
+Functions to save ScispaCy and its linkers to a directory that loads fast.
+
+Loading ScispaCy with a linker reads the linker's knowledge base from a
+JSON-lines file of millions of concepts, its TF-IDF vectorizer and alias
+list, and its approximate nearest neighbors (ANN) index, which can take
+minutes. A snapshot keeps them ready to load in seconds:
+- nlp/: the spaCy model, saved with nlp.to_disk
+- <linker>/linker.pkl: the linker's knowledge base, vectorizer and aliases,
+  pickled together
+- <linker>/ann_index and tfidf_vectors_sparse.npz: the nmslib index and the
+  vectors it indexes, copied as is since nmslib indexes can't be pickled
+- snapshot.json: the model, the linkers, and the versions of the packages
+  that wrote the pickles, which must match when loading
+
+The annotator doesn't add ScispaCy's abbreviation detector to the pipeline,
+so there is no detector state to save. The linkers' settings aren't saved
+either; SciSpacyAnnotator makes them with the same settings either way.
+
+Snapshots contain pickles, so only load snapshots you built.
+"""
+import gc
+from importlib.metadata import PackageNotFoundError, version
+import json
+import os
+import pickle
+import shutil
+import sys
+
+import spacy
+from scispacy.candidate_generation import (CandidateGenerator, DEFAULT_PATHS, LinkerPaths,
+                                           load_approximate_nearest_neighbours_index)
+from scispacy.file_cache import cached_path
+
+# Packages whose versions must match for the pickles to load
+_packages = ["spacy", "scispacy", "scikit-learn", "nmslib"]
+
+# Names of the files in a snapshot
+_manifest = "snapshot.json"
+_linker_state = "linker.pkl"
+_ann_index = "ann_index"
+_tfidf_vectors = "tfidf_vectors_sparse.npz"
+
+
+def save_snapshot(directory, model="en_core_sci_sm", linkers=("umls",), verbose=True):
+    """
+    Load ScispaCy and its linkers from scratch and save them as a snapshot.
+    The snapshot is written next to directory and then renamed, so an
+    interrupted save leaves no partial snapshot.
+
+    Parameters
+    ----------
+    directory (str)
+        Directory to write the snapshot to. It must not exist yet.
+    model (str)
+        Which ScispaCy model to save (small/medium/large)
+    linkers (list of str)
+        Which ScispaCy thesauri to save linkers for
+    verbose (bool)
+        True to show each step
+
+    Returns
+    -------
+    void
+    """
+    if os.path.exists(directory):
+        raise ValueError("%s already exists" % directory)
+
+    tmp_dir = directory.rstrip("/\\") + ".tmp"
+    if os.path.exists(tmp_dir):
+        shutil.rmtree(tmp_dir)
+    os.makedirs(tmp_dir)
+
+    if verbose:
+        print("Saving", model)
+    spacy.load(model).to_disk(os.path.join(tmp_dir, "nlp"))
+
+    for name in linkers:
+        if verbose:
+            print("Saving %s linker..." % name)
+
+        linker_dir = os.path.join(tmp_dir, name)
+        os.makedirs(linker_dir)
+
+        generator = CandidateGenerator(name=name)
+        state = dict(kb=generator.kb, vectorizer=generator.vectorizer, aliases=generator.ann_concept_aliases_list)
+        with open(os.path.join(linker_dir, _linker_state), "wb") as f:
+            pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+        paths = DEFAULT_PATHS[name]
+        shutil.copyfile(cached_path(paths.ann_index), os.path.join(linker_dir, _ann_index))
+        shutil.copyfile(cached_path(paths.tfidf_vectors), os.path.join(linker_dir, _tfidf_vectors))
+
+    with open(os.path.join(tmp_dir, _manifest), "w", encoding="utf-8") as f:
+        json.dump({"model": model, "linkers": list(linkers), "versions": _versions()}, f, indent=2)
+
+    os.rename(tmp_dir, directory)
+
+
+def load_snapshot(directory, linkers=None):
+    """
+    Load ScispaCy and the candidate generators of its linkers from a
+    snapshot.
+
+    Parameters
+    ----------
+    directory (str)
+        Directory written by save_snapshot
+    linkers (list of str)
+        Which of the snapshot's linkers to load (default all)
+
+    Returns
+    -------
+    Tuple of the model name, the spaCy pipeline (without linkers), and a dict
+    of scispacy CandidateGenerators indexed by linker name
+    """
+    manifest = read_manifest(directory)
+    if linkers is None:
+        linkers = manifest["linkers"]
+    missing = [name for name in linkers if name not in manifest["linkers"]]
+    if missing:
+        raise ValueError("Snapshot %s has no %s linker (it has %s)" % (directory, ", ".join(missing),
+                                                                        ", ".join(manifest["linkers"])))
+
+    # The pickles need the same versions of the packages that wrote them
+    versions = _versions()
+    for package, saved in manifest["versions"].items():
+        if versions.get(package) != saved:
+            raise RuntimeError("Snapshot %s was built with %s %s but %s is installed. Build it again with "
+                               "build_snapshot.py." % (directory, package, saved, versions.get(package)))
+
+    nlp = spacy.load(os.path.join(directory, "nlp"))
+
+    generators = dict()
+    for name in linkers:
+        linker_dir = os.path.join(directory, name)
+
+        # Unpickling millions of objects is much faster without the garbage
+        # collector looking at them as they are made
+        gc.disable()
+        try:
+            with open(os.path.join(linker_dir, _linker_state), "rb") as f:
+                state = pickle.load(f)
+        finally:
+            gc.enable()
+
+        paths = LinkerPaths(ann_index=os.path.join(linker_dir, _ann_index), tfidf_vectorizer=None,
+                            tfidf_vectors=os.path.join(linker_dir, _tfidf_vectors), concept_aliases_list=None)
+        generators[name] = CandidateGenerator(ann_index=load_approximate_nearest_neighbours_index(paths),
+                                              tfidf_vectorizer=state["vectorizer"],
+                                              ann_concept_aliases_list=state["aliases"], kb=state["kb"])
+
+    return manifest["model"], nlp, generators
+
+
+def read_manifest(directory):
+    """
+    Read what a snapshot contains.
+
+    Parameters
+    ----------
+    directory (str)
+        Directory written by save_snapshot
+
+    Returns
+    -------
+    Dict with the "model" name, list of "linkers" and the "versions" of the
+    packages that wrote it
+    """
+    filename = os.path.join(directory, _manifest)
+    if not os.path.exists(filename):
+        raise ValueError("%s is not a snapshot written by build_snapshot.py" % directory)
+
+    with open(filename, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def _versions():
+    """
+    Internal function to get the versions of Python and the packages the
+    pickles depend on.
+    """
+    versions = {"python": "%d.%d" % sys.version_info[:2]}
+    for package in _packages:
+        try:
+            versions[package] = version(package)
+        except PackageNotFoundError:
+            versions[package] = None
+    return versions
@@ -0,0 +1,137 @@
+"""
+Offline stand-ins for a ScispaCy model and linker, for benchmarking.
+
+make_stub_annotator makes a real SciSpacyAnnotator from a blank spaCy
+pipeline, whose entity ruler finds the spellings of a synthetic vocabulary
+from synthetic_corpus.py, and a stub candidate generator that links them to
+their concepts without the UMLS knowledge base. Tokenizing, scispacy's
+EntityLinker, the mention cache and the concept lookups all run as they do
+with the real models, so only the NER model and the nearest neighbor search
+are left out.
+"""
+import zlib
+
+import spacy
+from scispacy.candidate_generation import MentionCandidate
+from scispacy.linking_utils import Entity
+
+from lib.scispacy_annotator import SciSpacyAnnotator
+from lib.synthetic_corpus import make_vocabulary
+
+
+class StubKnowledgeBase:
+    """
+    Knowledge base of a synthetic vocabulary, with the cui_to_entity dict
+    that the linker looks concepts up in.
+    """
+    def __init__(self, vocabulary):
+        """
+        Constructor.
+
+        Parameters
+        ----------
+        vocabulary: list
+            Concepts from make_vocabulary
+        """
+        # The linker drops candidates without a definition unless their
+        # score is very high
+        self.cui_to_entity = {cuid: Entity(cuid, name, spellings, definition="Synthetic concept " + name)
+                              for cuid, name, spellings, _ in vocabulary}
+
+
+class StubCandidateGenerator:
+    """
+    Stand-in for scispacy's CandidateGenerator that links the spellings of a
+    synthetic vocabulary to their concepts. Each spelling always gets the
+    same score, some below the linker's threshold.
+    """
+    def __init__(self, vocabulary):
+        """
+        Constructor.
+
+        Parameters
+        ----------
+        vocabulary: list
+            Concepts from make_vocabulary
+        """
+        self.kb = StubKnowledgeBase(vocabulary)
+
+        # Concept of each spelling, in lowercase
+        self._concepts = dict()
+        for cuid, _, spellings, _ in vocabulary:
+            for spelling in spellings:
+                self._concepts.setdefault(spelling.lower(), cuid)
+
+    def __call__(self, mention_texts, k):
+        """
+        Get the candidate concepts of mentions.
+
+        Parameters
+        ----------
+        mention_texts: list of str
+            Mention texts
+        k: int
+            Unused, for compatibility with CandidateGenerator
+
+        Returns
+        -------
+        List of candidates for each mention
+        """
+        batch_candidates = list()
+        for text in mention_texts:
+            key = " ".join(text.lower().split())
+            cuid = self._concepts.get(key)
+            if cuid is None:
+                batch_candidates.append([])
+                continue
+
+            score = 0.6 + (zlib.crc32(key.encode("utf-8")) % 4001) / 10000.0
+            batch_candidates.append([MentionCandidate(cuid, [key], [score])])
+
+        return batch_candidates
+
+
+def make_stub_pipeline(vocabulary):
+    """
+    Make a blank spaCy pipeline that finds the spellings of a synthetic
+    vocabulary as entities, in place of a ScispaCy model.
+
+    Parameters
+    ----------
+    vocabulary: list
+        Concepts from make_vocabulary
+
+    Returns
+    -------
+    spaCy pipeline
+    """
+    nlp = spacy.blank("en")
+    ruler = nlp.add_pipe("entity_ruler", config={"phrase_matcher_attr": "LOWER"})
+    ruler.add_patterns([{"label": "ENTITY", "pattern": spelling}
+                        for _, _, spellings, _ in vocabulary for spelling in spellings])
+
+    return nlp
+
+
+def make_stub_annotator(vocabulary=None, linker="umls", **kwargs):
+    """
+    Make a SciSpacyAnnotator that annotates a synthetic vocabulary offline.
+
+    Parameters
+    ----------
+    vocabulary: list
+        Concepts from make_vocabulary (default vocabulary if None)
+    linker: str
+        Name of the thesaurus to report
+    kwargs:
+        Other SciSpacyAnnotator arguments, such as threshold
+
+    Returns
+    -------
+    SciSpacyAnnotator
+    """
+    if vocabulary is None:
+        vocabulary = make_vocabulary()
+
+    return SciSpacyAnnotator(linker=linker, model="stub", nlp=make_stub_pipeline(vocabulary),
+                             candidate_generators={linker: StubCandidateGenerator(vocabulary)}, **kwargs)
@@ -0,0 +1,176 @@
+"""
+Functions to make synthetic notes and annotations for benchmarking.
+
+Real corpora have a few very common concepts (hypertension, shortness of
+breath) with thousands of spelling variants and a long tail of rare ones.
+These functions generate notes and ScispaCy-style results with that skew so
+the hot paths can be measured without medical notes or the UMLS linker.
+stub_linker.py annotates the synthetic notes offline.
+"""
+import csv
+import random
+import string
+
+
+def make_vocabulary(n_cuis=1000, max_variants=2000, skew=1.1, seed=0):
+    """
+    Make synthetic concepts with spelling variants.
+
+    Parameters
+    ----------
+    n_cuis: int
+        Number of concepts
+    max_variants: int
+        Number of spelling variants of the most common concept. Rarer
+        concepts get proportionally fewer (at least one).
+    skew: float
+        Zipf exponent of the concept frequencies
+    seed: int
+        Random seed
+
+    Returns
+    -------
+    List of (cuid, name, spellings, weight) tuples, most common first
+    """
+    rng = random.Random(seed)
+    vocabulary = list()
+    for rank in range(1, n_cuis + 1):
+        weight = 1.0 / rank ** skew
+        n_variants = max(1, int(max_variants * weight))
+        base = "".join(rng.choice(string.ascii_lowercase) for _ in range(rng.randint(4, 10)))
+
+        spellings = [base]
+        for i in range(1, n_variants):
+            if i % 10 == 0:
+                # Acronym
+                spellings.append(base[:3].upper() + "".join(rng.choice(string.ascii_uppercase) for _ in range(i % 4)))
+            else:
+                spellings.append("%s %s" % (rng.choice(["mild", "severe", "acute", "chronic", "h/o", base[:2]]), base + str(i)))
+
+        vocabulary.append(("C%07d" % rank, base.capitalize(), spellings, weight))
+
+    return vocabulary
+
+
+def make_annotations(n_docs=10000, terms_per_doc=20, vocabulary=None, seed=0):
+    """
+    Make synthetic per-document results in the format returned by
+    SciSpacyAnnotator.annotate.
+
+    Parameters
+    ----------
+    n_docs: int
+        Number of documents
+    terms_per_doc: int
+        Average number of terms in a document
+    vocabulary: list
+        Concepts from make_vocabulary (default vocabulary if None)
+    seed: int
+        Random seed
+
+    Returns
+    -------
+    Generator of term dicts indexed by CUID, one per document
+    """
+    if vocabulary is None:
+        vocabulary = make_vocabulary(seed=seed)
+
+    rng = random.Random(seed)
+    cum_weights = list()
+    total = 0.0
+    for concept in vocabulary:
+        total += concept[3]
+        cum_weights.append(total)
+
+    for _ in range(n_docs):
+        terms = dict()
+        n_terms = rng.randint(1, 2 * terms_per_doc - 1)
+        for cuid, name, spellings, _ in rng.choices(vocabulary, cum_weights=cum_weights, k=n_terms):
+            if cuid not in terms:
+                terms[cuid] = {"name": name, "terms": list()}
+
+            # Favor the first (most common) spellings
+            text = spellings[min(int(rng.expovariate(1.0) * len(spellings) / 4), len(spellings) - 1)]
+            terms[cuid]["terms"].append({"text": text, "score": round(rng.uniform(0.7, 1.0), 4), "count": 1})
+
+        yield terms
+
+
+def make_notes(n_docs=10000, words_per_doc=300, vocabulary=None, seed=0):
+    """
+    Make synthetic clinical note texts, mixing filler words with concept
+    spellings, line breaks and the non-ASCII quotes and dashes found in notes
+    pasted from word processors.
+
+    Parameters
+    ----------
+    n_docs: int
+        Number of documents
+    words_per_doc: int
+        Average number of words in a document
+    vocabulary: list
+        Concepts from make_vocabulary (default vocabulary if None)
+    seed: int
+        Random seed
+
+    Returns
+    -------
+    Generator of document texts
+    """
+    if vocabulary is None:
+        vocabulary = make_vocabulary(seed=seed)
+
+    rng = random.Random(seed)
+    cum_weights = list()
+    total = 0.0
+    for concept in vocabulary:
+        total += concept[3]
+        cum_weights.append(total)
+    filler = ["patient", "reports", "with", "and", "the", "of", "denies", "history", "on", "exam", "today",
+              "no", "was", "given", "plan:", "follow", "up", "in", "weeks.", "BP", "HR", "mg", "daily"]
+    specials = ["\xc2\x91", "\xc2\x92", "\xc2\x93", "\xc2\x94", "\u2013", "\u201c", "\u201d", "\r\n", "\n\n"]
+
+    for _ in range(n_docs):
+        n_words = rng.randint(words_per_doc // 2, words_per_doc * 3 // 2)
+        concepts = iter(rng.choices(vocabulary, cum_weights=cum_weights, k=n_words // 10 + 1))
+        words = list()
+        for _ in range(n_words):
+            r = rng.random()
+            if r < 0.1:
+                spellings = next(concepts, vocabulary[0])[2]
+                words.append(spellings[min(int(rng.expovariate(1.0) * len(spellings) / 4), len(spellings) - 1)])
+            elif r < 0.12:
+                words.append(rng.choice(specials))
+            else:
+                words.append(rng.choice(filler))
+
+        yield " ".join(words)
+
+
+def write_notes_csv(filename, n_docs=10000, words_per_doc=300, vocabulary=None, text_column="TEXT", seed=0):
+    """
+    Write synthetic notes to a CSV file, one document per row, as expected
+    by annotate_docs.py. Notes are written as they are generated, so the
+    corpus can be larger than memory.
+
+    Parameters
+    ----------
+    filename: str
+        CSV file to write
+    n_docs: int
+        Number of documents
+    words_per_doc: int
+        Average number of words in a document
+    vocabulary: list
+        Concepts from make_vocabulary (default vocabulary if None)
+    text_column: str
+        Name of the text column
+    seed: int
+        Random seed
+    """
+    with open(filename, "w", encoding="utf-8", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["ID", text_column])
+        for i, text in enumerate(make_notes(n_docs, words_per_doc, vocabulary, seed)):
+            writer.writerow([i, text])
+
@@ -0,0 +1,381 @@
+"""
+Class to accumulate the terms found by ScispaCy across many documents.
+
+The TermAccumulator class merges the spellings found for each concept ID
+(CUID), case insensitive, and keeps a count of how often each was found.
+Spellings are indexed by their lowercase text so that merging a term takes
+the same time no matter how many spellings a concept already has.
+
+A large corpus can have tens of millions of distinct spellings, so they are
+kept compactly: each spelling is one string, its concept's number followed
+by its lowercase text, that is both the index key and the text to output.
+The scores and counts are kept in arrays rather than one dict per spelling,
+and the original text is only kept when it isn't lowercase (acronyms).
+
+With a memory budget, the spellings are written to disk as a sorted run
+whenever they take more memory than the budget, and the runs are merged
+when the terms are saved, giving the same terms as if they had all been
+kept in memory.
+
+Terms found with a score floor have a histogram of their "scores", which
+are merged along with their counts (see score_histogram.py).
+"""
+from array import array
+from heapq import merge
+import json
+import os
+import shutil
+import sys
+import tempfile
+import weakref
+
+from lib.score_histogram import merge_histograms, new_histogram
+
+# Approximate memory used by each spelling besides its text: the index
+# entry, the ID, and the array and list items
+_term_bytes = 200
+
+# Approximate memory used by a spelling's score histogram
+_histogram_bytes = 400
+
+# Max number of runs on disk before they are merged into one, to not run
+# out of file handles when merging them
+max_runs = 64
+
+
+class TermAccumulator:
+    """
+    Accumulate term spellings and counts by CUID.
+    """
+    def __init__(self, memory_budget=None, spill_dir=None):
+        """
+        Constructor.
+
+        Parameters
+        ----------
+        memory_budget (int)
+            Optional approximate number of bytes of spellings to keep in
+            memory before writing them to disk
+        spill_dir (str)
+            Directory to write the spellings to (default system temp)
+        """
+        self.memory_budget = memory_budget
+        self.spill_dir = spill_dir
+
+        # Concepts, numbered in the order found
+        self._cuids = dict()
+        self._names = list()
+
+        # Start of the index keys of each concept's spellings: its number in
+        # fixed width hex, so keys sort by concept
+        self._prefixes = list()
+
+        # Spellings in memory, in the order found: the index key, the text
+        # if not the same as the lowercase text, the score of the first one
+        # found, the count and the score histogram if any
+        self._index = dict()
+        self._keys = list()
+        self._texts = list()
+        self._scores = array("d")
+        self._counts = array("q")
+        self._histograms = list()
+
+        # Number of spellings found before those in memory, to tell which
+        # was found first when merging runs
+        self._first = 0
+
+        # Sorted runs of spellings written to disk
+        self._runs = list()
+        self._run_dir = None
+        self._run_number = 0
+        self._bytes = 0
+
+    def __len__(self):
+        return len(self._cuids)
+
+    def __contains__(self, cuid):
+        return cuid in self._cuids
+
+    @property
+    def runs(self):
+        """
+        Number of sorted runs written to disk.
+        """
+        return len(self._runs)
+
+    def clear(self):
+        """
+        Remove all concepts and terms.
+        """
+        self._cuids.clear()
+        self._names.clear()
+        self._prefixes.clear()
+        self._clear_terms()
+        self._first = 0
+
+        self._runs = list()
+        if self._run_dir:
+            self._remove_runs()
+            self._run_dir = None
+
+    def add_concept(self, cuid, name):
+        """
+        Start a new concept ID if it isn't already known.
+
+        Parameters
+        ----------
+        cuid (str)
+            Concept ID
+        name (str)
+            Concept name
+        """
+        if cuid not in self._cuids:
+            self._add_concept(cuid, name)
+
+    def add_term(self, cuid, term):
+        """
+        Add a term to a concept, merging it with an existing spelling that
+        differs only by case. Lowercase spellings are favored over acronyms.
+
+        Parameters
+        ----------
+        cuid (str)
+            Concept ID, already added with add_concept
+        term (dict)
+            Term with "text", "score", "count" and optionally "scores"
+        """
+        self._add(self._prefixes[self._cuids[cuid]], term["text"], term["score"], term["count"], term.get("scores"))
+        self._check_budget()
+
+    def add_terms(self, terms):
+        """
+        Add terms in the annotate_docs.py output format, such as the terms of
+        a document or the accumulated terms of another run.
+
+        Parameters
+        ----------
+        terms (dict)
+            Terms indexed by CUID, with the concept "name" and a list of
+            "terms"
+        """
+        cuids = self._cuids
+        prefixes = self._prefixes
+        for cuid, obj in terms.items():
+            i = cuids.get(cuid)
+            if i is None:
+                i = self._add_concept(cuid, obj["name"])
+
+            prefix = prefixes[i]
+            for term in obj["terms"]:
+                self._add(prefix, term["text"], term["score"], term["count"], term.get("scores"))
+
+        self._check_budget()
+
+    def items(self):
+        """
+        Get the accumulated terms one concept at a time, merging any runs
+        written to disk.
+
+        Returns
+        -------
+        Generator of (CUID, concept) tuples in the order the concepts were
+        first found, each concept with its "name" and a list of "terms" in
+        the order they were first found
+        """
+        if not self._runs:
+            yield from self._memory_items()
+            return
+
+        spellings = self._merge_runs(self._runs)
+        spelling = next(spellings, None)
+        for i, cuid in enumerate(self._cuids):
+            prefix = self._prefixes[i]
+            found = list()
+            while spelling is not None and spelling[0].startswith(prefix):
+                found.append(spelling)
+                spelling = next(spellings, None)
+
+            found.sort(key=lambda spelling: spelling[2])
+            terms = list()
+            for key, text, _, score, count, histogram in found:
+                terms.append(_term(key[len(prefix):] if text is None else text, score, count, histogram))
+            yield cuid, {"name": self._names[i], "terms": terms}
+
+    def to_dict(self):
+        """
+        Get the accumulated terms in the annotate_docs.py output format.
+
+        Returns
+        -------
+        Dict indexed by CUID with the concept "name" and a list of "terms"
+        in the order they were first found
+        """
+        return dict(self.items())
+
+    def _memory_items(self):
+        """
+        Internal generator of the concepts when all spellings are in memory,
+        grouping them by concept in the order found without sorting.
+        """
+        found = [list() for _ in self._names]
+        for i, key in enumerate(self._keys):
+            found[int(key[:8], 16)].append(i)
+
+        for n, cuid in enumerate(self._cuids):
+            terms = list()
+            for i in found[n]:
+                text = self._texts[i]
+                terms.append(_term(self._keys[i][9:] if text is None else text, self._scores[i], self._counts[i],
+                                   self._histograms[i]))
+            yield cuid, {"name": self._names[n], "terms": terms}
+
+    def _add_concept(self, cuid, name):
+        """
+        Internal method to number a new concept.
+        """
+        i = self._cuids[sys.intern(cuid)] = len(self._names)
+        self._names.append(name)
+        self._prefixes.append("%08x:" % i)
+        return i
+
+    def _add(self, prefix, text, score, count, histogram=None):
+        """
+        Internal method to add a spelling of the concept with a prefix.
+        """
+        lower = text.lower()
+        key = prefix + lower
+        i = self._index.get(key)
+        if i is None:
+            self._index[key] = len(self._keys)
+            self._keys.append(key)
+            self._texts.append(None if text == lower else text)
+            self._scores.append(score)
+            self._counts.append(count)
+            self._histograms.append(histogram)
+            self._bytes += _term_bytes + len(key) + (_histogram_bytes if histogram is not None else 0)
+        else:
+            if histogram is not None or self._histograms[i] is not None:
+                self._histograms[i] = _merge_scores(self._histograms[i], self._scores[i], self._counts[i],
+                                                    histogram, score, count)
+            self._counts[i] += count
+            if text == lower:
+                # Keep lowercase
+                self._texts[i] = None
+
+    def _check_budget(self):
+        """
+        Internal method to write the spellings in memory to disk if they are
+        over budget.
+        """
+        if self.memory_budget is not None and self._bytes > self.memory_budget and self._keys:
+            self._spill()
+
+    def _spill(self):
+        """
+        Internal method to write the spellings in memory to a new sorted run
+        on disk, one JSON list per line, and forget them.
+        """
+        if self._run_dir is None:
+            self._run_dir = tempfile.mkdtemp(prefix="terms.", dir=self.spill_dir)
+            self._remove_runs = weakref.finalize(self, shutil.rmtree, self._run_dir, ignore_errors=True)
+
+        self._runs.append(self._write_run(self._sorted_spellings()))
+        self._first += len(self._keys)
+        self._clear_terms()
+
+        if len(self._runs) >= max_runs:
+            runs = self._runs
+            self._runs = [self._write_run(self._merge_runs(runs, memory=False))]
+            for filename in runs:
+                os.remove(filename)
+
+    def _write_run(self, spellings):
+        """
+        Internal method to write sorted spellings to a new run file, one
+        JSON list per line.
+
+        Returns
+        -------
+        Filename of the run
+        """
+        self._run_number += 1
+        filename = os.path.join(self._run_dir, "run%d.jsonl" % self._run_number)
+        with open(filename, "w", encoding="utf-8") as f:
+            f.writelines(json.dumps(spelling, ensure_ascii=False) + "\n" for spelling in spellings)
+        return filename
+
+    def _clear_terms(self):
+        """
+        Internal method to forget the spellings in memory.
+        """
+        self._index = dict()
+        self._keys = list()
+        self._texts = list()
+        self._scores = array("d")
+        self._counts = array("q")
+        self._histograms = list()
+        self._bytes = 0
+
+    def _sorted_spellings(self):
+        """
+        Internal generator of the spellings in memory sorted by key, as
+        [key, text, order found, score, count, histogram] lists.
+        """
+        keys = self._keys
+        for i in sorted(range(len(keys)), key=keys.__getitem__):
+            yield [keys[i], self._texts[i], self._first + i, self._scores[i], self._counts[i], self._histograms[i]]
+
+    def _merge_runs(self, runs, memory=True):
+        """
+        Internal generator of the spellings sorted by key, merging runs on
+        disk and, if memory is set, those in memory. Spellings with the same
+        key are combined as add would have: the score of the first found, the
+        total count, lowercase text if any was lowercase, and the merged score
+        histograms.
+        """
+        files = [open(filename, "r", encoding="utf-8") for filename in runs]
+        try:
+            sources = [map(json.loads, f) for f in files]
+            if memory:
+                sources.append(self._sorted_spellings())
+            spellings = merge(*sources, key=lambda spelling: spelling[0])
+
+            current = next(spellings, None)
+            for spelling in spellings:
+                if spelling[0] != current[0]:
+                    yield current
+                    current = spelling
+                    continue
+
+                first, other = (current, spelling) if current[2] < spelling[2] else (spelling, current)
+                current = [first[0], None if other[1] is None else first[1], first[2], first[3],
+                           current[4] + spelling[4],
+                           _merge_scores(current[5], current[3], current[4], spelling[5], spelling[3], spelling[4])]
+
+            if current is not None:
+                yield current
+        finally:
+            for f in files:
+                f.close()
+
+
+def _term(text, score, count, histogram):
+    """
+    Make a term of the output format.
+    """
+    term = {"text": text, "score": score, "count": count}
+    if histogram is not None:
+        term["scores"] = histogram
+    return term
+
+
+def _merge_scores(histogram, score, count, other, other_score, other_count):
+    """
+    Internal function to combine the score histograms of two sets of times
+    a spelling was found, or None if neither has one. A set without one has
+    all of its count at its score.
+    """
+    if histogram is None and other is None:
+        return None
+    return merge_histograms(histogram if histogram is not None else new_histogram(score, count),
+                            other if other is not None else new_histogram(other_score, other_count))
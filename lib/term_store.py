@@ -0,0 +1,398 @@
+"""
+Functions to save and load the terms found by annotate_docs.py.
+
+Terms are saved as JSON by default. For large corpora they can instead be
+saved to an SQLite database with one row per (CUI, spelling) and an index on
+the CUI, so that readers can look up a few concepts without loading the
+whole file. Both formats load back to the same dict, and can be read one
+concept at a time with iter_terms. Score histograms of terms found with a
+score floor are kept as JSON in SQLite files.
+"""
+import json
+import os
+import pathlib
+import sqlite3
+
+# Filename extensions of SQLite term files
+sqlite_extensions = (".sqlite", ".db")
+
+
+def is_sqlite(filename):
+    """
+    True if filename is an SQLite term file, based on its extension.
+    """
+    return filename.lower().endswith(sqlite_extensions)
+
+
+def save_terms(terms, filename, encoding="utf-8"):
+    """
+    Save terms to a JSON or SQLite file, depending on the extension.
+
+    Parameters
+    ----------
+    terms: dict or iterable
+        Terms indexed by CUID, with the concept "name" and a list of "terms",
+        or (CUID, concept) tuples such as from TermAccumulator.items, which
+        are written one concept at a time
+    filename: str
+        Output filename (.json, .sqlite or .db)
+    encoding: str
+        Encoding of JSON files
+    """
+    items = terms.items() if isinstance(terms, dict) else terms
+    with TermWriter(filename, encoding=encoding) as writer:
+        for cuid, obj in items:
+            writer.write(cuid, obj)
+
+
+class TermWriter:
+    """
+    Write terms to a JSON or SQLite file one concept at a time, such as to
+    write several files in one pass over the terms. Use it as a context
+    manager: the file is complete when the with block ends, and SQLite files
+    are written under a temporary name and then renamed, so readers never see
+    a partial file.
+    """
+    def __init__(self, filename, encoding="utf-8", sqlite=None):
+        """
+        Constructor. Creates the file.
+
+        Parameters
+        ----------
+        filename: str
+            Output filename (.json, .sqlite or .db)
+        encoding: str
+            Encoding of JSON files
+        sqlite: bool
+            True or False to write SQLite or JSON whatever the extension
+            (default by the extension)
+        """
+        self.filename = filename
+        self._f = None
+        self._conn = None
+        self._count = 0
+        if sqlite if sqlite is not None else is_sqlite(filename):
+            self._tmp_file = filename + ".tmp"
+            if os.path.exists(self._tmp_file):
+                os.remove(self._tmp_file)
+            self._conn = sqlite3.connect(self._tmp_file)
+            self._conn.execute("CREATE TABLE concepts (cui TEXT PRIMARY KEY, name TEXT, position INTEGER)")
+            self._conn.execute("CREATE TABLE terms (cui TEXT, name TEXT, text TEXT, score REAL, count INTEGER, "
+                               "position INTEGER, scores TEXT)")
+        else:
+            self._f = open(filename, "w", encoding=encoding)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        elif self._conn is not None:
+            # Leave any earlier file as it was
+            self._conn.close()
+        else:
+            self._f.close()
+
+    def write(self, cuid, obj):
+        """
+        Write the next concept.
+
+        Parameters
+        ----------
+        cuid: str
+            Concept ID
+        obj: dict
+            Concept with its "name" and a list of "terms"
+        """
+        if self._conn is not None:
+            _insert_concept(self._conn, cuid, obj, self._count)
+        else:
+            self._f.write(_json_concept(cuid, obj, self._count == 0))
+        self._count += 1
+
+    def close(self):
+        """
+        Finish writing the file.
+        """
+        if self._conn is not None:
+            try:
+                self._conn.execute("CREATE INDEX terms_cui ON terms (cui, position)")
+                self._conn.commit()
+            finally:
+                self._conn.close()
+            os.replace(self._tmp_file, self.filename)
+        else:
+            self._f.write("{}" if self._count == 0 else "\n}")
+            self._f.close()
+
+
+def write_json(items, f):
+    """
+    Write terms as JSON one concept at a time, the same as json.dump with an
+    indent of 2.
+
+    Parameters
+    ----------
+    items: iterable
+        (CUID, concept) tuples
+    f: file
+        File open for writing text
+    """
+    first = True
+    for cuid, obj in items:
+        f.write(_json_concept(cuid, obj, first))
+        first = False
+
+    f.write("{}" if first else "\n}")
+
+
+def _json_concept(cuid, obj, first):
+    """
+    Internal function to format a concept as JSON to write after the ones
+    before it.
+    """
+    # Dump the concept as a dict of its own and drop the braces, so it is
+    # indented as in the whole dict
+    return ("{\n" if first else ",\n") + json.dumps({cuid: obj}, indent=2, ensure_ascii=False)[2:-2]
+
+
+def load_terms(filename, cuids=None, encoding="utf-8"):
+    """
+    Load terms from a JSON or SQLite file, depending on the extension.
+
+    Parameters
+    ----------
+    filename: str
+        File written by annotate_docs.py
+    cuids: list
+        Optional CUIDs to load. Only these are read from SQLite files.
+    encoding: str
+        Encoding of JSON files
+
+    Returns
+    -------
+    Terms indexed by CUID, with the concept "name" and a list of "terms"
+    """
+    if is_sqlite(filename):
+        return read_sqlite(filename, cuids)
+
+    with open(filename, "r", encoding=encoding) as f:
+        terms = json.load(f)
+
+    if cuids is not None:
+        terms = {cuid: terms[cuid] for cuid in cuids if cuid in terms}
+
+    return terms
+
+
+def write_sqlite(terms, filename):
+    """
+    Save terms to an SQLite file. The file is written under a temporary name
+    and then renamed, so readers never see a partial file.
+
+    Parameters
+    ----------
+    terms: dict or iterable
+        Terms indexed by CUID, with the concept "name" and a list of "terms",
+        or (CUID, concept) tuples
+    filename: str
+        Output filename
+    """
+    items = terms.items() if isinstance(terms, dict) else terms
+    with TermWriter(filename, sqlite=True) as writer:
+        for cuid, obj in items:
+            writer.write(cuid, obj)
+
+
+def _insert_concept(conn, cuid, obj, position):
+    """
+    Internal function to add a concept and its terms to an SQLite file.
+    """
+    conn.execute("INSERT INTO concepts VALUES (?, ?, ?)", (cuid, obj["name"], position))
+    conn.executemany("INSERT INTO terms VALUES (?, ?, ?, ?, ?, ?, ?)",
+                     ((cuid, obj["name"], term["text"], term["score"], term["count"], i,
+                       json.dumps(term["scores"]) if "scores" in term else None)
+                      for i, term in enumerate(obj["terms"])))
+
+
+def read_sqlite(filename, cuids=None):
+    """
+    Load terms from an SQLite file.
+
+    Parameters
+    ----------
+    filename: str
+        File written by write_sqlite
+    cuids: list
+        Optional CUIDs to load, looked up with the index
+
+    Returns
+    -------
+    Terms indexed by CUID, with the concept "name" and a list of "terms"
+    """
+    if not os.path.exists(filename):
+        raise FileNotFoundError(filename)
+
+    conn = _connect_read_only(filename)
+    try:
+        if cuids is None:
+            concepts = conn.execute("SELECT cui, name FROM concepts ORDER BY position").fetchall()
+        else:
+            concepts = list()
+            for cuid in cuids:
+                row = conn.execute("SELECT cui, name FROM concepts WHERE cui = ?", (cuid,)).fetchone()
+                if row:
+                    concepts.append(row)
+
+        has_scores = _has_scores(conn)
+        terms = dict()
+        for cuid, name in concepts:
+            terms[cuid] = {"name": name, "terms": _read_terms(conn, cuid, has_scores)}
+    finally:
+        conn.close()
+
+    return terms
+
+
+def iter_terms(filename, encoding="utf-8", chunk_size=1 << 20):
+    """
+    Read terms one concept at a time from a JSON or SQLite file, without
+    loading the whole file.
+
+    Parameters
+    ----------
+    filename: str
+        File written by annotate_docs.py
+    encoding: str
+        Encoding of JSON files
+    chunk_size: int
+        Number of characters of JSON to read at a time
+
+    Returns
+    -------
+    Generator of (CUID, concept) tuples in the order of the file, each
+    concept with its "name" and a list of "terms"
+    """
+    if is_sqlite(filename):
+        yield from _iter_sqlite(filename)
+        return
+
+    with open(filename, "r", encoding=encoding) as f:
+        yield from _iter_json(f, chunk_size)
+
+
+def _iter_json(f, chunk_size):
+    """
+    Internal generator of the key and value pairs of a JSON object in a file,
+    decoding one value at a time from a buffer that is refilled as needed.
+    """
+    decoder = json.JSONDecoder()
+    buffer = ""
+    pos = 0
+    eof = False
+
+    def fill():
+        nonlocal buffer, pos, eof
+        chunk = f.read(chunk_size)
+        eof = not chunk
+        buffer = buffer[pos:] + chunk
+        pos = 0
+
+    def peek():
+        # Skip whitespace and get the next character
+        nonlocal pos
+        while True:
+            while pos < len(buffer) and buffer[pos] in " \t\r\n":
+                pos += 1
+            if pos < len(buffer):
+                return buffer[pos]
+            if eof:
+                raise ValueError("Unexpected end of %s" % f.name)
+            fill()
+
+    def decode():
+        # Decode the next value, reading more until it is complete
+        nonlocal pos
+        while True:
+            try:
+                value, pos = decoder.raw_decode(buffer, pos)
+                return value
+            except ValueError:
+                if eof:
+                    raise
+                fill()
+
+    def expect(char):
+        nonlocal pos
+        if peek() != char:
+            raise ValueError("Expected %r at character %d of %s" % (char, f.tell(), f.name))
+        pos += 1
+
+    expect("{")
+    if peek() == "}":
+        return
+
+    while True:
+        peek()
+        key = decode()
+        expect(":")
+        peek()
+        yield key, decode()
+
+        if peek() == "}":
+            return
+        expect(",")
+
+
+def _iter_sqlite(filename):
+    """
+    Internal generator of the concepts in an SQLite file, in their original
+    order.
+    """
+    if not os.path.exists(filename):
+        raise FileNotFoundError(filename)
+
+    conn = _connect_read_only(filename)
+    try:
+        has_scores = _has_scores(conn)
+        concepts = conn.execute("SELECT cui, name FROM concepts ORDER BY position")
+        for cuid, name in concepts:
+            yield cuid, {"name": name, "terms": _read_terms(conn, cuid, has_scores)}
+    finally:
+        conn.close()
+
+
+def _connect_read_only(filename):
+    """
+    Internal function to open an SQLite file read only. The path is quoted
+    as a URI, so names with characters such as "?", "#" or "%" work.
+    """
+    return sqlite3.connect(pathlib.Path(filename).resolve().as_uri() + "?mode=ro", uri=True)
+
+
+def _has_scores(conn):
+    """
+    Internal function to check whether an SQLite file has score histograms.
+    Files written before they were added don't have the column.
+    """
+    return any(row[1] == "scores" for row in conn.execute("PRAGMA table_info(terms)"))
+
+
+def _read_terms(conn, cuid, has_scores):
+    """
+    Internal function to read the terms of a concept from an SQLite file, in
+    their original order.
+    """
+    if not has_scores:
+        rows = conn.execute("SELECT text, score, count FROM terms WHERE cui = ? ORDER BY position", (cuid,))
+        return [{"text": text, "score": score, "count": count} for text, score, count in rows]
+
+    terms = list()
+    rows = conn.execute("SELECT text, score, count, scores FROM terms WHERE cui = ? ORDER BY position", (cuid,))
+    for text, score, count, scores in rows:
+        term = {"text": text, "score": score, "count": count}
+        if scores is not None:
+            term["scores"] = json.loads(scores)
+        terms.append(term)
+    return terms
@@ -0,0 +1,218 @@
+"""
+Class to find the terms of saved termsets in documents.
+
+Termsets saved by termset_generator.py (in "Saved Termsets" and "Reviewed
+Termsets") are JSON files of concepts and their terms. The TermsetMatcher
+class compiles the terms of one or more termsets into an Aho-Corasick
+automaton, which finds all of them in one pass over a document without
+ScispaCy, however many terms there are.
+
+Documents and terms are split into tokens of letters and digits, with each
+punctuation character a token of its own, and the automaton steps over
+tokens rather than characters. So a term only matches whole words, spacing
+and line breaks between words don't matter, and a document's tokens that
+appear in no term are skipped with one set lookup. Matching is case
+insensitive by default, since terms are saved in lowercase except for
+acronyms.
+"""
+from collections import deque
+import json
+import re
+
+# Runs of letters and digits, or single punctuation characters
+_token = re.compile(r"\w+|[^\w\s]")
+
+
+def load_termsets(filenames, encoding="utf-8"):
+    """
+    Load saved termsets.
+
+    Parameters
+    ----------
+    filenames (list of str)
+        Termset JSON files, each of concepts and their lists of terms
+    encoding (str)
+        Encoding of the files
+
+    Returns
+    -------
+    Dict of the terms of each concept, in the order read. The terms of a
+    concept that is in several files are combined.
+    """
+    termsets = dict()
+    for filename in filenames:
+        with open(filename, "r", encoding=encoding) as f:
+            data = json.load(f)
+
+        if not isinstance(data, dict) or not all(isinstance(terms, list) for terms in data.values()):
+            raise ValueError("%s is not a saved termset" % filename)
+
+        for concept, terms in data.items():
+            termset = termsets.setdefault(concept, list())
+            termset.extend(term for term in terms if isinstance(term, str) and term not in termset)
+
+    return termsets
+
+
+class TermsetMatcher:
+    """
+    Find the terms of termsets in documents.
+    """
+    def __init__(self, termsets, case_sensitive=False):
+        """
+        Constructor. Compiles the automaton.
+
+        Parameters
+        ----------
+        termsets (dict)
+            Lists of terms indexed by concept, as from load_termsets
+        case_sensitive (bool)
+            True to match only terms with the same case
+        """
+        self.case_sensitive = case_sensitive
+
+        # Terms as written in the termsets, and the concepts of each. Terms
+        # that only differ in case or spacing are the same term.
+        self.terms = list()
+        self.concepts = dict()
+
+        # Trie of the terms' tokens, with the failure link and the terms
+        # that end at each state
+        self._goto = [dict()]
+        self._fail = [0]
+        self._output = [()]
+
+        # Tokens that appear in some term
+        self._vocabulary = set()
+
+        ids = dict()
+        for concept, terms in termsets.items():
+            for term in terms:
+                tokens = tuple(self._tokenize(term))
+                if not tokens:
+                    continue
+
+                term_id = ids.get(tokens)
+                if term_id is None:
+                    term_id = ids[tokens] = len(self.terms)
+                    self.terms.append(term)
+                    self.concepts[term] = list()
+                    self._add(tokens, term_id)
+
+                if concept not in self.concepts[self.terms[term_id]]:
+                    self.concepts[self.terms[term_id]].append(concept)
+
+        self._link()
+
+    def __len__(self):
+        """
+        Number of distinct terms.
+        """
+        return len(self.terms)
+
+    def _tokenize(self, text):
+        """
+        Internal method to split text into tokens.
+        """
+        return _token.findall(text if self.case_sensitive else text.lower())
+
+    def _add(self, tokens, term_id):
+        """
+        Internal method to add a term's tokens to the trie.
+        """
+        goto = self._goto
+        state = 0
+        for token in tokens:
+            self._vocabulary.add(token)
+            next_state = goto[state].get(token)
+            if next_state is None:
+                next_state = len(goto)
+                goto[state][token] = next_state
+                goto.append(dict())
+                self._fail.append(0)
+                self._output.append(())
+            state = next_state
+
+        self._output[state] = (term_id,)
+
+    def _link(self):
+        """
+        Internal method to set the failure links breadth first, so that each
+        state also outputs the terms that end at its longest proper suffix.
+        """
+        goto = self._goto
+        fail = self._fail
+        output = self._output
+
+        queue = deque(goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for token, next_state in goto[state].items():
+                queue.append(next_state)
+
+                f = fail[state]
+                while f and token not in goto[f]:
+                    f = fail[f]
+                fail[next_state] = goto[f].get(token, 0)
+                output[next_state] = output[next_state] + output[fail[next_state]]
+
+    def _find_ids(self, text):
+        """
+        Internal generator of the ids of the terms found in text.
+        """
+        goto = self._goto
+        fail = self._fail
+        output = self._output
+        vocabulary = self._vocabulary
+
+        state = 0
+        for token in self._tokenize(text):
+            if token not in vocabulary:
+                state = 0
+                continue
+
+            while state and token not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(token, 0)
+
+            if output[state]:
+                yield from output[state]
+
+    def find(self, text):
+        """
+        Find the terms in a document.
+
+        Parameters
+        ----------
+        text (str)
+            Document text
+
+        Returns
+        -------
+        List of the terms found, in the order they end in the text, with a
+        term repeated for each time it is found. Overlapping terms, such as
+        "heart failure" within "congestive heart failure", are all found.
+        """
+        terms = self.terms
+        return [terms[term_id] for term_id in self._find_ids(text)]
+
+    def count(self, text):
+        """
+        Count the terms in a document.
+
+        Parameters
+        ----------
+        text (str)
+            Document text
+
+        Returns
+        -------
+        Dict of the number of times each term is found, in the order first
+        found
+        """
+        counts = dict()
+        for term_id in self._find_ids(text):
+            counts[term_id] = counts.get(term_id, 0) + 1
+
+        terms = self.terms
+        return {terms[term_id]: n for term_id, n in counts.items()}
@@ -0,0 +1,167 @@
+"""
+Class to split very long documents into windows for ScispaCy.
+
+Discharge summaries can be hundreds of KB long, beyond spaCy's max_length,
+and a single huge document holds up its whole batch and the memory for it.
+The TextChunker class splits documents longer than a window size into
+windows that end on paragraph or sentence boundaries where possible.
+
+Each window has a core region, and the windows' core regions cover the
+document without overlapping. A window also includes some of the text
+before and after its core, so that entities at the edges are tagged with
+their context. An entity belongs to the window whose core contains its
+first character, so each entity is found once.
+"""
+import re
+
+# Where to end a window, best first
+_paragraph_break = re.compile(r"\n\s*\n")
+_sentence_end = re.compile(r"[.!?;:](?=\s)|\n")
+_whitespace = re.compile(r"\s")
+
+
+class Window:
+    """
+    Window of a document to run through ScispaCy.
+    """
+    __slots__ = ("text", "core_start", "core_end")
+
+    def __init__(self, text, core_start, core_end):
+        """
+        Constructor.
+
+        Parameters
+        ----------
+        text (str)
+            Text of the window, including its context
+        core_start (int)
+            Offset in text of the first character of the core region
+        core_end (int)
+            Offset in text after the last character of the core region
+        """
+        self.text = text
+        self.core_start = core_start
+        self.core_end = core_end
+
+    def owns(self, ent):
+        """
+        True if an entity found in the window belongs to it.
+
+        Parameters
+        ----------
+        ent (spacy.tokens.Span)
+            Entity found in the window's text
+        """
+        return self.core_start <= ent.start_char < self.core_end
+
+
+class TextChunker:
+    """
+    Split long documents into windows.
+    """
+    def __init__(self, window_size=20000, overlap=200):
+        """
+        Constructor.
+
+        Parameters
+        ----------
+        window_size (int)
+            Max number of characters in the core of a window. Documents
+            this long or shorter aren't split.
+        overlap (int)
+            Number of characters of context to include before and after
+            the core of a window
+        """
+        if window_size < 2:
+            raise ValueError("The window size must be at least 2 characters")
+
+        self.window_size = window_size
+        self.overlap = overlap
+
+    def split(self, text):
+        """
+        Split a document into windows.
+
+        Parameters
+        ----------
+        text (str)
+            Document text
+
+        Returns
+        -------
+        List of Window objects in document order, or None if the document
+        is short enough to not be split
+        """
+        if len(text) <= self.window_size:
+            return None
+
+        cuts = self._cuts(text)
+
+        windows = list()
+        for core_start, core_end in zip(cuts, cuts[1:]):
+            start = self._context_start(text, core_start)
+            end = self._context_end(text, core_end)
+            windows.append(Window(text[start:end], core_start - start, core_end - start))
+
+        return windows
+
+    def _cuts(self, text):
+        """
+        Internal method to choose where the core regions start and end.
+
+        Returns
+        -------
+        List of offsets, starting with 0 and ending with the text length
+        """
+        cuts = [0]
+        while len(text) - cuts[-1] > self.window_size:
+            start = cuts[-1]
+            limit = start + self.window_size
+
+            # Don't make windows much shorter than needed to end on a
+            # boundary
+            cut = None
+            for pattern in (_paragraph_break, _sentence_end, _whitespace):
+                cut = _last_match_end(pattern, text, start + self.window_size // 2, limit)
+                if cut is not None:
+                    break
+
+            cuts.append(cut if cut is not None else limit)
+
+        cuts.append(len(text))
+        return cuts
+
+    def _context_start(self, text, core_start):
+        """
+        Internal method to find where a window starts, up to overlap
+        characters before its core, at the start of a word.
+        """
+        if core_start == 0:
+            return 0
+
+        start = max(core_start - self.overlap, 0)
+        space = _whitespace.search(text, start, core_start)
+        return space.end() if space and start > 0 else start
+
+    def _context_end(self, text, core_end):
+        """
+        Internal method to find where a window ends, up to overlap characters
+        after its core, at the end of a word.
+        """
+        end = min(core_end + self.overlap, len(text))
+        if end == len(text):
+            return end
+
+        space = _last_match_end(_whitespace, text, core_end, end)
+        return space if space is not None else end
+
+
+def _last_match_end(pattern, text, start, end):
+    """
+    Find the end of the last match of a pattern within text[start:end], or
+    None if there isn't one.
+    """
+    last = None
+    for match in pattern.finditer(text, start, end):
+        last = match.end()
+    return last